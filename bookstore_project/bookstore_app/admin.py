@@ -1,14 +1,32 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.forms import UserChangeForm, UserCreationForm
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from .models import Book, CustomUser
+from .models import Book, CustomUser, PriceRule
+from .paginators import EstimatedCountPaginator
+from .pricing import apply_price_rule
+from .search import prefix_search
+
+
+# Admin options shared by models that are expected to grow very large
+class ScalableAdminMixin:
+    paginator = EstimatedCountPaginator
+    # Avoid a second COUNT(*) over the whole table when a search is active
+    show_full_result_count = False
+
+    # Case-insensitive prefix search on indexed columns instead of icontains.
+    # Search terms only match the start of a value: "tales" finds "Tales of
+    # Kashyyyk" but not "Wookiee Tales".
+    def get_search_results(self, request, queryset, search_term):
+        return prefix_search(queryset, self.search_fields, search_term), False
 
 
 # Custom UserAdmin class for the CustomUser model
 @admin.register(CustomUser)
-class CustomUserAdmin(BaseUserAdmin):
+class CustomUserAdmin(ScalableAdminMixin, BaseUserAdmin):
     form = UserChangeForm
     add_form = UserCreationForm
     # Additional fieldsets for the CustomUser model including 'author_pseudonym'
@@ -17,20 +35,27 @@ class CustomUserAdmin(BaseUserAdmin):
     ]
     # Fields to display in the list view for CustomUser objects
     list_display = ("username", "email", "first_name", "last_name", "author_pseudonym")
-    # Fields that can be searched in the admin list view for CustomUser objects
+    # Fields whose prefixes can be searched in the admin list view for CustomUser
+    # objects, each backed by an index on its lower-cased value
     search_fields = ("username", "email", "first_name", "last_name", "author_pseudonym")
 
 
 # Custom Admin class for the Book model
 @admin.register(Book)
-class BookAdmin(admin.ModelAdmin):
+class BookAdmin(ScalableAdminMixin, admin.ModelAdmin):
     # Fields to display in the list view for Book objects
     list_display = (
         "title",
         "author",
         "price",
+        "is_published",
     )
-    # Fields that can be searched in the admin list view for Book objects
+    list_filter = ("is_published",)
+    # Load authors in the changelist query instead of one query per row
+    list_select_related = ("author",)
+    # Authors are picked through a search box instead of a full <select>
+    autocomplete_fields = ("author",)
+    # Fields whose prefixes can be searched in the admin list view for Book objects
     search_fields = (
         "title",
         "author__username",
@@ -46,8 +71,53 @@ class BookAdmin(admin.ModelAdmin):
                     "author",
                     "cover_image",
                     "price",
+                    "is_published",
                 ),
                 "description": "These fields are related to the book details.",
             },
         ),
     )
+
+    # Sharded books cannot be joined with their authors in one query
+    def get_list_select_related(self, request):
+        if settings.BOOK_SHARD_DATABASES:
+            return ()
+        return super().get_list_select_related(request)
+
+    # Admins manage unpublished books as well
+    def get_queryset(self, request):
+        return Book.all_objects.all()
+
+
+# Custom Admin class for the PriceRule model
+@admin.register(PriceRule)
+class PriceRuleAdmin(admin.ModelAdmin):
+    list_display = ("name", "kind", "amount", "starts_at", "ends_at", "applied_at")
+    list_filter = ("kind",)
+    autocomplete_fields = ("author",)
+    readonly_fields = ("applied_at",)
+    actions = ["apply_rules"]
+
+    # Write the discounts of the selected rules in effect into the stored book
+    # prices; scheduled, expired and applied rules are skipped
+    @admin.action(description=_("Apply selected rules to book prices"))
+    def apply_rules(self, request, queryset):
+        now = timezone.now()
+        updated = 0
+        skipped = 0
+        for rule in queryset:
+            count = apply_price_rule(rule) if rule.is_active(now) else None
+            if count is None:
+                skipped += 1
+            else:
+                updated += count
+        self.message_user(
+            request, _("Updated the prices of %(count)d books.") % {"count": updated}
+        )
+        if skipped:
+            self.message_user(
+                request,
+                _("Skipped %(count)d rules that are not in effect or already applied.")
+                % {"count": skipped},
+                messages.WARNING,
+            )
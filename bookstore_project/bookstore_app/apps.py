@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 from .banned_users_cache import set_banned_users
 
@@ -7,7 +8,16 @@ class BookstoreAppConfig(AppConfig):
     name = "bookstore_app"
 
     def ready(self):
+        # Register background job handlers and signal receivers
+        from . import signals, tasks  # noqa: F401
+
         banned_usernames = [
             "Darth Vader",
         ]
         set_banned_users(banned_usernames)
+
+        # Build lazily initialised state before the first request arrives
+        if settings.WARM_UP_ON_READY:
+            from .warmup import warm_up
+
+            warm_up()
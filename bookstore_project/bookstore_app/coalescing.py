@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+# Metric names: leaders computed a result, local and remote followers reused a
+# result computed by another thread or worker, fallbacks gave up waiting
+METRICS = ("leaders", "local_followers", "remote_followers", "fallbacks")
+
+
+def _cache():
+    return caches[settings.COALESCE_CACHE_ALIAS]
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Collapses concurrent identical computations into one.
+# Within a process, threads asking for a key that is already being computed
+# wait for and share that result. Across workers, the first to take a lock in
+# the shared cache computes and publishes the result for COALESCE_RESULT_TTL
+# seconds while the others poll for it. This needs a cache shared between
+# workers, such as Redis or Memcached; with the default local-memory cache only
+# in-process coalescing applies.
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.stats = Counter()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._record("local_followers")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._do_shared(key, func)
+        except Exception as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _do_shared(self, key, func):
+        cache = _cache()
+        lock_key = f"coalesce:lock:{key}"
+        result_key = f"coalesce:result:{key}"
+
+        if cache.add(lock_key, 1, timeout=settings.COALESCE_LOCK_TIMEOUT):
+            try:
+                result = func()
+                cache.set(result_key, result, timeout=settings.COALESCE_RESULT_TTL)
+            finally:
+                cache.delete(lock_key)
+            self._record("leaders")
+            return result
+
+        # Another worker holds the lock; wait for the result it publishes. The
+        # lock is read before the result, as the leader publishes the result
+        # before releasing the lock.
+        deadline = time.monotonic() + settings.COALESCE_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            locked = cache.get(lock_key) is not None
+            result = cache.get(result_key, _MISSING)
+            if result is not _MISSING:
+                self._record("remote_followers")
+                return result
+            if not locked:
+                break
+            time.sleep(settings.COALESCE_POLL_INTERVAL)
+
+        self._record("fallbacks")
+        return func()
+
+    def _record(self, metric):
+        self.stats[metric] += 1
+        cache = _cache()
+        try:
+            cache.incr(f"coalesce:stats:{metric}")
+        except ValueError:
+            cache.add(f"coalesce:stats:{metric}", 1, timeout=None)
+
+
+single_flight = SingleFlight()
+
+
+# Metrics of every worker sharing the cache
+def coalescing_stats():
+    cache = _cache()
+    stats = {metric: cache.get(f"coalesce:stats:{metric}", 0) for metric in METRICS}
+    stats["collapsed"] = stats["local_followers"] + stats["remote_followers"]
+    return stats
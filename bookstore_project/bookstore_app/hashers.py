@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.contrib.auth.hashers import ScryptPasswordHasher
+
+
+# Scrypt hasher whose cost parameters are tuned from settings.
+# Passwords stored with other parameters (or other hashers) are rehashed
+# transparently the next time their owner logs in.
+class TunableScryptPasswordHasher(ScryptPasswordHasher):
+    @property
+    def work_factor(self):
+        return settings.PASSWORD_SCRYPT_WORK_FACTOR
+
+    @property
+    def block_size(self):
+        return settings.PASSWORD_SCRYPT_BLOCK_SIZE
+
+    @property
+    def parallelism(self):
+        return settings.PASSWORD_SCRYPT_PARALLELISM
+
+    @property
+    def maxmem(self):
+        # Leave headroom above the 128 * n * r bytes scrypt needs
+        return 256 * self.work_factor * self.block_size
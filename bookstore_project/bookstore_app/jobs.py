@@ -0,0 +1,143 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Maps job names to the callables that execute them
+job_registry = {}
+
+
+# Register a function as the handler for jobs with the given name
+def job(name):
+    def decorator(func):
+        job_registry[name] = func
+        return func
+
+    return decorator
+
+
+def _create_job(name, payload, idempotency_key, run_after):
+    try:
+        with transaction.atomic():
+            return Job.objects.create(
+                name=name,
+                payload=payload,
+                idempotency_key=idempotency_key,
+                max_attempts=settings.JOB_QUEUE_MAX_ATTEMPTS,
+                run_after=run_after or timezone.now(),
+            )
+    except IntegrityError:
+        # A job with the same idempotency key already exists
+        logger.debug("Skipping duplicate job %s (%s)", name, idempotency_key)
+        return None
+
+
+# Queue a job once the current transaction commits.
+# Rolled back writes never leave follow-up work behind, and callers outside a
+# transaction get the job inserted immediately.
+def enqueue(name, payload=None, idempotency_key=None, run_after=None):
+    if name not in job_registry:
+        raise LookupError(f"No job registered under the name {name!r}")
+    transaction.on_commit(
+        lambda: _create_job(name, payload or {}, idempotency_key, run_after)
+    )
+
+
+# Delay before the next attempt, doubling with every failure
+def retry_delay(attempts):
+    delay = settings.JOB_QUEUE_RETRY_BACKOFF * (2 ** max(attempts - 1, 0))
+    return timedelta(seconds=min(delay, settings.JOB_QUEUE_MAX_BACKOFF))
+
+
+# Return jobs whose worker died mid-run to the pending state, or mark them
+# failed once they have used up their attempts
+def requeue_stale_jobs():
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=settings.JOB_QUEUE_LOCK_TIMEOUT)
+    stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff)
+    stale.filter(attempts__gte=F("max_attempts")).update(
+        status=Job.FAILED,
+        locked_at=None,
+        last_error="Abandoned by its worker",
+        updated_at=now,
+    )
+    return stale.update(status=Job.PENDING, locked_at=None, updated_at=now)
+
+
+# Delete finished jobs older than JOB_QUEUE_RETENTION seconds
+def prune_finished_jobs():
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_QUEUE_RETENTION)
+    deleted, _ = Job.objects.filter(
+        status__in=[Job.SUCCEEDED, Job.FAILED], updated_at__lt=cutoff
+    ).delete()
+    return deleted
+
+
+# Atomically mark up to `limit` due jobs as running and return their ids.
+# The conditional UPDATE makes claiming safe across workers without relying on
+# row locks, which SQLite does not provide.
+def claim_jobs(limit):
+    now = timezone.now()
+    candidates = (
+        Job.objects.filter(status=Job.PENDING, run_after__lte=now)
+        .order_by("run_after")
+        .values_list("pk", flat=True)[:limit]
+    )
+    claimed = []
+    for pk in candidates:
+        updated = Job.objects.filter(pk=pk, status=Job.PENDING).update(
+            status=Job.RUNNING,
+            locked_at=now,
+            attempts=F("attempts") + 1,
+            updated_at=now,
+        )
+        if updated:
+            claimed.append(pk)
+    return claimed
+
+
+# Execute a claimed job and record its outcome. Returns True on success.
+def run_job(pk):
+    job_obj = Job.objects.get(pk=pk)
+    handler = job_registry.get(job_obj.name)
+    try:
+        if handler is None:
+            raise LookupError(f"No job registered under the name {job_obj.name!r}")
+        handler(**job_obj.payload)
+    except Exception as exc:
+        logger.exception("Job %s (%s) failed", job_obj.pk, job_obj.name)
+        _record_failure(job_obj, exc)
+        return False
+    Job.objects.filter(pk=pk).update(
+        status=Job.SUCCEEDED, locked_at=None, last_error="", updated_at=timezone.now()
+    )
+    return True
+
+
+# Record the failure of a claimed job that could not be run, for example
+# because the database was locked
+def record_job_error(pk, exc):
+    _record_failure(Job.objects.get(pk=pk), exc)
+
+
+def _record_failure(job_obj, exc):
+    if job_obj.attempts >= job_obj.max_attempts:
+        status = Job.FAILED
+        run_after = job_obj.run_after
+    else:
+        status = Job.PENDING
+        run_after = timezone.now() + retry_delay(job_obj.attempts)
+    Job.objects.filter(pk=job_obj.pk).update(
+        status=status,
+        locked_at=None,
+        run_after=run_after,
+        last_error=f"{type(exc).__name__}: {exc}",
+        updated_at=timezone.now(),
+    )
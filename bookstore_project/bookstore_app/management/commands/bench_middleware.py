@@ -0,0 +1,64 @@
+import io
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+
+from bookstore_project.handlers import APIWSGIHandler
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-request time of an API path served through the full "
+        "middleware chain and through the lean API chain."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            default="/api/",
+            help="API path to request; the default API root needs no database.",
+        )
+        parser.add_argument(
+            "--requests",
+            type=int,
+            default=2000,
+            help="Requests issued per middleware chain.",
+        )
+
+    def handle(self, *args, **options):
+        results = {}
+        for label, handler in [
+            ("Full middleware", WSGIHandler()),
+            ("API middleware", APIWSGIHandler()),
+        ]:
+            # One untimed request to build lazily initialised state
+            self.request(handler, options["path"])
+            start = time.perf_counter()
+            for _ in range(options["requests"]):
+                self.request(handler, options["path"])
+            per_request = (time.perf_counter() - start) / options["requests"]
+            results[label] = per_request
+            self.stdout.write(f"{label}: {per_request * 1e6:.1f} us/request")
+
+        saved = results["Full middleware"] - results["API middleware"]
+        self.stdout.write(
+            f"Saved per request: {saved * 1e6:.1f} us "
+            f"({saved / results['Full middleware']:.1%})"
+        )
+
+    def request(self, handler, path):
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": path,
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "HTTP_ACCEPT": "application/json",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.url_scheme": "http",
+            "wsgi.errors": io.StringIO(),
+        }
+        response = handler(environ, lambda status, headers: None)
+        b"".join(response)
+        response.close()
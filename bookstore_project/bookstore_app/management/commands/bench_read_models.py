@@ -0,0 +1,157 @@
+import time
+import tracemalloc
+from contextlib import ExitStack
+from decimal import Decimal
+
+from bookstore_app.models import Book
+from bookstore_app.pricing import price_rules
+from bookstore_app.read_models import ReadModel
+from bookstore_app.serializers import BookSerializer
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+User = get_user_model()
+
+USERNAME_PREFIX = "bench-read-models-"
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the book list path built on model instances with the "
+        "read-model path: memory held by the loaded rows per 10k books, "
+        "query count and time to query and serialize. Temporary books are "
+        "created for the run and removed afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            action="append",
+            help="Number of books listed; may be given several times.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=3,
+            help="Runs per measurement; the fastest run is reported.",
+        )
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get("/api/books/"))
+        context = {"request": request}
+        price_rules.ensure_current()
+        paths = [
+            ("Model instances", self.load_instances, self.serialize_instances),
+            ("Read model", self.load_records, self.serialize_records),
+        ]
+
+        for rows in options["rows"] or [10_000]:
+            author_ids = self.create_books(rows)
+            queryset = Book.objects.filter(author__in=author_ids)
+            self.stdout.write(f"\n{rows} rows")
+            self.stdout.write(
+                f"{'path':<16} {'KiB/10k rows':>13} {'queries':>8} {'ms':>10}"
+            )
+            try:
+                # Query logging would add to the measured memory and time
+                with override_settings(DEBUG=False):
+                    for name, load, serialize in paths:
+                        memory = self.retained_memory(lambda: load(queryset, context))
+                        queries = self.count_queries(
+                            lambda: serialize(queryset, context)
+                        )
+                        elapsed = self.best_of(
+                            options["repeat"], lambda: serialize(queryset, context)
+                        )
+                        self.stdout.write(
+                            f"{name:<16} {memory / rows * 10_000 / 1024:>13.0f} "
+                            f"{queries:>8} {elapsed * 1000:>10.1f}"
+                        )
+            finally:
+                Book.all_objects.filter(author__in=author_ids).delete()
+                User.objects.filter(pk__in=author_ids).delete()
+
+    # Model instances as the serializer sees them, with their authors loaded.
+    # Every run copies the queryset so no run reuses another's results.
+    def load_instances(self, queryset, context):
+        books = list(queryset.all())
+        for book in books:
+            book.author
+        return books
+
+    def serialize_instances(self, queryset, context):
+        return BookSerializer(queryset.all(), many=True, context=context).data
+
+    def load_records(self, queryset, context):
+        return ReadModel(BookSerializer(context=context)).records(queryset)
+
+    def serialize_records(self, queryset, context):
+        read_model = ReadModel(BookSerializer(context=context))
+        return read_model.to_representation(read_model.records(queryset))
+
+    def create_books(self, rows):
+        authors = [
+            User(
+                username=f"{USERNAME_PREFIX}{i}",
+                first_name="Lohgarra",
+                last_name="Wookie",
+            )
+            for i in range(50)
+        ]
+        for author in authors:
+            author.set_unusable_password()
+        authors = User.objects.bulk_create(authors)
+        Book.all_objects.bulk_create(
+            (
+                Book(
+                    title=f"Adventures on Kashyyyk, volume {i}",
+                    description="A self-published tale from the forests of "
+                    "Kashyyyk. " * 4,
+                    author=authors[i % len(authors)],
+                    price=Decimal(i % 10_000) / 100,
+                )
+                for i in range(1, rows + 1)
+            ),
+            batch_size=1000,
+        )
+        return [author.pk for author in authors]
+
+    # Queries run by `func` on every database
+    def count_queries(self, func):
+        count = 0
+
+        def counter(execute, *args):
+            nonlocal count
+            count += 1
+            return execute(*args)
+
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(counter))
+            func()
+        return count
+
+    # Bytes allocated by `func` and still held by its result
+    def retained_memory(self, func):
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            result = func()
+            retained = tracemalloc.get_traced_memory()[0] - baseline
+        finally:
+            tracemalloc.stop()
+        del result
+        return retained
+
+    def best_of(self, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
@@ -0,0 +1,93 @@
+import io
+import time
+from decimal import Decimal
+
+from bookstore_app.models import Book
+from bookstore_app.parsers import MessagePackParser
+from bookstore_app.renderers import MessagePackRenderer
+from bookstore_app.serializers import BookSerializer
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework_xml.parsers import XMLParser
+from rest_framework_xml.renderers import XMLRenderer
+
+User = get_user_model()
+
+FORMATS = [
+    ("JSON", JSONRenderer, JSONParser),
+    ("XML", XMLRenderer, XMLParser),
+    ("MessagePack", MessagePackRenderer, MessagePackParser),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare payload size and encode/decode time of the JSON, XML and "
+        "MessagePack formats for book lists. No database access is needed."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rows",
+            type=int,
+            action="append",
+            help="Number of books in the list; may be given several times.",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=5,
+            help="Runs per measurement; the fastest run is reported.",
+        )
+
+    def handle(self, *args, **options):
+        for rows in options["rows"] or [100, 10_000]:
+            data = BookSerializer(self.make_books(rows), many=True).data
+            self.stdout.write(f"\n{rows} rows")
+            self.stdout.write(
+                f"{'format':<12} {'bytes':>12} {'encode ms':>10} {'decode ms':>10}"
+            )
+            for name, renderer_class, parser_class in FORMATS:
+                renderer = renderer_class()
+                parser = parser_class()
+                payload = renderer.render(data)
+                # The XML renderer returns text rather than bytes
+                if isinstance(payload, str):
+                    payload = payload.encode()
+                encode = self.best_of(options["repeat"], lambda: renderer.render(data))
+                decode = self.best_of(
+                    options["repeat"],
+                    lambda: parser.parse(
+                        io.BytesIO(payload), parser.media_type, {"view": None}
+                    ),
+                )
+                self.stdout.write(
+                    f"{name:<12} {len(payload):>12} {encode * 1000:>10.2f} "
+                    f"{decode * 1000:>10.2f}"
+                )
+
+    def make_books(self, rows):
+        authors = [
+            User(id=i, username=f"author{i}", first_name="Lohgarra", last_name="Wookie")
+            for i in range(1, 51)
+        ]
+        return [
+            Book(
+                id=i,
+                title=f"Adventures on Kashyyyk, volume {i}",
+                description="A self-published tale from the forests of Kashyyyk. " * 4,
+                author=authors[i % len(authors)],
+                price=Decimal(i % 10_000) / 100,
+            )
+            for i in range(1, rows + 1)
+        ]
+
+    def best_of(self, repeat, func):
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return min(timings)
@@ -0,0 +1,77 @@
+import time
+
+from bookstore_app.views import DenylistTokenRefreshView
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+from rest_framework_simplejwt.views import TokenObtainPairView
+
+User = get_user_model()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the token endpoints on a single core and report logins and "
+        "refreshes per second. Nothing is persisted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--iterations",
+            type=int,
+            default=50,
+            help="Requests issued per endpoint.",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options["iterations"])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def run(self, iterations):
+        factory = APIRequestFactory()
+        obtain_view = TokenObtainPairView.as_view()
+        refresh_view = DenylistTokenRefreshView.as_view()
+        credentials = {"username": "bench_tokens_user", "password": "bench-password"}
+
+        user = User.objects.create_user(**credentials)
+        # Login against a legacy PBKDF2 hash, including the rehash on first login
+        user.password = make_password(credentials["password"], hasher="pbkdf2_sha256")
+        user.save(update_fields=["password"])
+        start = time.perf_counter()
+        response = obtain_view(factory.post("/api/token/", credentials, format="json"))
+        self.report("First login with PBKDF2 hash (rehashed)", 1, start)
+
+        start = time.perf_counter()
+        for _ in range(iterations):
+            response = obtain_view(
+                factory.post("/api/token/", credentials, format="json")
+            )
+            assert response.status_code == 200, response.data
+        self.report("Login", iterations, start)
+
+        refresh = response.data["refresh"]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            response = refresh_view(
+                factory.post("/api/token/refresh/", {"refresh": refresh}, format="json")
+            )
+            assert response.status_code == 200, response.data
+            refresh = response.data.get("refresh", refresh)
+        self.report("Refresh", iterations, start)
+
+    def report(self, label, count, start):
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"{label}: {count} requests in {elapsed:.3f}s, "
+            f"{count / elapsed:.1f} requests/sec per core"
+        )
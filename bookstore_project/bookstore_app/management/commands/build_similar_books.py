@@ -0,0 +1,42 @@
+import time
+
+from bookstore_app.similarity import build_similar_books
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the TF-IDF model of book titles and descriptions and store the "
+        "top-k similar books of every published book."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top-k",
+            type=int,
+            default=settings.SIMILAR_BOOKS_TOP_K,
+            help="Similar books stored per book.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Books whose similarities are computed at once.",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        def progress(done, total):
+            self.stdout.write(f"{done}/{total} books")
+
+        book_count = build_similar_books(
+            options["top_k"], options["batch_size"], progress=progress
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Computed similar books for {book_count} books in "
+                f"{time.perf_counter() - start:.1f}s"
+            )
+        )
@@ -0,0 +1,10 @@
+from bookstore_app.coalescing import coalescing_stats
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Show how many book list requests were coalesced into shared results."
+
+    def handle(self, *args, **options):
+        for metric, value in coalescing_stats().items():
+            self.stdout.write(f"{metric}: {value}")
@@ -0,0 +1,281 @@
+import csv
+import io
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+
+from bookstore_app.models import Book
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+User = get_user_model()
+
+
+# Shrink a cover to `max_size` in a pool process and return the encoded image.
+# Runs without Django; the parent process writes the result to storage.
+def prepare_cover(path, max_size):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.load()
+        image_format = image.format
+        if image.width > max_size[0] or image.height > max_size[1]:
+            image.thumbnail(max_size)
+        output = io.BytesIO()
+        image.save(output, format=image_format)
+    return output.getvalue()
+
+
+# Rows of a CSV or newline-delimited JSON file, read one line at a time
+def read_rows(path, file_format):
+    with open(path, newline="", encoding="utf-8") as source:
+        if file_format == "csv":
+            yield from csv.DictReader(source)
+            return
+        for line in source:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = (
+        "Import books from a CSV or newline-delimited JSON file, creating "
+        "missing authors and resizing covers from a local directory in a "
+        "process pool. Interrupted imports resume where they stopped. Rows need "
+        "title, description, price and author (username) and may have "
+        "author_pseudonym and cover (file name in --covers-dir)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="CSV or NDJSON file to import.")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "ndjson"],
+            help="Input format; guessed from the file extension by default.",
+        )
+        parser.add_argument(
+            "--covers-dir",
+            help="Directory holding the cover files named in the input.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Books inserted per transaction.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Processes resizing covers.",
+        )
+        parser.add_argument(
+            "--state",
+            help="File recording the progress of the import; defaults to the "
+            "source path with .import-state.json appended.",
+        )
+        parser.add_argument(
+            "--restart",
+            action="store_true",
+            help="Ignore the recorded progress and import from the first row.",
+        )
+
+    def handle(self, *args, **options):
+        source = Path(options["source"])
+        if not source.is_file():
+            raise CommandError(f"{source} does not exist.")
+        file_format = options["format"] or (
+            "csv" if source.suffix.lower() == ".csv" else "ndjson"
+        )
+        self.covers_dir = Path(options["covers_dir"]) if options["covers_dir"] else None
+        self.state_path = Path(options["state"] or f"{source}.import-state.json")
+        self.source_stat = source.stat()
+        self.authors = {}
+        self.counts = {"books": 0, "authors": 0, "covers": 0, "skipped": 0}
+
+        state = self.load_state()
+        # Covers saved for a batch that was not inserted before the previous
+        # run stopped
+        self.delete_orphan_covers(state.get("covers", []))
+        done = 0 if options["restart"] else state.get("rows", 0)
+        if done:
+            self.stdout.write(f"Resuming after row {done}")
+        rows = itertools.islice(read_rows(source, file_format), done, None)
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=options["workers"]) as pool:
+            # The first batch after a resume may already have been inserted
+            # if the previous run stopped before recording it
+            check_existing = done > 0
+            while batch := list(itertools.islice(rows, options["batch_size"])):
+                self.import_batch(batch, pool, check_existing, done)
+                check_existing = False
+                done += len(batch)
+                self.save_state(done)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(
+                    f"{done} rows, {self.counts['books']} books, "
+                    f"{self.counts['covers']} covers, "
+                    f"{self.counts['skipped']} skipped, "
+                    f"{self.counts['books'] / elapsed:.0f} books/s"
+                )
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Imported {self.counts['books']} books, "
+                f"{self.counts['authors']} new authors and "
+                f"{self.counts['covers']} covers in {elapsed:.1f}s"
+            )
+        )
+        # Imported books are inserted without signals
+        self.stdout.write("Run build_similar_books to include them in similar books.")
+
+    # Import the rows following the first `done` rows of the source
+    def import_batch(self, rows, pool, check_existing, done):
+        rows = [row for row in rows if self.is_valid(row)]
+        max_size = settings.BOOK_COVER_MAX_SIZE
+        covers = {
+            index: pool.submit(prepare_cover, self.covers_dir / row["cover"], max_size)
+            for index, row in enumerate(rows)
+            if row.get("cover") and self.covers_dir
+        }
+        # Authors are resolved while the pool works on the covers
+        self.resolve_authors(rows)
+
+        books = [
+            Book(
+                title=row["title"],
+                description=row.get("description", ""),
+                author_id=self.authors[row["author"]],
+                price=Decimal(str(row["price"])),
+            )
+            for row in rows
+        ]
+        if check_existing:
+            existing = set(
+                Book.all_objects.filter(
+                    author_id__in={book.author_id for book in books},
+                    title__in={book.title for book in books},
+                ).values_list("author_id", "title")
+            )
+        else:
+            existing = set()
+
+        new_books = []
+        saved_covers = []
+        for index, (book, row) in enumerate(zip(books, rows)):
+            if (book.author_id, book.title) in existing:
+                continue
+            if index in covers:
+                try:
+                    data = covers[index].result()
+                except Exception as exc:
+                    self.stderr.write(f"Skipping cover {row['cover']}: {exc}")
+                else:
+                    book.cover_image.name = default_storage.save(
+                        f"book_covers/{Path(row['cover']).name}", ContentFile(data)
+                    )
+                    saved_covers.append(book.cover_image.name)
+            new_books.append(book)
+
+        # Covers are stored before their books are inserted. They are recorded
+        # first so a run that stops in between has them removed on resume.
+        self.save_state(done, saved_covers)
+        try:
+            with transaction.atomic():
+                Book.all_objects.bulk_create(new_books)
+        except BaseException:
+            self.delete_orphan_covers(saved_covers)
+            raise
+        self.counts["books"] += len(new_books)
+        self.counts["covers"] += len(saved_covers)
+
+    def is_valid(self, row):
+        try:
+            Book._meta.get_field("price").clean(row.get("price"), None)
+        except ValidationError:
+            valid = False
+        else:
+            valid = bool(row.get("title") and row.get("author"))
+        if not valid:
+            self.counts["skipped"] += 1
+        return valid
+
+    # Look up the authors of a batch that are not cached yet and create the
+    # missing ones, all with a single query each
+    def resolve_authors(self, rows):
+        pseudonyms = {}
+        for row in rows:
+            if row["author"] not in self.authors:
+                pseudonyms.setdefault(
+                    row["author"], row.get("author_pseudonym") or None
+                )
+        if not pseudonyms:
+            return
+
+        self.authors.update(
+            User.objects.filter(username__in=list(pseudonyms)).values_list(
+                "username", "pk"
+            )
+        )
+        new_authors = []
+        for username, pseudonym in pseudonyms.items():
+            if username not in self.authors:
+                author = User(username=username, author_pseudonym=pseudonym)
+                author.set_unusable_password()
+                new_authors.append(author)
+        User.objects.bulk_create(new_authors)
+        self.authors.update((author.username, author.pk) for author in new_authors)
+        self.counts["authors"] += len(new_authors)
+
+    # Delete stored covers that no book refers to
+    def delete_orphan_covers(self, names):
+        if not names:
+            return
+        referenced = set(
+            Book.all_objects.filter(cover_image__in=names).values_list(
+                "cover_image", flat=True
+            )
+        )
+        for name in set(names) - referenced:
+            default_storage.delete(name)
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        # Progress recorded for a different version of the source is ignored
+        if state.get("size") != self.source_stat.st_size or state.get("mtime") != int(
+            self.source_stat.st_mtime
+        ):
+            self.stdout.write(
+                self.style.WARNING("Source changed since the last run, restarting")
+            )
+            return {"covers": state.get("covers", [])}
+        return state
+
+    # Record the rows imported so far and the covers stored for books that
+    # are not inserted yet
+    def save_state(self, rows, covers=()):
+        state = {
+            "size": self.source_stat.st_size,
+            "mtime": int(self.source_stat.st_mtime),
+            "rows": rows,
+            "covers": list(covers),
+        }
+        temporary_path = self.state_path.with_name(f"{self.state_path.name}.tmp")
+        with open(temporary_path, "w") as state_file:
+            json.dump(state, state_file)
+        os.replace(temporary_path, self.state_path)
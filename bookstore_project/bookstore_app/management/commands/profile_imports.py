@@ -0,0 +1,122 @@
+import json
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Code run in a fresh interpreter to reproduce a worker boot
+BOOT_SCRIPT = "; ".join(
+    [
+        "import django",
+        "django.setup()",
+        "from django.urls import get_resolver",
+        "get_resolver()._populate()",
+    ]
+)
+
+
+# Parse `python -X importtime` output into {module: (self us, cumulative us)}
+def parse_importtime(output):
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+class Command(BaseCommand):
+    help = (
+        "Profile the import cost of booting a worker and report the most "
+        "expensive modules and top-level packages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--top",
+            type=int,
+            default=20,
+            help="Number of modules and packages to list.",
+        )
+        parser.add_argument(
+            "--output",
+            help="Write the per-module report as JSON to this file.",
+        )
+        parser.add_argument(
+            "--baseline",
+            help="JSON report from an earlier run to compare against.",
+        )
+        parser.add_argument(
+            "--threshold-ms",
+            type=float,
+            default=5.0,
+            help="Report packages whose import time grew by more than this.",
+        )
+
+    def handle(self, *args, **options):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", BOOT_SCRIPT],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Worker boot failed:\n{result.stderr}")
+
+        modules = parse_importtime(result.stderr)
+        packages = defaultdict(int)
+        for name, (self_us, _) in modules.items():
+            packages[name.split(".")[0]] += self_us
+        total_us = sum(packages.values())
+
+        self.stdout.write(f"Total import time: {total_us / 1000:.1f} ms")
+        self.stdout.write("\nSlowest modules (cumulative ms, self ms):")
+        slowest = sorted(modules.items(), key=lambda item: item[1][1], reverse=True)
+        for name, (self_us, cumulative_us) in slowest[: options["top"]]:
+            self.stdout.write(
+                f"  {cumulative_us / 1000:>9.1f} {self_us / 1000:>9.1f}  {name}"
+            )
+
+        self.stdout.write("\nSlowest top-level packages (self ms):")
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+        for name, self_us in heaviest[: options["top"]]:
+            self.stdout.write(f"  {self_us / 1000:>9.1f}  {name}")
+
+        if options["baseline"]:
+            self.compare(packages, options["baseline"], options["threshold_ms"])
+
+        if options["output"]:
+            with open(options["output"], "w") as report_file:
+                json.dump(
+                    {
+                        "total_us": total_us,
+                        "packages": packages,
+                        "modules": {
+                            name: {"self_us": self_us, "cumulative_us": cumulative_us}
+                            for name, (self_us, cumulative_us) in modules.items()
+                        },
+                    },
+                    report_file,
+                    indent=2,
+                )
+            self.stdout.write(f"\nReport written to {options['output']}")
+
+    def compare(self, packages, baseline_path, threshold_ms):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)["packages"]
+
+        regressions = []
+        for name, self_us in packages.items():
+            growth_ms = (self_us - baseline.get(name, 0)) / 1000
+            if growth_ms > threshold_ms:
+                regressions.append((growth_ms, name))
+
+        if not regressions:
+            self.stdout.write(self.style.SUCCESS("\nNo import time regressions."))
+            return
+        self.stdout.write(self.style.WARNING("\nImport time regressions:"))
+        for growth_ms, name in sorted(regressions, reverse=True):
+            self.stdout.write(f"  +{growth_ms:.1f} ms  {name}")
@@ -0,0 +1,87 @@
+from bookstore_app.sharding import (
+    author_book_counts,
+    import_unsharded_books,
+    move_author,
+    plan_rebalance,
+)
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Move authors and their books between book shards while the site keeps "
+        "running, either explicitly or until the shards hold similar numbers of "
+        "books."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--author",
+            type=int,
+            action="append",
+            help="Move this author; may be given several times. Requires --to.",
+        )
+        parser.add_argument("--to", help="Shard to move the given authors to.")
+        parser.add_argument(
+            "--import-unsharded",
+            action="store_true",
+            help="First move books stored in the default database before "
+            "sharding was enabled.",
+        )
+        parser.add_argument(
+            "--tolerance",
+            type=float,
+            default=0.1,
+            help="Largest allowed difference between shards, as a fraction of "
+            "the mean number of books per shard.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Books copied per transaction.",
+        )
+        parser.add_argument(
+            "--grace",
+            type=float,
+            help="Seconds to wait for every process to see an author marked as "
+            "moving, and again after switching them before clearing the old "
+            "shard; defaults to the directory cache lifetime plus one.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only print the planned moves.",
+        )
+
+    def handle(self, *args, **options):
+        shards = settings.BOOK_SHARD_DATABASES
+        if not shards:
+            raise CommandError("Book sharding is not enabled.")
+
+        if options["import_unsharded"] and not options["dry_run"]:
+            moved = import_unsharded_books(options["batch_size"])
+            self.stdout.write(f"Moved {moved} books out of the default database")
+
+        if options["author"]:
+            if options["to"] not in shards:
+                raise CommandError(f"--to must be one of: {', '.join(shards)}")
+            moves = [
+                (author_id, None, options["to"]) for author_id in options["author"]
+            ]
+        else:
+            moves = plan_rebalance(options["tolerance"])
+
+        for author_id, source, target in moves:
+            self.stdout.write(f"Author {author_id}: {source or '?'} -> {target}")
+            if not options["dry_run"]:
+                moved = move_author(
+                    author_id, target, options["batch_size"], options["grace"]
+                )
+                self.stdout.write(f"  moved {moved} books")
+
+        for alias, authors in author_book_counts().items():
+            self.stdout.write(
+                f"{alias}: {sum(authors.values())} books, {len(authors)} authors"
+            )
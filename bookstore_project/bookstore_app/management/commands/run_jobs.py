@@ -0,0 +1,138 @@
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+
+import django
+from bookstore_app.jobs import (
+    claim_jobs,
+    prune_finished_jobs,
+    record_job_error,
+    requeue_stale_jobs,
+    run_job,
+)
+from bookstore_app.token_denylist import denylist
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, close_old_connections, connections
+
+
+# Prepare a pool process; spawned (rather than forked) children need Django set up
+def init_worker():
+    django.setup()
+    connections.close_all()
+
+
+# Entry point for pool workers; each job gets a fresh database connection
+def execute_job(pk):
+    close_old_connections()
+    try:
+        return run_job(pk)
+    finally:
+        close_old_connections()
+
+
+class Command(BaseCommand):
+    help = "Run background jobs from the job queue using a thread or process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.JOB_QUEUE_WORKERS,
+            help="Number of jobs executed concurrently.",
+        )
+        parser.add_argument(
+            "--pool",
+            choices=["thread", "process"],
+            default=settings.JOB_QUEUE_POOL,
+            help="Execute jobs in worker threads or worker processes.",
+        )
+        parser.add_argument(
+            "--poll-interval",
+            type=float,
+            default=settings.JOB_QUEUE_POLL_INTERVAL,
+            help="Seconds to wait before polling again when no job is due.",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once no due jobs are left instead of polling forever.",
+        )
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        if options["pool"] == "process":
+            # Forked children must not share the parent's database connections
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.stdout.write(f"Running jobs with {workers} {options['pool']} worker(s)...")
+        succeeded = failed = 0
+        # Claimed job ids by their future
+        running = {}
+        maintained_at = None
+        try:
+            while True:
+                if (
+                    maintained_at is None
+                    or time.monotonic() - maintained_at
+                    >= settings.JOB_QUEUE_MAINTENANCE_INTERVAL
+                ):
+                    self.maintain()
+                    maintained_at = time.monotonic()
+                requeue_stale_jobs()
+                for pk in claim_jobs(workers - len(running)):
+                    running[executor.submit(execute_job, pk)] = pk
+
+                if not running:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+                    continue
+
+                done, _ = wait(
+                    running,
+                    timeout=options["poll_interval"],
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in done:
+                    if self.finished(running.pop(future), future):
+                        succeeded += 1
+                    else:
+                        failed += 1
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping, waiting for running jobs to finish...")
+        finally:
+            executor.shutdown(wait=True)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Jobs succeeded: {succeeded}, failed: {failed}")
+        )
+
+    # Whether a job ran successfully. Errors raised around the job itself,
+    # such as a locked database, count as failed attempts; jobs that cannot
+    # even be updated are requeued once their lock times out.
+    def finished(self, pk, future):
+        try:
+            return future.result()
+        except Exception as exc:
+            self.stderr.write(f"Job {pk} could not be run: {exc!r}")
+            try:
+                record_job_error(pk, exc)
+            except DatabaseError:
+                pass
+            return False
+
+    def maintain(self):
+        pruned = prune_finished_jobs()
+        if pruned:
+            self.stdout.write(f"Deleted {pruned} finished jobs")
+        purged = denylist.purge_expired()
+        if purged:
+            self.stdout.write(f"Deleted {purged} expired revoked tokens")
@@ -0,0 +1,354 @@
+import gc
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from bookstore_app.popularity import view_counter
+from bookstore_app.warmup import build_indexes, warm_up
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import (
+    WSGIRequestHandler,
+    WSGIServer,
+    get_internal_wsgi_application,
+)
+from django.db import connections
+
+# Set for a master started by a graceful reload: the inherited listening
+# socket, and the workers of the previous master that still serve on it
+LISTEN_FD_ENV = "BOOKSTORE_SERVE_FD"
+OLD_WORKERS_ENV = "BOOKSTORE_SERVE_OLD_WORKERS"
+
+
+# Resident and private (not shared copy-on-write with the master) memory of a
+# process in bytes, or None where /proc is not available
+def memory_usage(pid):
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as smaps:
+            for line in smaps:
+                name, _, value = line.partition(":")
+                parts = value.split()
+                if len(parts) == 2 and parts[1] == "kB":
+                    fields[name] = int(parts[0]) * 1024
+    except OSError:
+        return None
+    return {
+        "rss": fields.get("Rss", 0),
+        "private": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+    }
+
+
+def format_memory(usage):
+    if usage is None:
+        return "memory n/a"
+    return (
+        f"rss {usage['rss'] / 2**20:.1f} MiB, "
+        f"private {usage['private'] / 2**20:.1f} MiB"
+    )
+
+
+class RequestHandler(WSGIRequestHandler):
+    # Set per worker; bounds the time a slow client can hold the worker
+    timeout = None
+
+
+# Serves requests from the shared listening socket, one at a time, until it
+# has served `max_requests` or is asked to stop
+class Worker:
+    def __init__(self, app, sock, max_requests, request_timeout):
+        self.app = app
+        self.sock = sock
+        self.max_requests = max_requests
+        self.request_timeout = request_timeout
+        self.stopping = False
+        self.served = 0
+
+    # Entry point in the forked process
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        # The master handles these for the whole process group
+        for signum in (signal.SIGINT, signal.SIGHUP, signal.SIGUSR1):
+            signal.signal(signum, signal.SIG_IGN)
+        random.seed()
+        try:
+            self.serve()
+        finally:
+            # Buffered book views would otherwise be lost with the process
+            view_counter.flush()
+            connections.close_all()
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def serve(self):
+        RequestHandler.timeout = self.request_timeout
+        server = WSGIServer(
+            self.sock.getsockname()[:2], RequestHandler, bind_and_activate=False
+        )
+        server.socket.close()
+        server.socket = self.sock
+        server.server_name = socket.getfqdn(server.server_address[0])
+        server.server_port = server.server_address[1]
+        server.setup_environ()
+        server.set_app(self.app)
+
+        while not self.stopping and self.served < self.max_requests:
+            ready, _, _ = select.select([self.sock], [], [], 1.0)
+            if not ready:
+                continue
+            try:
+                request, client_address = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                # Another worker accepted the connection first
+                continue
+            self.served += 1
+            try:
+                server.process_request(request, client_address)
+            except Exception:
+                server.handle_error(request, client_address)
+                server.shutdown_request(request)
+
+
+class Command(BaseCommand):
+    help = (
+        "Serve the site with a preforking server. The master process loads the "
+        "app, URL routes, serializers and in-memory indexes once, then forks "
+        "workers that share them copy-on-write. Workers are replaced after a "
+        "number of requests. SIGHUP reloads the code without closing the "
+        "listening socket, SIGTERM or SIGINT stop gracefully and SIGUSR1 "
+        "reports the workers and their memory."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--bind",
+            default="127.0.0.1:8000",
+            help="Address to listen on, as host:port.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.SERVE_WORKERS,
+            help="Number of worker processes.",
+        )
+        parser.add_argument(
+            "--max-requests",
+            type=int,
+            default=settings.SERVE_MAX_REQUESTS,
+            help="Requests a worker serves before it is replaced.",
+        )
+        parser.add_argument(
+            "--max-requests-jitter",
+            type=int,
+            default=settings.SERVE_MAX_REQUESTS_JITTER,
+            help="Random extra requests added to --max-requests per worker.",
+        )
+        parser.add_argument(
+            "--graceful-timeout",
+            type=float,
+            default=settings.SERVE_GRACEFUL_TIMEOUT,
+            help="Seconds a stopping worker may take before it is killed.",
+        )
+        parser.add_argument(
+            "--stats-interval",
+            type=float,
+            default=settings.SERVE_STATS_INTERVAL,
+            help="Seconds between worker memory reports; 0 disables them.",
+        )
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1.")
+        self.options = options
+        self.workers = {}
+        # Workers asked to stop, with the time they are killed at
+        self.retiring = {}
+        self.pending_signals = []
+        self.stopping = False
+
+        self.sock = self.listen(options["bind"])
+        self.app = self.preload()
+        for signum in (
+            signal.SIGTERM,
+            signal.SIGINT,
+            signal.SIGHUP,
+            signal.SIGUSR1,
+        ):
+            signal.signal(signum, self.queue_signal)
+
+        host, port = self.sock.getsockname()[:2]
+        self.stdout.write(
+            f"Master {os.getpid()} listening on http://{host}:{port}/ "
+            f"with {options['workers']} workers"
+        )
+        self.spawn_workers()
+        # After a reload, the previous master's workers stop once the new
+        # ones are accepting connections
+        old_workers = os.environ.pop(OLD_WORKERS_ENV, "")
+        for pid in filter(None, old_workers.split(",")):
+            self.retire(int(pid))
+
+        self.reported_at = time.monotonic()
+        while self.workers or self.retiring or not self.stopping:
+            self.reap_workers()
+            while self.pending_signals:
+                self.handle_signal(self.pending_signals.pop(0))
+            if not self.stopping:
+                self.spawn_workers()
+            self.kill_overdue()
+            interval = options["stats_interval"]
+            if interval and time.monotonic() - self.reported_at >= interval:
+                self.report()
+            time.sleep(0.2)
+        self.sock.close()
+        self.stdout.write(f"Master {os.getpid()} stopped")
+
+    # Listen on `bind`, or reuse the socket handed over by a reload
+    def listen(self, bind):
+        fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if fd is not None:
+            sock = socket.socket(fileno=int(fd))
+        else:
+            host, _, port = bind.rpartition(":")
+            try:
+                address = (host.strip("[]") or "127.0.0.1", int(port))
+            except ValueError:
+                raise CommandError(f"--bind must be host:port, not {bind!r}.")
+            family = socket.AF_INET6 if ":" in address[0] else socket.AF_INET
+            sock = socket.create_server(address, family=family, backlog=2048)
+        # Every worker waits on the socket; only one accepts each connection
+        sock.setblocking(False)
+        return sock
+
+    # Load everything workers share before forking them
+    def preload(self):
+        start = time.perf_counter()
+        app = get_internal_wsgi_application()
+        # Already done by the app registry when WARM_UP_ON_READY is set
+        if not settings.WARM_UP_ON_READY:
+            warm_up()
+        build_indexes()
+        # Workers open their own database connections
+        connections.close_all()
+        # Objects loaded so far are shared with every worker. Freezing them
+        # keeps the garbage collector from writing to, and so copying, their
+        # memory pages in the workers.
+        gc.collect()
+        gc.freeze()
+        usage = format_memory(memory_usage(os.getpid()))
+        self.stdout.write(
+            f"Preloaded the app in {(time.perf_counter() - start) * 1000:.0f} ms "
+            f"({usage})"
+        )
+        return app
+
+    def spawn_workers(self):
+        while len(self.workers) < self.options["workers"]:
+            max_requests = self.options["max_requests"] + random.randint(
+                0, max(self.options["max_requests_jitter"], 0)
+            )
+            pid = os.fork()
+            if pid == 0:
+                self.run_worker(max_requests)
+            self.workers[pid] = time.monotonic()
+
+    # Runs in the forked process and never returns into the master's code
+    def run_worker(self, max_requests):
+        status = 1
+        try:
+            worker = Worker(
+                self.app, self.sock, max_requests, settings.SERVE_REQUEST_TIMEOUT
+            )
+            worker.run()
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def queue_signal(self, signum, frame):
+        self.pending_signals.append(signum)
+
+    def handle_signal(self, signum):
+        if signum in (signal.SIGTERM, signal.SIGINT):
+            if not self.stopping:
+                self.stdout.write("Stopping gracefully...")
+                self.stopping = True
+                for pid in list(self.workers):
+                    self.retire(pid)
+        elif signum == signal.SIGHUP and not self.stopping:
+            self.reload()
+        elif signum == signal.SIGUSR1:
+            self.report()
+
+    # Ask a worker to finish its current request and exit
+    def retire(self, pid):
+        self.workers.pop(pid, None)
+        self.retiring[pid] = time.monotonic() + self.options["graceful_timeout"]
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            self.retiring.pop(pid)
+
+    def kill_overdue(self):
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now >= deadline:
+                self.stderr.write(f"Worker {pid} did not stop in time, killing it")
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.retiring[pid] = float("inf")
+
+    def reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            started_at = self.workers.pop(pid, None)
+            self.retiring.pop(pid, None)
+            code = os.waitstatus_to_exitcode(status)
+            if started_at is not None and code != 0:
+                self.stderr.write(f"Worker {pid} exited with status {code}")
+            elif started_at is not None:
+                self.stdout.write(f"Worker {pid} reached its request limit")
+
+    # Replace this process with a fresh master running the current code. The
+    # listening socket stays open and the old workers keep serving until the
+    # new master has started its own, so no connection is refused.
+    def reload(self):
+        self.stdout.write("Reloading...")
+        fd = self.sock.fileno()
+        os.set_inheritable(fd, True)
+        env = {
+            **os.environ,
+            LISTEN_FD_ENV: str(fd),
+            OLD_WORKERS_ENV: ",".join(map(str, [*self.workers, *self.retiring])),
+        }
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execve(sys.executable, [sys.executable, *sys.orig_argv[1:]], env)
+
+    def report(self):
+        self.reported_at = time.monotonic()
+        master = format_memory(memory_usage(os.getpid()))
+        self.stdout.write(
+            f"{len(self.workers)} workers, {len(self.retiring)} stopping; "
+            f"master {os.getpid()}: {master}"
+        )
+        now = time.monotonic()
+        for pid, started_at in sorted(self.workers.items()):
+            usage = format_memory(memory_usage(pid))
+            self.stdout.write(f"  worker {pid}: {usage}, up {now - started_at:.0f}s")
@@ -0,0 +1,55 @@
+import random
+import string
+import time
+
+from bookstore_app.title_index import TitleIndex
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the title suggestion index and report its size, memory use per "
+        "100k titles and lookup time."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--synthetic",
+            type=int,
+            help="Index this many generated titles instead of the Book table.",
+        )
+
+    def handle(self, *args, **options):
+        index = TitleIndex()
+        start = time.perf_counter()
+        if options["synthetic"]:
+            index.load(self.synthetic_titles(options["synthetic"]))
+        else:
+            index.build()
+        build_seconds = time.perf_counter() - start
+
+        titles = len(index)
+        memory = index.memory_usage()
+        self.stdout.write(f"Titles: {titles}")
+        self.stdout.write(f"Build time: {build_seconds:.2f}s")
+        self.stdout.write(f"Memory: {memory / 2**20:.1f} MiB")
+        if titles:
+            per_100k = memory / titles * 100_000
+            self.stdout.write(f"Memory per 100k titles: {per_100k / 2**20:.1f} MiB")
+
+        prefixes = ["a", "the", "wo", "adventures of", "zzz"]
+        lookups = 10_000
+        start = time.perf_counter()
+        for i in range(lookups):
+            index.suggest(prefixes[i % len(prefixes)], 10)
+        per_lookup = (time.perf_counter() - start) / lookups
+        self.stdout.write(f"Lookup time (top 10): {per_lookup * 1e6:.1f} us")
+
+    def synthetic_titles(self, count):
+        words = [
+            "".join(random.choices(string.ascii_lowercase, k=random.randint(3, 9)))
+            for _ in range(5_000)
+        ]
+        for book_id in range(1, count + 1):
+            title = " ".join(random.choices(words, k=random.randint(2, 6)))
+            yield book_id, title.title()
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookstore_app", "0007_job"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="is_published",
+            field=models.BooleanField(default=True, verbose_name="Is Published"),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="unpublished_at",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Unpublished At"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["author"],
+                name="book_published_author_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["title"],
+                name="book_published_title_idx",
+            ),
+        ),
+    ]
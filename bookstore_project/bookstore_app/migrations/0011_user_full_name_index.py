@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:53
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth", "0012_alter_user_first_name_max_length"),
+        ("bookstore_app", "0010_lower_case_search_indexes"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="customuser",
+            index=models.Index(
+                django.db.models.functions.text.Lower("first_name"),
+                django.db.models.functions.text.Lower("last_name"),
+                name="user_full_name_lower_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookstore_app", "0011_user_full_name_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SimilarBook",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "similar_title",
+                    models.CharField(max_length=255, verbose_name="Similar Title"),
+                ),
+                ("score", models.FloatField(verbose_name="Score")),
+                ("rank", models.PositiveSmallIntegerField(verbose_name="Rank")),
+                (
+                    "book",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="similar_books",
+                        to="bookstore_app.book",
+                        verbose_name="Book",
+                    ),
+                ),
+                (
+                    "similar",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="bookstore_app.book",
+                        verbose_name="Similar Book",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("book", "rank"), name="similar_book_book_rank_unique"
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookstore_app", "0012_similarbook"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="trending_score",
+            field=models.FloatField(default=0, verbose_name="Trending Score"),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="view_count",
+            field=models.PositiveBigIntegerField(default=0, verbose_name="Views"),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                condition=models.Q(("is_published", True)),
+                fields=["-trending_score"],
+                name="book_published_trending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,106 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:06
+
+import bookstore_app.models
+import django.db.models.deletion
+import django.db.models.manager
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookstore_app", "0013_book_popularity"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IdSequence",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "name",
+                    models.CharField(max_length=100, unique=True, verbose_name="Name"),
+                ),
+                (
+                    "next_value",
+                    models.PositiveBigIntegerField(verbose_name="Next Value"),
+                ),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name="book",
+            options={"base_manager_name": "all_objects"},
+        ),
+        migrations.AlterModelManagers(
+            name="book",
+            managers=[
+                ("objects", django.db.models.manager.Manager()),
+                ("all_objects", django.db.models.manager.Manager()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="book",
+            name="author",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=bookstore_app.models.CROSS_DATABASE_CASCADE,
+                to=settings.AUTH_USER_MODEL,
+                verbose_name="Author",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="similarbook",
+            name="book",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=bookstore_app.models.CROSS_DATABASE_CASCADE,
+                related_name="similar_books",
+                to="bookstore_app.book",
+                verbose_name="Book",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="similarbook",
+            name="similar",
+            field=models.ForeignKey(
+                db_constraint=False,
+                on_delete=bookstore_app.models.CROSS_DATABASE_CASCADE,
+                related_name="+",
+                to="bookstore_app.book",
+                verbose_name="Similar Book",
+            ),
+        ),
+        migrations.CreateModel(
+            name="AuthorShard",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("shard", models.CharField(max_length=100, verbose_name="Shard")),
+                (
+                    "author",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to=settings.AUTH_USER_MODEL,
+                        verbose_name="Author",
+                    ),
+                ),
+            ],
+        ),
+    ]
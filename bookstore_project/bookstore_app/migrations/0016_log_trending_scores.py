@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:40
+
+from django.db import migrations
+from django.db.models import F, Value
+from django.db.models.functions import Log, Power
+
+
+# Trending scores move from the summed view weights to their base 2 logarithm
+def to_log_scores(apps, schema_editor):
+    Book = apps.get_model("bookstore_app", "Book")
+    Book.objects.using(schema_editor.connection.alias).filter(
+        trending_score__gt=0
+    ).update(trending_score=Log(Value(2.0), F("trending_score")))
+
+
+def to_linear_scores(apps, schema_editor):
+    Book = apps.get_model("bookstore_app", "Book")
+    Book.objects.using(schema_editor.connection.alias).filter(
+        trending_score__gt=0
+    ).update(trending_score=Power(Value(2.0), F("trending_score")))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookstore_app", "0015_price_rules"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            to_log_scores, to_linear_scores, hints={"model_name": "book"}
+        ),
+    ]
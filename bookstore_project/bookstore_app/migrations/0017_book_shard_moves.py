@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("bookstore_app", "0016_log_trending_scores"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="authorshard",
+            name="moving_from",
+            field=models.CharField(
+                blank=True, max_length=100, verbose_name="Moving From"
+            ),
+        ),
+    ]
@@ -1,8 +1,15 @@
+from decimal import ROUND_HALF_UP, Decimal
+
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, router
+from django.db.models.functions import Greatest, Lower, Round
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from .sharding import ShardedQuerySet, prepare_book_save
+
 
 class CustomUser(AbstractUser):
     # Add a new field to the CustomUser model to store the author's pseudonym
@@ -15,20 +22,339 @@ class CustomUser(AbstractUser):
         help_text=_("Enter author pseudonym (max 100 characters)."),
     )
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive prefix searches compare against lower-cased values
+            models.Index(Lower("username"), name="user_username_lower_idx"),
+            models.Index(Lower("email"), name="user_email_lower_idx"),
+            models.Index(Lower("last_name"), name="user_last_name_lower_idx"),
+            # Serves first name prefixes and "first last" full name lookups
+            models.Index(
+                Lower("first_name"), Lower("last_name"), name="user_full_name_lower_idx"
+            ),
+            models.Index(Lower("author_pseudonym"), name="user_pseudonym_lower_idx"),
+        ]
+
     def __str__(self):
         return self.username
 
 
+# CASCADE for relations that may cross databases: once books are sharded, a
+# user and their books, or a book and its similar book rows, live in different
+# databases. Related rows are then deleted through their own database instead
+# of the deleted object's.
+def CROSS_DATABASE_CASCADE(collector, field, sub_objs, using):
+    if not settings.BOOK_SHARD_DATABASES:
+        return models.CASCADE(collector, field, sub_objs, using)
+    sub_objs.using(router.db_for_write(sub_objs.model)).delete()
+
+
+CROSS_DATABASE_CASCADE.lazy_sub_objs = True
+
+
+BookManager = models.Manager.from_queryset(ShardedQuerySet)
+
+
+# Manager that hides unpublished books
+class PublishedBookManager(BookManager):
+    def get_queryset(self):
+        return super().get_queryset().filter(is_published=True)
+
+
 class Book(models.Model):
     title = models.CharField(max_length=255, verbose_name=_("Title"))
     description = models.TextField(verbose_name=_("Description"))
+    # Sharded books are stored apart from their author, so the database
+    # cannot enforce the relation
     author = models.ForeignKey(
-        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name=_("Author")
+        settings.AUTH_USER_MODEL,
+        on_delete=CROSS_DATABASE_CASCADE,
+        db_constraint=False,
+        verbose_name=_("Author"),
     )
     cover_image = models.ImageField(
         upload_to="book_covers/", blank=True, null=True, verbose_name=_("Cover Image")
     )
     price = models.DecimalField(max_digits=6, decimal_places=2, verbose_name=_("Price"))
+    # Unpublished books are kept but hidden from the default manager
+    is_published = models.BooleanField(default=True, verbose_name=_("Is Published"))
+    unpublished_at = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("Unpublished At")
+    )
+    # Updated in batches from buffered per-process view counts
+    view_count = models.PositiveBigIntegerField(default=0, verbose_name=_("Views"))
+    trending_score = models.FloatField(default=0, verbose_name=_("Trending Score"))
+
+    objects = PublishedBookManager()
+    all_objects = BookManager()
+
+    class Meta:
+        # Related lookups such as similar_book.book also span every shard
+        base_manager_name = "all_objects"
+        indexes = [
+            # Partial indexes only cover published rows
+            models.Index(
+                fields=["author"],
+                condition=models.Q(is_published=True),
+                name="book_published_author_idx",
+            ),
+            models.Index(
+                fields=["title"],
+                condition=models.Q(is_published=True),
+                name="book_published_title_idx",
+            ),
+            # Serves ?ordering=trending
+            models.Index(
+                fields=["-trending_score"],
+                condition=models.Q(is_published=True),
+                name="book_published_trending_idx",
+            ),
+            # Admin prefix search covers unpublished books as well
+            models.Index(Lower("title"), name="book_title_lower_idx"),
+        ]
 
     def __str__(self):
         return self.title
+
+    def save(self, *args, **kwargs):
+        if settings.BOOK_SHARD_DATABASES:
+            kwargs = prepare_book_save(self, kwargs)
+        super().save(*args, **kwargs)
+
+    def unpublish(self):
+        self.is_published = False
+        self.unpublished_at = timezone.now()
+        self.save(update_fields=["is_published", "unpublished_at"])
+
+
+class SimilarBook(models.Model):
+    # Precomputed neighbour of `book`, ranked by description similarity
+    book = models.ForeignKey(
+        Book,
+        on_delete=CROSS_DATABASE_CASCADE,
+        db_constraint=False,
+        related_name="similar_books",
+        verbose_name=_("Book"),
+    )
+    similar = models.ForeignKey(
+        Book,
+        on_delete=CROSS_DATABASE_CASCADE,
+        db_constraint=False,
+        related_name="+",
+        verbose_name=_("Similar Book"),
+    )
+    # Copied from the similar book so lookups do not need a join
+    similar_title = models.CharField(max_length=255, verbose_name=_("Similar Title"))
+    score = models.FloatField(verbose_name=_("Score"))
+    rank = models.PositiveSmallIntegerField(verbose_name=_("Rank"))
+
+    class Meta:
+        constraints = [
+            # Also the index behind the ranked lookup for a book
+            models.UniqueConstraint(
+                fields=["book", "rank"], name="similar_book_book_rank_unique"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id} -> {self.similar_id} ({self.score:.3f})"
+
+
+# Discount on the books of an author, the books whose title contains a
+# phrase, an explicit set of books, or any combination of these; a rule
+# without a scope applies to every book. Active rules lower the effective
+# price shown to readers; applying a rule writes its discount into the stored
+# prices instead.
+class PriceRule(models.Model):
+    PERCENT = "percent"
+    FIXED = "fixed"
+    KIND_CHOICES = [
+        (PERCENT, _("Percentage off")),
+        (FIXED, _("Fixed amount off")),
+    ]
+
+    name = models.CharField(max_length=255, verbose_name=_("Name"))
+    kind = models.CharField(
+        max_length=20, choices=KIND_CHOICES, default=PERCENT, verbose_name=_("Kind")
+    )
+    amount = models.DecimalField(
+        max_digits=6, decimal_places=2, verbose_name=_("Amount")
+    )
+    author = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="+",
+        verbose_name=_("Author"),
+    )
+    title_contains = models.CharField(
+        max_length=255, blank=True, verbose_name=_("Title Contains")
+    )
+    # Books may be stored in other databases, so they are listed by id
+    book_ids = models.JSONField(default=list, blank=True, verbose_name=_("Book IDs"))
+    # Open-ended on either side when empty
+    starts_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Starts At"))
+    ends_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Ends At"))
+    # Set once the discount has been written into the stored prices
+    applied_at = models.DateTimeField(
+        null=True, blank=True, verbose_name=_("Applied At")
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated At"))
+
+    def __str__(self):
+        return self.name
+
+    def clean(self):
+        if self.kind == self.PERCENT and self.amount is not None and self.amount > 100:
+            raise ValidationError({"amount": _("A percentage cannot exceed 100.")})
+        if self.amount is not None and self.amount < 0:
+            raise ValidationError({"amount": _("The amount cannot be negative.")})
+        if self.starts_at and self.ends_at and self.starts_at >= self.ends_at:
+            raise ValidationError({"ends_at": _("The rule must end after it starts.")})
+        if not isinstance(self.book_ids, list) or not all(
+            isinstance(book_id, int) for book_id in self.book_ids
+        ):
+            raise ValidationError({"book_ids": _("Enter a list of book ids.")})
+
+    def is_active(self, now):
+        return (
+            self.applied_at is None
+            and (self.starts_at is None or self.starts_at <= now)
+            and (self.ends_at is None or now < self.ends_at)
+        )
+
+    # Whether the rule's scope covers `book`, a book or a record with its
+    # primary key, author_id and title. Matches the books of book_filter().
+    def matches(self, book):
+        return (
+            (self.author_id is None or book.author_id == self.author_id)
+            and (
+                not self.title_contains
+                or self.title_contains.casefold() in book.title.casefold()
+            )
+            and (not self.book_ids or book.pk in self.book_ids)
+        )
+
+    # Condition selecting the books the rule applies to
+    def book_filter(self):
+        condition = models.Q()
+        if self.author_id is not None:
+            condition &= models.Q(author_id=self.author_id)
+        if self.title_contains:
+            condition &= models.Q(title__icontains=self.title_contains)
+        if self.book_ids:
+            condition &= models.Q(pk__in=self.book_ids)
+        return condition
+
+    # Discounted `price`, rounded to cents and never below zero
+    def apply_to(self, price):
+        price = price if isinstance(price, Decimal) else Decimal(str(price))
+        if self.kind == self.PERCENT:
+            price = price * (100 - self.amount) / 100
+        else:
+            price = price - self.amount
+        return max(price, Decimal(0)).quantize(Decimal("0.01"), ROUND_HALF_UP)
+
+    # The same discount as a database expression over the price column. The
+    # percentage is passed as a decimal factor, as SQLite stores whole prices
+    # as integers and would otherwise divide them as integers.
+    def price_expression(self):
+        output_field = models.DecimalField(max_digits=6, decimal_places=2)
+        if self.kind == self.PERCENT:
+            factor = models.Value(
+                (100 - self.amount) / Decimal(100),
+                output_field=models.DecimalField(max_digits=9, decimal_places=6),
+            )
+            price = models.F("price") * factor
+        else:
+            price = models.F("price") - self.amount
+        price = Round(models.ExpressionWrapper(price, output_field), 2)
+        return Greatest(price, models.Value(0), output_field=output_field)
+
+
+# Shard holding the books of an author when books are sharded
+class AuthorShard(models.Model):
+    author = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="+",
+        verbose_name=_("Author"),
+    )
+    shard = models.CharField(max_length=100, verbose_name=_("Shard"))
+    # Shard still holding the author's books while they are moved
+    moving_from = models.CharField(
+        max_length=100, blank=True, verbose_name=_("Moving From")
+    )
+
+    def __str__(self):
+        return f"{self.author_id} -> {self.shard}"
+
+
+# Next free id of a table whose rows are spread over several databases
+class IdSequence(models.Model):
+    name = models.CharField(max_length=100, unique=True, verbose_name=_("Name"))
+    next_value = models.PositiveBigIntegerField(verbose_name=_("Next Value"))
+
+    def __str__(self):
+        return f"{self.name}: {self.next_value}"
+
+
+class Job(models.Model):
+    # Lifecycle states of a queued job
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, _("Pending")),
+        (RUNNING, _("Running")),
+        (SUCCEEDED, _("Succeeded")),
+        (FAILED, _("Failed")),
+    ]
+
+    name = models.CharField(max_length=100, verbose_name=_("Name"))
+    payload = models.JSONField(default=dict, blank=True, verbose_name=_("Payload"))
+    # Enqueueing the same key twice results in a single job
+    idempotency_key = models.CharField(
+        max_length=255,
+        unique=True,
+        null=True,
+        blank=True,
+        verbose_name=_("Idempotency Key"),
+    )
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+        verbose_name=_("Status"),
+    )
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_("Attempts"))
+    max_attempts = models.PositiveIntegerField(
+        default=5, verbose_name=_("Max Attempts")
+    )
+    run_after = models.DateTimeField(default=timezone.now, verbose_name=_("Run After"))
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name=_("Locked At"))
+    last_error = models.TextField(blank=True, verbose_name=_("Last Error"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Created At"))
+    updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Updated At"))
+
+    class Meta:
+        indexes = [
+            # Workers poll for due pending jobs in `run_after` order
+            models.Index(
+                fields=["status", "run_after"], name="job_status_run_after_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.status})"
+
+
+class RevokedToken(models.Model):
+    # JWT ID of a refresh token that may no longer be used
+    jti = models.CharField(max_length=255, unique=True, verbose_name=_("JWT ID"))
+    expires_at = models.DateTimeField(db_index=True, verbose_name=_("Expires At"))
+
+    def __str__(self):
+        return self.jti
@@ -0,0 +1,55 @@
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+from .sharding import is_book_model, shard_databases
+
+
+# Paginator that stops counting exactly past a threshold.
+# Large result sets report an estimate taken from the database statistics,
+# so changelists on huge tables do not run a full COUNT(*) per page.
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        threshold = settings.ADMIN_EXACT_COUNT_THRESHOLD
+        # Counts at most threshold + 1 rows
+        capped_count = self.object_list[: threshold + 1].count()
+        if capped_count <= threshold:
+            return capped_count
+        return max(capped_count, self.estimate_count())
+
+    def estimate_count(self):
+        queryset = self.object_list
+        # Books spread over shards are estimated on each shard
+        if shard_databases() and is_book_model(queryset.model) and queryset._db is None:
+            return sum(
+                self.estimate_database_count(queryset.using(alias))
+                for alias in shard_databases()
+            )
+        return self.estimate_database_count(queryset)
+
+    def estimate_database_count(self, queryset):
+        connection = connections[queryset.db]
+        table = queryset.model._meta.db_table
+
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+                return int(cursor.fetchone()[0][0]["Plan"]["Plan Rows"])
+
+            # Other databases can only estimate the size of the whole table
+            if queryset.query.where:
+                return 0
+            # sqlite_stat1 is created by ANALYZE; its first number is the row count
+            if (
+                connection.vendor == "sqlite"
+                and "sqlite_stat1" in connection.introspection.table_names(cursor)
+            ):
+                cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s", [table])
+                stats = cursor.fetchall()
+                if stats:
+                    return max(int(stat.split()[0]) for (stat,) in stats)
+        pk = queryset.model._meta.pk.attname
+        return queryset.order_by(f"-{pk}").values_list(pk, flat=True).first() or 0
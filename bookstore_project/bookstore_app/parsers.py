@@ -0,0 +1,26 @@
+import msgpack
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from .renderers import decimal_scales, from_fixed_point
+
+
+# Parser for MessagePack request bodies.
+# Integers sent for decimal serializer fields are read as fixed-point values,
+# mirroring MessagePackRenderer.
+class MessagePackParser(BaseParser):
+    media_type = "application/msgpack"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            data = msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError) as exc:
+            raise ParseError(f"MessagePack parse error - {exc}")
+
+        view = (parser_context or {}).get("view")
+        if isinstance(data, dict) and hasattr(view, "get_serializer_class"):
+            scales = decimal_scales(view.get_serializer_class())
+            for name, scale in scales.items():
+                if name in data:
+                    data[name] = from_fixed_point(data[name], scale)
+        return data
@@ -0,0 +1,145 @@
+import atexit
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db.models import Case, F, FloatField, PositiveBigIntegerField, Value, When
+from django.db.models.functions import Abs, Greatest, Log, Power
+from django.utils import timezone
+
+from .jobs import enqueue
+from .models import Book
+
+logger = logging.getLogger(__name__)
+
+# Books updated per UPDATE statement, keeping within SQLite's parameter limit
+FLUSH_CHUNK_SIZE = 100
+
+
+# Weight of `count` views happening at `when`, as a base 2 logarithm. Scores
+# use forward decay: newer views weigh exponentially more, doubling every
+# TRENDING_HALF_LIFE, so old scores never need rewriting and ordering by the
+# stored score ranks books by their time-decayed popularity. The weights
+# themselves would leave float range within years of TRENDING_EPOCH, so
+# trending_score holds the base 2 logarithm of their sum, which grows by one
+# per half-life.
+def log_view_weight(when, count):
+    elapsed = (when - settings.TRENDING_EPOCH) / settings.TRENDING_HALF_LIFE
+    return elapsed + math.log2(count)
+
+
+# log2(2 ** score + 2 ** weight) as a database expression, computed without
+# either power so it cannot overflow. Books without views have a score of 0,
+# which adds the negligible weight of one view at TRENDING_EPOCH.
+def add_log_weight(score, weight):
+    return Greatest(score, weight) + Log(
+        Value(2.0), Value(1.0) + Power(Value(2.0), -Abs(score - weight))
+    )
+
+
+# Add `counts` views made at `viewed_at` to the books' view counts and
+# trending scores, with one UPDATE per FLUSH_CHUNK_SIZE books. Written books
+# are removed from `counts`, so after a failure it holds the views not written.
+def write_views(counts, viewed_at):
+    book_ids = list(counts)
+    for start in range(0, len(book_ids), FLUSH_CHUNK_SIZE):
+        chunk = book_ids[start : start + FLUSH_CHUNK_SIZE]
+        weight = Case(
+            *[
+                When(pk=pk, then=Value(log_view_weight(viewed_at, counts[pk])))
+                for pk in chunk
+            ],
+            output_field=FloatField(),
+        )
+        Book.all_objects.filter(pk__in=chunk).update(
+            view_count=F("view_count")
+            + Case(
+                *[When(pk=pk, then=Value(counts[pk])) for pk in chunk],
+                default=Value(0),
+                output_field=PositiveBigIntegerField(),
+            ),
+            trending_score=add_log_weight(F("trending_score"), weight),
+        )
+        for pk in chunk:
+            del counts[pk]
+
+
+# Buffers book views in process memory and writes them to the database in
+# batched UPDATE ... CASE statements, instead of one UPDATE per request. Once
+# the buffer is due, the request that notices it queues a job for the write.
+class ViewCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+        self._last_flush = time.monotonic()
+        self._pid = os.getpid()
+
+    def record(self, book_id):
+        with self._lock:
+            # A forked worker must not flush views counted by its parent
+            if self._pid != os.getpid():
+                self._counts = Counter()
+                self._pid = os.getpid()
+            self._counts[book_id] += 1
+            due = (
+                len(self._counts) >= settings.BOOK_VIEW_FLUSH_THRESHOLD
+                or time.monotonic() - self._last_flush
+                >= settings.BOOK_VIEW_FLUSH_INTERVAL
+            )
+        if due:
+            self.flush_later()
+
+    def _take_counts(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+            self._last_flush = time.monotonic()
+        return counts
+
+    # Hand the buffered views to a background job, so the request that fills
+    # the buffer only inserts the job instead of running the UPDATEs
+    def flush_later(self):
+        counts = self._take_counts()
+        if not counts:
+            return
+        try:
+            enqueue(
+                "books.record_views",
+                {
+                    "counts": {str(pk): count for pk, count in counts.items()},
+                    "viewed_at": timezone.now().isoformat(),
+                },
+            )
+        except Exception:
+            logger.exception("Failed to queue book views, keeping them buffered")
+            with self._lock:
+                self._counts.update(counts)
+
+    # Write the buffered views now
+    def flush(self):
+        counts = self._take_counts()
+        book_count = len(counts)
+        if not counts:
+            return 0
+        try:
+            write_views(counts, timezone.now())
+        except Exception:
+            logger.exception("Failed to flush book views, keeping them buffered")
+            with self._lock:
+                self._counts.update(counts)
+            return 0
+        return book_count
+
+
+view_counter = ViewCounter()
+
+
+@atexit.register
+def _flush_on_exit():
+    try:
+        view_counter.flush()
+    except Exception:
+        logger.exception("Failed to flush book views on exit")
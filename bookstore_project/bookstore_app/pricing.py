@@ -0,0 +1,162 @@
+import logging
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .models import Book, PriceRule
+from .sharding import shard_databases
+
+logger = logging.getLogger(__name__)
+
+
+# Process-local index of the price rules in effect, keyed by the books or
+# author they are scoped to, so the effective price of a book takes a few
+# dictionary lookups and no query. The remaining conditions of a rule, such as
+# its title phrase, are checked against the book itself, so books created or
+# renamed in any process are priced correctly at once. The index is rebuilt
+# when a rule starts or ends, after rule changes in this process, and within
+# PRICE_RULE_SYNC_INTERVAL seconds of changes made by other processes.
+class PriceRuleIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._global_rules = ()
+        self._author_rules = {}
+        self._book_rules = {}
+        # Wall-clock time of the next rule start or end
+        self._valid_until = None
+        self._version = None
+        self._checked_at = None
+
+    @property
+    def is_built(self):
+        return self._checked_at is not None
+
+    def reset(self):
+        with self._lock:
+            self._global_rules = ()
+            self._author_rules = {}
+            self._book_rules = {}
+            self._valid_until = None
+            self._version = None
+            self._checked_at = None
+
+    # Rebuild on next use
+    def invalidate(self):
+        self._checked_at = None
+
+    # Changes to the stored rules, including deletions
+    def rules_version(self):
+        return tuple(
+            PriceRule.objects.filter(applied_at__isnull=True)
+            .aggregate(count=Count("id"), updated=Max("updated_at"))
+            .values()
+        )
+
+    def build(self):
+        version = self.rules_version()
+        now = timezone.now()
+        rules = list(
+            PriceRule.objects.filter(applied_at__isnull=True).exclude(ends_at__lte=now)
+        )
+        active = [rule for rule in rules if rule.is_active(now)]
+        global_rules = []
+        author_rules = {}
+        book_rules = {}
+        for rule in active:
+            if rule.book_ids:
+                for book_id in rule.book_ids:
+                    book_rules.setdefault(book_id, []).append(rule)
+            elif rule.author_id is not None:
+                author_rules.setdefault(rule.author_id, []).append(rule)
+            else:
+                global_rules.append(rule)
+
+        boundaries = [
+            boundary
+            for rule in rules
+            for boundary in (rule.starts_at, rule.ends_at)
+            if boundary is not None and boundary > now
+        ]
+        self._global_rules = tuple(global_rules)
+        self._author_rules = {key: tuple(value) for key, value in author_rules.items()}
+        self._book_rules = {key: tuple(value) for key, value in book_rules.items()}
+        self._valid_until = min(boundaries).timestamp() if boundaries else None
+        self._version = version
+        self._checked_at = time.monotonic()
+        logger.info("Built price rule index with %d active rules", len(active))
+
+    def ensure_current(self):
+        checked_at = self._checked_at
+        if (
+            checked_at is not None
+            and time.monotonic() - checked_at < settings.PRICE_RULE_SYNC_INTERVAL
+            and (self._valid_until is None or time.time() < self._valid_until)
+        ):
+            return
+        with self._lock:
+            if self._checked_at is not checked_at:
+                return
+            if (
+                checked_at is None
+                or (self._valid_until is not None and time.time() >= self._valid_until)
+                or self.rules_version() != self._version
+            ):
+                self.build()
+            else:
+                self._checked_at = time.monotonic()
+
+    # Active rules applying to a book
+    def rules_for(self, book):
+        self.ensure_current()
+        candidates = (
+            self._global_rules
+            + self._author_rules.get(book.author_id, ())
+            + self._book_rules.get(book.pk, ())
+        )
+        return tuple(rule for rule in candidates if rule.matches(book))
+
+    # Lowest price of a book under the rules in effect
+    def effective_price(self, book):
+        rules = self.rules_for(book)
+        if not rules:
+            return book.price
+        return min(rule.apply_to(book.price) for rule in rules)
+
+
+price_rules = PriceRuleIndex()
+
+
+# Write a rule's discount into the stored prices with one UPDATE per database
+# holding books. The rule then no longer counts towards effective prices. Only
+# rules in effect can be applied, so a scheduled or expired discount is never
+# written into the prices. The rule is claimed by setting `applied_at` only
+# while it is unset, in the same transactions as the price updates, so a rule
+# applied concurrently or twice discounts the prices once. Returns the number
+# of books updated, or None when the rule had already been applied.
+def apply_price_rule(rule):
+    now = timezone.now()
+    if not rule.is_active(now):
+        raise ValueError(f"Price rule {rule.pk} is not in effect.")
+    # The claim's database is entered first, so it commits last
+    aliases = [DEFAULT_DB_ALIAS]
+    aliases += [alias for alias in shard_databases() if alias != DEFAULT_DB_ALIAS]
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        claimed = PriceRule.objects.filter(pk=rule.pk, applied_at__isnull=True).update(
+            applied_at=now, updated_at=now
+        )
+        if claimed != 1:
+            logger.info("Price rule %s has already been applied", rule.pk)
+            return None
+        books = Book.all_objects.filter(rule.book_filter())
+        updated = books.update(price=rule.price_expression())
+        transaction.on_commit(price_rules.invalidate)
+    rule.applied_at = rule.updated_at = now
+    logger.info("Applied price rule %s to %d books", rule.pk, updated)
+    return updated
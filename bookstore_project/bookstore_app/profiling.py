@@ -0,0 +1,307 @@
+import contextvars
+import cProfile
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+
+from .permissions import IsAdmin
+
+logger = logging.getLogger(__name__)
+
+# Request header asking for a profile; "cprofile" selects the deterministic
+# profiler, any other value the sampling profiler
+PROFILE_HEADER = "HTTP_X_PROFILE"
+REPORT_HEADER = "X-Profile-Report"
+REPORT_ID_RE = re.compile(r"^[0-9A-Za-z-]+$")
+
+_active_profile = contextvars.ContextVar("active_profile", default=None)
+# Sampled traffic is profiled by at most PROFILE_MAX_CONCURRENT requests per
+# process at a time, which bounds its overhead
+_sampled_slots = None
+_sampled_slots_lock = threading.Lock()
+
+
+def _take_sampled_slot():
+    global _sampled_slots
+    with _sampled_slots_lock:
+        if _sampled_slots is None:
+            _sampled_slots = threading.BoundedSemaphore(settings.PROFILE_MAX_CONCURRENT)
+    return _sampled_slots.acquire(blocking=False)
+
+
+# Semicolon separated stack of a frame, outermost call first, as used by
+# flamegraph.pl and speedscope
+def folded_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", "?")
+        names.append(f"{module}:{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+# Samples the stack of one thread every `interval` seconds
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[folded_stack(frame)] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+# Profile of one request: SQL statements, named phase timings and either
+# sampled stacks or a cProfile run
+class RequestProfile:
+    def __init__(self, mode, explain):
+        self.mode = mode
+        self.explain = explain
+        self.queries = []
+        self.dropped_queries = 0
+        self.phases = Counter()
+        self.sampler = None
+        self.profiler = None
+
+    # Connection execute wrapper recording every statement
+    def record_query(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if len(self.queries) < settings.PROFILE_MAX_QUERIES:
+                self.queries.append(
+                    {
+                        "alias": context["connection"].alias,
+                        "sql": sql,
+                        "params": None if many else params,
+                        "ms": (time.perf_counter() - start) * 1000,
+                    }
+                )
+            else:
+                self.dropped_queries += 1
+
+    @contextmanager
+    def run(self):
+        token = _active_profile.set(self)
+        if self.mode == "cprofile":
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.sampler = StackSampler(
+                threading.get_ident(), settings.PROFILE_SAMPLE_INTERVAL
+            )
+            self.sampler.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(self.record_query))
+                yield
+        finally:
+            if self.profiler is not None:
+                self.profiler.disable()
+            if self.sampler is not None:
+                self.sampler.stop()
+            _active_profile.reset(token)
+
+    # Query plans of the slowest SELECT statements
+    def explain_queries(self):
+        selects = [
+            query
+            for query in self.queries
+            if query["params"] is not None
+            and query["sql"].lstrip().upper().startswith("SELECT")
+        ]
+        selects.sort(key=lambda query: query["ms"], reverse=True)
+        for query in selects[: settings.PROFILE_EXPLAIN_LIMIT]:
+            connection = connections[query["alias"]]
+            prefix = connection.ops.explain_query_prefix()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(f"{prefix} {query['sql']}", query["params"])
+                    query["plan"] = [
+                        " ".join(str(column) for column in row)
+                        for row in cursor.fetchall()
+                    ]
+            except Exception as exc:
+                query["plan"] = [f"EXPLAIN failed: {exc}"]
+
+    def report(self, request, response, total_ms):
+        if self.explain:
+            self.explain_queries()
+        stacks = self.sampler.stacks if self.sampler is not None else Counter()
+        return {
+            "method": request.method,
+            "path": request.get_full_path(),
+            "status": response.status_code,
+            "mode": self.mode,
+            "total_ms": round(total_ms, 3),
+            "phases_ms": {
+                name: round(seconds * 1000, 3) for name, seconds in self.phases.items()
+            },
+            "sql": {
+                "count": len(self.queries) + self.dropped_queries,
+                "total_ms": round(sum(query["ms"] for query in self.queries), 3),
+                "queries": [
+                    {**query, "params": repr(query["params"])} for query in self.queries
+                ],
+            },
+            "samples": sum(stacks.values()),
+            "folded_stacks": [
+                f"{stack} {count}" for stack, count in stacks.most_common()
+            ],
+        }
+
+
+# Time the enclosed block as a named phase of the active profile, if any
+@contextmanager
+def phase(name):
+    profile = _active_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.phases[name] += time.perf_counter() - start
+
+
+# Renderer wrapper adding rendering time to the active profile
+class TimedRenderer:
+    def __init__(self, renderer):
+        self._renderer = renderer
+
+    def __getattr__(self, name):
+        return getattr(self._renderer, name)
+
+    def render(self, *args, **kwargs):
+        with phase("render"):
+            return self._renderer.render(*args, **kwargs)
+
+
+# View mixin reporting rendering time to the active profile
+class ProfiledViewMixin:
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        renderer = getattr(response, "accepted_renderer", None)
+        if _active_profile.get() is not None and renderer is not None:
+            response.accepted_renderer = TimedRenderer(renderer)
+        return response
+
+
+# Staff status of the requesting user. The middleware runs before DRF
+# authenticates the request, so API users are authenticated from their JWT
+# here; session users come from AuthenticationMiddleware.
+def is_staff_request(request):
+    user = getattr(request, "user", None)
+    if user is None or not user.is_authenticated:
+        try:
+            result = JWTAuthentication().authenticate(request)
+        except (AuthenticationFailed, InvalidToken):
+            return False
+        user = result[0] if result else None
+    return bool(IsAdmin().has_permission(SimpleNamespace(user=user), None))
+
+
+def report_path(report_id, suffix=".json"):
+    return settings.PROFILE_REPORT_DIR / f"{report_id}{suffix}"
+
+
+def load_report(report_id):
+    if not REPORT_ID_RE.match(report_id):
+        return None
+    try:
+        with open(report_path(report_id)) as report_file:
+            return json.load(report_file)
+    except FileNotFoundError:
+        return None
+
+
+# Write a report as JSON, its stacks as a flamegraph-ready .folded file and a
+# cProfile run as a .prof file, then remove the oldest reports beyond
+# PROFILE_REPORT_KEEP
+def save_report(report, profiler=None):
+    report_dir = settings.PROFILE_REPORT_DIR
+    report_dir.mkdir(parents=True, exist_ok=True)
+    report_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    with open(report_path(report_id), "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    if report["folded_stacks"]:
+        with open(report_path(report_id, ".folded"), "w") as folded_file:
+            folded_file.write("\n".join(report["folded_stacks"]) + "\n")
+    if profiler is not None:
+        profiler.dump_stats(report_path(report_id, ".prof"))
+
+    reports = sorted(report_dir.glob("*.json"))
+    for old_report in reports[: max(len(reports) - settings.PROFILE_REPORT_KEEP, 0)]:
+        for suffix in (".json", ".folded", ".prof"):
+            old_report.with_suffix(suffix).unlink(missing_ok=True)
+    return report_id
+
+
+# Profiles requests of staff users sending the X-Profile header, and a
+# PROFILE_SAMPLE_RATE fraction of other requests. Staff requests get the
+# report id in the X-Profile-Report response header and EXPLAIN plans of their
+# slowest queries; sampled requests are only stored, without plans.
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        header = request.META.get(PROFILE_HEADER)
+        if header and is_staff_request(request):
+            mode = "cprofile" if header.lower() == "cprofile" else "sample"
+            return self.profile(request, RequestProfile(mode, explain=True), True)
+
+        rate = settings.PROFILE_SAMPLE_RATE
+        if rate and random.random() < rate and _take_sampled_slot():
+            try:
+                return self.profile(request, RequestProfile("sample", False), False)
+            finally:
+                _sampled_slots.release()
+        return self.get_response(request)
+
+    def profile(self, request, profile, expose):
+        start = time.perf_counter()
+        with profile.run():
+            response = self.get_response(request)
+            # Render inside the profile so rendering time is included
+            if hasattr(response, "render") and not response.is_rendered:
+                response.render()
+        total_ms = (time.perf_counter() - start) * 1000
+
+        try:
+            report_id = save_report(
+                profile.report(request, response, total_ms), profile.profiler
+            )
+        except Exception:
+            logger.exception("Failed to save the profile of %s", request.path)
+            return response
+        if expose:
+            response[REPORT_HEADER] = report_id
+        return response
@@ -0,0 +1,204 @@
+import itertools
+import operator
+from collections import namedtuple
+
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+from .sharding import stored_together
+
+# Serializer fields whose representation of a database value is the value
+# itself
+PASSTHROUGH_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.IntegerField,
+)
+
+
+# Tuple-backed record class with one attribute per name. Like model
+# instances, records expose their primary key as `pk`.
+def record_class(model, attributes):
+    base = namedtuple(f"{model.__name__}Record", attributes)
+    pk_index = attributes.index(model._meta.pk.attname)
+    return type(
+        base.__name__,
+        (base,),
+        {"__slots__": (), "pk": property(operator.itemgetter(pk_index))},
+    )
+
+
+# Read-only representation of a model serializer's instances built from
+# values_list() rows instead of model instances. Rows become compact records
+# holding only the columns the serializer reads, and related objects named in
+# the serializer's Meta.read_model_related are loaded once per object into
+# shared records. Plain column fields are converted by functions chosen when
+# the read model is created; other fields, such as method fields, go through
+# their serializer field with the record standing in for the instance.
+class ReadModel:
+    def __init__(self, serializer):
+        self.model = serializer.Meta.model
+        opts = self.model._meta
+        request = serializer.context.get("request")
+
+        self.columns = [opts.pk.attname]
+        field_columns = []
+        for field in serializer.fields.values():
+            if field.write_only:
+                continue
+            model_field = self.model_field(field)
+            if model_field is None:
+                field_columns.append((field, None))
+                continue
+            if model_field.attname not in self.columns:
+                self.columns.append(model_field.attname)
+            field_columns.append((field, model_field))
+
+        # (name, related model, attributes, record class) of each relation
+        self.related = []
+        for name, attributes in getattr(
+            serializer.Meta, "read_model_related", {}
+        ).items():
+            relation = opts.get_field(name)
+            if relation.attname not in self.columns:
+                self.columns.append(relation.attname)
+            related_model = relation.related_model
+            record = record_class(
+                related_model, [related_model._meta.pk.attname, *attributes]
+            )
+            self.related.append((name, related_model, list(attributes), record))
+
+        self.record = record_class(
+            self.model, [*self.columns, *(name for name, *_ in self.related)]
+        )
+        self.plan = [
+            (field.field_name, self.getter(field, model_field, request))
+            for field, model_field in field_columns
+        ]
+
+    # Model field behind a serializer field that reads a plain column
+    def model_field(self, field):
+        if isinstance(field, serializers.SerializerMethodField):
+            return None
+        if field.source == "*" or "." in field.source:
+            return None
+        try:
+            model_field = self.model._meta.get_field(field.source)
+        except FieldDoesNotExist:
+            return None
+        if not model_field.concrete or model_field.many_to_many:
+            return None
+        if model_field.is_relation and not isinstance(
+            field, serializers.PrimaryKeyRelatedField
+        ):
+            return None
+        return model_field
+
+    # Function reading the representation of `field` from a record
+    def getter(self, field, model_field, request):
+        if model_field is None:
+
+            def computed(record):
+                value = field.get_attribute(record)
+                return None if value is None else field.to_representation(value)
+
+            return computed
+
+        index = self.columns.index(model_field.attname)
+        if isinstance(field, serializers.FileField):
+            convert = self.file_converter(field, model_field, request)
+        elif isinstance(field, serializers.PrimaryKeyRelatedField):
+            if field.pk_field is None:
+                return operator.itemgetter(index)
+            convert = field.pk_field.to_representation
+        elif isinstance(field, PASSTHROUGH_FIELDS):
+            return operator.itemgetter(index)
+        else:
+            convert = field.to_representation
+
+        def converted(record):
+            value = record[index]
+            return None if value is None else convert(value)
+
+        return converted
+
+    # File columns hold the stored name; the representation is its URL
+    def file_converter(self, field, model_field, request):
+        storage = model_field.storage
+        use_url = getattr(field, "use_url", api_settings.UPLOADED_FILES_USE_URL)
+
+        def convert(name):
+            if not name:
+                return None
+            if not use_url:
+                return name
+            url = storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+
+        return convert
+
+    # Columns selected for `queryset`. Related columns are joined when stored
+    # in the same database, and ordering columns are selected so results from
+    # several book shards can be merged.
+    def select_columns(self, queryset):
+        columns = list(self.columns)
+        joined = []
+        for name, related_model, attributes, _ in self.related:
+            joined.append(stored_together(self.model, related_model))
+            if joined[-1]:
+                columns.extend(f"{name}__{attribute}" for attribute in attributes)
+        for ordering in queryset.query.order_by:
+            if isinstance(ordering, str):
+                name = ordering.lstrip("-")
+                if name not in columns and name not in ("?", "pk"):
+                    columns.append(name)
+        return columns, joined
+
+    # Records of every row of `queryset`
+    def records(self, queryset):
+        columns, joined = self.select_columns(queryset)
+        return self.build(queryset.values_list(*columns), joined)
+
+    # Lists of up to `chunk_size` records, read with a server-side cursor
+    def iter_records(self, queryset, chunk_size):
+        columns, joined = self.select_columns(queryset)
+        rows = queryset.values_list(*columns).iterator(chunk_size=chunk_size)
+        while chunk := list(itertools.islice(rows, chunk_size)):
+            yield self.build(chunk, joined)
+
+    def build(self, rows, joined):
+        rows = list(rows)
+        width = len(self.columns)
+        lookups = []
+        offset = width
+        for (name, related_model, attributes, record), is_joined in zip(
+            self.related, joined
+        ):
+            index = self.columns.index(self.model._meta.get_field(name).attname)
+            if is_joined:
+                stop = offset + len(attributes)
+                related = {}
+                for row in rows:
+                    key = row[index]
+                    if key is not None and key not in related:
+                        related[key] = record(key, *row[offset:stop])
+                offset = stop
+            else:
+                keys = {row[index] for row in rows} - {None}
+                values = related_model._base_manager.filter(pk__in=keys).values_list(
+                    "pk", *attributes
+                )
+                related = {row[0]: record(*row) for row in values}
+            lookups.append((index, related))
+
+        return [
+            self.record(
+                *row[:width], *(related.get(row[index]) for index, related in lookups)
+            )
+            for row in rows
+        ]
+
+    def to_representation(self, records):
+        plan = self.plan
+        return [{name: get(record) for name, get in plan} for record in records]
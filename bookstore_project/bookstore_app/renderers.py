@@ -0,0 +1,88 @@
+import datetime
+import decimal
+
+import msgpack
+from rest_framework import serializers
+from rest_framework.renderers import BaseRenderer
+
+# Decimal scales per serializer class, computed once per class
+_decimal_scales_cache = {}
+
+
+# Return {field name: decimal places} for the DecimalFields of a serializer
+# class or instance. Decimal values travel as integers in units of
+# 10 ** -decimal_places, so a price of "12.99" is sent as 1299.
+def decimal_scales(serializer):
+    if isinstance(serializer, serializers.ListSerializer):
+        serializer = serializer.child
+    serializer_class = serializer if isinstance(serializer, type) else type(serializer)
+    if serializer_class not in _decimal_scales_cache:
+        if serializer is serializer_class:
+            serializer = serializer_class()
+        _decimal_scales_cache[serializer_class] = {
+            name: field.decimal_places
+            for name, field in serializer.fields.items()
+            if isinstance(field, serializers.DecimalField)
+        }
+    return _decimal_scales_cache[serializer_class]
+
+
+def to_fixed_point(value, scale):
+    if value is None:
+        return None
+    # DRF renders decimals with exactly `decimal_places` digits after the point
+    if isinstance(value, str):
+        whole, _, fraction = value.partition(".")
+        if len(fraction) == scale:
+            return int(whole + fraction)
+    return int(decimal.Decimal(value).scaleb(scale).to_integral_value())
+
+
+def from_fixed_point(value, scale):
+    if not isinstance(value, int):
+        return value
+    return decimal.Decimal(value).scaleb(-scale)
+
+
+# Fallback for values msgpack cannot encode natively
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return str(value)
+
+
+# Renderer for the MessagePack binary format.
+# Rows produced by a serializer only have their decimal fields converted, the
+# rest of each row is passed to msgpack's C encoder untouched. Error responses
+# also carry the serializer, but hold messages rather than values, and are
+# sent as they are.
+class MessagePackRenderer(BaseRenderer):
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        response = (renderer_context or {}).get("response")
+        if response is not None and response.status_code >= 400:
+            serializer = None
+        else:
+            serializer = getattr(data, "serializer", None)
+        scales = decimal_scales(serializer) if serializer is not None else {}
+        if scales:
+            if isinstance(data, dict):
+                data = self._convert_row(data, scales)
+            else:
+                data = [self._convert_row(row, scales) for row in data]
+
+        return msgpack.packb(data, use_bin_type=True, default=_default)
+
+    def _convert_row(self, row, scales):
+        row = dict(row)
+        for name, scale in scales.items():
+            if isinstance(row.get(name), (str, decimal.Decimal, int, float)):
+                row[name] = to_fixed_point(row[name], scale)
+        return row
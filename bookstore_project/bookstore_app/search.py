@@ -0,0 +1,86 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Q
+from django.db.models.functions import Lower
+
+from .sharding import stored_together
+
+# Sorts after any character, so [term, term + PREFIX_END) covers every string
+# that starts with term
+PREFIX_END = "\U0010ffff"
+
+
+def prefix_annotation(field):
+    return f"{field}_folded"
+
+
+# Filter a queryset to rows where any of `fields` starts with `term`, ignoring
+# case. Each match is a range comparison on LOWER(field), which lets the
+# database use the expression indexes declared on the models instead of
+# scanning with LIKE '%term%'. Fields on related models ("author__username")
+# are matched in a subquery so every branch of the OR stays indexable, or
+# ahead of the query when the related model is stored in another database.
+def prefix_search(queryset, fields, term):
+    term = term.strip().lower()
+    if not term:
+        return queryset
+    condition = Q()
+    for field in fields:
+        relation, _, remote_field = field.partition("__")
+        if remote_field:
+            related_model = queryset.model._meta.get_field(relation).related_model
+            matches = prefix_search(
+                related_model._base_manager.all(), [remote_field], term
+            )
+            matches = matches.values("pk")
+            if not stored_together(queryset.model, related_model):
+                matches = [row["pk"] for row in matches]
+            condition |= Q(**{f"{relation}__in": matches})
+            continue
+        annotation = prefix_annotation(field)
+        queryset = queryset.annotate(**{annotation: Lower(field)})
+        condition |= Q(
+            **{f"{annotation}__gte": term, f"{annotation}__lt": term + PREFIX_END}
+        )
+    return queryset.filter(condition)
+
+
+def _first_matches(queryset, field, term, limit):
+    queryset = prefix_search(queryset, [field], term)
+    return queryset.order_by(prefix_annotation(field))[:limit]
+
+
+# Ranked author lookup for typeahead boxes. Username prefixes rank first,
+# followed by pseudonym, first name, last name and "first last" full name
+# matches. Every tier is a LIMITed range scan over an expression index, so the
+# cost does not grow with the number of users.
+def autocomplete_authors(term, limit):
+    term = " ".join(term.split()).lower()
+    if not term:
+        return []
+
+    users = (
+        get_user_model()
+        .objects.filter(is_active=True)
+        .only("id", "username", "first_name", "last_name", "author_pseudonym")
+    )
+    tiers = [
+        _first_matches(users, "username", term, limit),
+        _first_matches(users, "author_pseudonym", term, limit),
+    ]
+    first_name, _, last_name = term.partition(" ")
+    if last_name:
+        full_name_matches = users.annotate(
+            first_name_folded=Lower("first_name")
+        ).filter(first_name_folded=first_name)
+        tiers.append(_first_matches(full_name_matches, "last_name", last_name, limit))
+    else:
+        tiers.append(_first_matches(users, "first_name", term, limit))
+        tiers.append(_first_matches(users, "last_name", term, limit))
+
+    ranked = {}
+    for tier in tiers:
+        for user in tier:
+            ranked.setdefault(user.pk, user)
+            if len(ranked) == limit:
+                return list(ranked.values())
+    return list(ranked.values())
@@ -1,11 +1,30 @@
+from datetime import datetime, timezone
+
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.serializers import TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
 
-from .models import Book
+from .models import Book, PriceRule
+from .pricing import price_rules
+from .token_denylist import denylist
 
 User = get_user_model()
 
 
+# Name shown for an author: their pseudonym, else their full name, else their
+# username. Also used with the author records of the read-model list path.
+def displayed_name(author):
+    if author.author_pseudonym:
+        return author.author_pseudonym
+    full_name = f"{author.first_name} {author.last_name}".strip()
+    return full_name or author.username
+
+
 class UserSerializer(serializers.ModelSerializer):
     displayed_name = serializers.SerializerMethodField()
 
@@ -14,14 +33,24 @@ class UserSerializer(serializers.ModelSerializer):
         fields = ["id", "username", "displayed_name"]
 
     def get_displayed_name(self, obj):
-        if obj.author_pseudonym:
-            return obj.author_pseudonym
-        else:
-            return obj.get_full_name() or obj.username
+        return displayed_name(obj)
+
+
+# Price of a book after the price rules in effect, read from the in-memory
+# rule index without a query
+class EffectivePriceField(serializers.DecimalField):
+    def __init__(self, **kwargs):
+        kwargs.setdefault("source", "*")
+        kwargs.setdefault("read_only", True)
+        super().__init__(max_digits=6, decimal_places=2, **kwargs)
+
+    def to_representation(self, book):
+        return super().to_representation(price_rules.effective_price(book))
 
 
 class BookSerializer(serializers.ModelSerializer):
     author_displayed_name = serializers.SerializerMethodField()
+    effective_price = EffectivePriceField()
 
     class Meta:
         model = Book
@@ -32,12 +61,92 @@ class BookSerializer(serializers.ModelSerializer):
             "author",
             "cover_image",
             "price",
+            "effective_price",
             "author_displayed_name",
         ]
+        # Author columns loaded with each row by the read-model list path
+        read_model_related = {
+            "author": ["author_pseudonym", "first_name", "last_name", "username"]
+        }
 
     def get_author_displayed_name(self, obj):
-        author = obj.author
-        if author.author_pseudonym:
-            return author.author_pseudonym
-        else:
-            return author.get_full_name() or author.username
+        return displayed_name(obj.author)
+
+
+class PriceRuleSerializer(serializers.ModelSerializer):
+    book_ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), required=False
+    )
+
+    class Meta:
+        model = PriceRule
+        fields = [
+            "id",
+            "name",
+            "kind",
+            "amount",
+            "author",
+            "title_contains",
+            "book_ids",
+            "starts_at",
+            "ends_at",
+            "applied_at",
+        ]
+        read_only_fields = ["applied_at"]
+
+    # Run the model's own validation of the combined fields
+    def validate(self, attrs):
+        rule = PriceRule(**{**self.initial_rule_fields(), **attrs})
+        try:
+            rule.clean()
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(exc.message_dict)
+        return attrs
+
+    def initial_rule_fields(self):
+        if self.instance is None:
+            return {}
+        return {
+            field: getattr(self.instance, field)
+            for field in self.Meta.fields
+            if field not in ("id", "applied_at")
+        }
+
+
+# Refresh serializer that checks the token denylist and rotates refresh tokens
+class DenylistTokenRefreshSerializer(TokenRefreshSerializer):
+    # Not defined by every supported simplejwt release
+    default_error_messages = {
+        "no_active_account": _("No active account found for the given token.")
+    }
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        jti = refresh[api_settings.JTI_CLAIM]
+        if denylist.is_revoked(jti):
+            raise InvalidToken(_("Token is revoked"))
+
+        user_id = refresh.payload.get(api_settings.USER_ID_CLAIM)
+        if user_id:
+            user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+            if user is None or not api_settings.USER_AUTHENTICATION_RULE(user):
+                raise AuthenticationFailed(
+                    self.error_messages["no_active_account"], "no_active_account"
+                )
+
+        data = {"access": str(refresh.access_token)}
+
+        if api_settings.ROTATE_REFRESH_TOKENS:
+            # The presented token can only be used once: of several refreshes
+            # with it, replayed or concurrent, only the one that records its
+            # revocation gets new tokens
+            expires_at = datetime.fromtimestamp(refresh["exp"], tz=timezone.utc)
+            if not denylist.revoke(jti, expires_at):
+                raise InvalidToken(_("Token is revoked"))
+
+            refresh.set_jti()
+            refresh.set_exp()
+            refresh.set_iat()
+            data["refresh"] = str(refresh)
+
+        return data
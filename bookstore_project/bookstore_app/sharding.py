@@ -0,0 +1,689 @@
+import functools
+import heapq
+import itertools
+import logging
+import operator
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    IntegrityError,
+    NotSupportedError,
+    connections,
+    models,
+    router,
+    transaction,
+)
+from django.db.models.expressions import F, OrderBy
+from django.db.models.query import FlatValuesListIterable, ModelIterable, ValuesIterable
+
+logger = logging.getLogger(__name__)
+
+# Books can be stored on several databases ("shards"), each holding every book
+# of a set of authors. The placement of authors is kept in the AuthorShard
+# table on the default database, which also holds every other model. Queries
+# that are not bound to one author run on every shard in parallel and their
+# results are merged in the requested order. While an author is moved, their
+# books are stored on two shards and only read from the one they are placed on.
+
+
+def shard_databases():
+    return settings.BOOK_SHARD_DATABASES
+
+
+# Also called with the stand-in model of the database cache, whose options
+# only name its app and model
+def is_book_model(model):
+    opts = model._meta
+    return (opts.app_label, opts.model_name) == ("bookstore_app", "book")
+
+
+# Whether rows of both models are stored in the same database and can be
+# joined in one query
+def stored_together(model, other_model):
+    if shard_databases() and is_book_model(model) != is_book_model(other_model):
+        return False
+    return router.db_for_read(model) == router.db_for_read(other_model)
+
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+_pool_thread = threading.local()
+
+
+def _mark_pool_thread():
+    _pool_thread.active = True
+
+
+# The pool's threads do not survive a fork, so forked workers start their own
+def _get_executor():
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor_pid = os.getpid()
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BOOK_SHARD_QUERY_WORKERS,
+                thread_name_prefix="book-shard",
+                initializer=_mark_pool_thread,
+            )
+        return _executor
+
+
+def _run_on_shard(func, alias):
+    try:
+        return func(alias)
+    finally:
+        connections[alias].close_if_unusable_or_obsolete()
+
+
+# Call `func(alias)` for every shard and return the results in shard order.
+# Shards are queried in parallel, except inside a transaction on a shard,
+# whose uncommitted rows only this thread's connection can see.
+def scatter(func):
+    shards = shard_databases()
+    if (
+        len(shards) == 1
+        or getattr(_pool_thread, "active", False)
+        or any(connections[alias].in_atomic_block for alias in shards)
+    ):
+        return [func(alias) for alias in shards]
+    executor = _get_executor()
+    return list(executor.map(functools.partial(_run_on_shard, func), shards))
+
+
+# Sort key comparing rows by several (getter, descending) pairs. NULLs sort
+# first in ascending order, as they do in SQLite.
+def merge_key(getters):
+    def compare(left, right):
+        for getter, descending in getters:
+            left_value, right_value = getter(left), getter(right)
+            if left_value == right_value:
+                continue
+            if left_value is None:
+                result = -1
+            elif right_value is None:
+                result = 1
+            else:
+                result = -1 if left_value < right_value else 1
+            return -result if descending else result
+        return 0
+
+    return functools.cmp_to_key(compare)
+
+
+# QuerySet that spans every shard unless it is bound to one, either with
+# using() or through the author it was reached from. Reads are gathered from
+# all shards and merged; updates and deletes are applied to each shard.
+class ShardedQuerySet(models.QuerySet):
+    # The shard this queryset is bound to, or None when it spans every shard
+    def _bound_shard(self, write=False):
+        shards = shard_databases()
+        if not shards or self._db in shards:
+            return self._db
+        route = router.db_for_write if write else router.db_for_read
+        alias = route(self.model, **self._hints)
+        return alias if alias in shards else None
+
+    def _spans_shards(self, write=False):
+        return bool(shard_databases()) and self._bound_shard(write) is None
+
+    # (name, descending) pairs of the ordering, which the merge repeats
+    def _merge_ordering(self):
+        query = self.query
+        if query.extra_order_by:
+            ordering = query.extra_order_by
+        elif query.order_by:
+            ordering = query.order_by
+        elif query.default_ordering:
+            ordering = self.model._meta.ordering
+        else:
+            ordering = []
+
+        fields = []
+        for field in ordering:
+            if isinstance(field, OrderBy) and isinstance(field.expression, F):
+                fields.append((field.expression.name, field.descending))
+            elif isinstance(field, F):
+                fields.append((field.name, False))
+            elif isinstance(field, str) and field != "?":
+                fields.append((field.lstrip("-"), field.startswith("-")))
+            else:
+                raise NotSupportedError(
+                    f"Cannot merge shard results ordered by {field!r}."
+                )
+        return fields
+
+    # Function reading the value of an ordering field from a result row
+    def _row_getter(self, name):
+        opts = self.model._meta
+        if name == "pk":
+            name = opts.pk.name
+        try:
+            attname = opts.get_field(name).attname
+        except FieldDoesNotExist:
+            attname = name
+        if issubclass(self._iterable_class, ModelIterable):
+            return operator.attrgetter(attname)
+
+        if self._fields:
+            columns = list(self._fields)
+        else:
+            columns = [field.attname for field in opts.concrete_fields]
+            columns += list(self.query.annotation_select)
+        for column in (name, attname, "pk" if name == opts.pk.name else None):
+            if column not in columns:
+                continue
+            if issubclass(self._iterable_class, ValuesIterable):
+                return operator.itemgetter(column)
+            if issubclass(self._iterable_class, FlatValuesListIterable):
+                return lambda value: value
+            return operator.itemgetter(columns.index(column))
+        raise NotSupportedError(
+            f"Cannot merge shard results ordered by {name!r} without selecting it."
+        )
+
+    def _merge(self, results):
+        fields = self._merge_ordering()
+        if not fields:
+            return itertools.chain.from_iterable(results)
+        getters = [(self._row_getter(name), descending) for name, descending in fields]
+        return heapq.merge(*results, key=merge_key(getters))
+
+    # Copy of this queryset for one shard, without the books of authors placed
+    # on another shard. Every shard may hold the first `high_mark` rows, so
+    # each returns that many and the slice is applied to the merged rows.
+    def _for_shard(self, alias):
+        queryset = self._chain()
+        queryset._prefetch_related_lookups = ()
+        queryset.query.clear_limits()
+        hidden = shard_directory.hidden_authors(alias)
+        if hidden:
+            queryset = queryset.exclude(author__in=hidden)
+        if self.query.high_mark is not None:
+            queryset.query.set_limits(high=self.query.high_mark)
+        return queryset.using(alias)
+
+    def _fetch_all(self):
+        if self._result_cache is None and self._spans_shards():
+            querysets = {alias: self._for_shard(alias) for alias in shard_databases()}
+            results = scatter(lambda alias: list(querysets[alias]))
+            # Rows of a single shard, such as a book looked up by id, are
+            # already in order
+            results = [rows for rows in results if rows]
+            merged = (
+                self._merge(results) if len(results) > 1 else itertools.chain(*results)
+            )
+            self._result_cache = list(
+                itertools.islice(merged, self.query.low_mark, self.query.high_mark)
+            )
+        super()._fetch_all()
+
+    def iterator(self, chunk_size=None):
+        if not self._spans_shards():
+            return super().iterator(chunk_size)
+        iterators = [
+            self._for_shard(alias).iterator(chunk_size) for alias in shard_databases()
+        ]
+        return itertools.islice(
+            self._merge(iterators), self.query.low_mark, self.query.high_mark
+        )
+
+    def count(self):
+        if self._result_cache is not None or not self._spans_shards():
+            return super().count()
+        querysets = {alias: self._for_shard(alias) for alias in shard_databases()}
+        total = sum(scatter(lambda alias: querysets[alias].count()))
+        if self.query.high_mark is not None:
+            total = min(total, self.query.high_mark)
+        return max(total - self.query.low_mark, 0)
+
+    def exists(self):
+        if self._result_cache is not None or not self._spans_shards():
+            return super().exists()
+        querysets = {alias: self._for_shard(alias) for alias in shard_databases()}
+        return any(scatter(lambda alias: querysets[alias].exists()))
+
+    def aggregate(self, *args, **kwargs):
+        if self._spans_shards():
+            raise NotSupportedError("Cannot aggregate over every book shard.")
+        return super().aggregate(*args, **kwargs)
+
+    # Writes run shard by shard in this thread, so signal receivers and
+    # on_commit callbacks behave as they do without shards
+    def update(self, **kwargs):
+        if not self._spans_shards(write=True):
+            return super().update(**kwargs)
+        return sum(self.using(alias).update(**kwargs) for alias in shard_databases())
+
+    update.alters_data = True
+
+    def delete(self):
+        if not self._spans_shards(write=True):
+            return super().delete()
+        total = 0
+        deleted = Counter()
+        for alias in shard_databases():
+            count, per_model = self.using(alias).delete()
+            total += count
+            deleted.update(per_model)
+        return total, dict(deleted)
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    # New books are saved to the shard of their author
+    def create(self, **kwargs):
+        if not self._spans_shards(write=True):
+            return super().create(**kwargs)
+        book = self.model(**kwargs)
+        book.save(force_insert=True)
+        return book
+
+    create.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        if not self._spans_shards(write=True):
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        new_books = [book for book in objs if book.pk is None]
+        for book, book_id in zip(new_books, allocate_book_ids(len(new_books))):
+            book.pk = book_id
+        by_shard = {}
+        for book in objs:
+            shard = shard_directory.assign(book.author_id)
+            by_shard.setdefault(shard, []).append(book)
+        for alias, books in by_shard.items():
+            self.using(alias).bulk_create(books, *args, **kwargs)
+        return objs
+
+    bulk_create.alters_data = True
+
+
+# Placement of authors on shards. The whole directory is cached per process
+# and reloaded every BOOK_SHARD_DIRECTORY_TTL seconds; authors without a row
+# have no books yet and are placed by their id. Authors being moved also keep
+# the shard they are moved away from until the move is finished.
+class ShardDirectory:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._placements = {}
+        self._moving_from = {}
+        self._loaded_at = None
+
+    def default_shard(self, author_id):
+        shards = shard_databases()
+        return shards[author_id % len(shards)]
+
+    def shard_for(self, author_id):
+        self._refresh()
+        return self._placements.get(author_id) or self.default_shard(author_id)
+
+    # The shard an author is being moved away from, or None
+    def moving_from(self, author_id):
+        self._refresh()
+        return self._moving_from.get(author_id)
+
+    # Authors whose books are stored on `alias` while they are moved, although
+    # they are placed on another shard
+    def hidden_authors(self, alias):
+        self._refresh()
+        return [
+            author_id
+            for author_id in list(self._moving_from)
+            if self._placements.get(author_id) != alias
+        ]
+
+    # Record the placement of an author before their first book is written.
+    # The placement of authors being moved is read from the database, so their
+    # books are written to the new shard as soon as it is switched.
+    def assign(self, author_id):
+        from .models import AuthorShard
+
+        shard = self.shard_for(author_id)
+        if author_id in self._moving_from:
+            return AuthorShard.objects.values_list("shard", flat=True).get(
+                author_id=author_id
+            )
+        if author_id in self._placements:
+            return shard
+
+        placement, _ = AuthorShard.objects.get_or_create(
+            author_id=author_id, defaults={"shard": shard}
+        )
+        with self._lock:
+            self._placements[author_id] = placement.shard
+        return placement.shard
+
+    # Mark an author as moving away from their current shard
+    def start_move(self, author_id):
+        from .models import AuthorShard
+
+        source = self.shard_for(author_id)
+        AuthorShard.objects.update_or_create(
+            author_id=author_id, defaults={"shard": source, "moving_from": source}
+        )
+        with self._lock:
+            self._placements[author_id] = source
+            self._moving_from[author_id] = source
+        return source
+
+    def move(self, author_id, shard):
+        from .models import AuthorShard
+
+        AuthorShard.objects.update_or_create(
+            author_id=author_id, defaults={"shard": shard}
+        )
+        with self._lock:
+            self._placements[author_id] = shard
+
+    def finish_move(self, author_id):
+        from .models import AuthorShard
+
+        AuthorShard.objects.filter(author_id=author_id).update(moving_from="")
+        with self._lock:
+            self._moving_from.pop(author_id, None)
+
+    def reset(self):
+        with self._lock:
+            self._placements = {}
+            self._moving_from = {}
+            self._loaded_at = None
+
+    def _refresh(self):
+        now = time.monotonic()
+        if (
+            self._loaded_at is not None
+            and now - self._loaded_at < settings.BOOK_SHARD_DIRECTORY_TTL
+        ):
+            return
+
+        from .models import AuthorShard
+
+        rows = list(
+            AuthorShard.objects.values_list("author_id", "shard", "moving_from")
+        )
+        with self._lock:
+            self._placements = {author_id: shard for author_id, shard, _ in rows}
+            self._moving_from = {
+                author_id: source for author_id, _, source in rows if source
+            }
+            self._loaded_at = now
+
+
+shard_directory = ShardDirectory()
+
+
+# Book ids come from one sequence on the default database, as every shard
+# would otherwise number its rows from 1. Each process reserves a block of
+# BOOK_ID_BLOCK_SIZE ids at a time; blocks are not shared with forked children.
+_id_lock = threading.Lock()
+_id_block = {"pid": None, "ids": iter(())}
+
+
+def allocate_book_ids(count):
+    with _id_lock:
+        if _id_block["pid"] != os.getpid():
+            _id_block.update(pid=os.getpid(), ids=iter(()))
+        ids = list(itertools.islice(_id_block["ids"], count))
+        missing = count - len(ids)
+        if missing:
+            size = max(missing, settings.BOOK_ID_BLOCK_SIZE)
+            start = _reserve_book_ids(size)
+            block = iter(range(start, start + size))
+            ids.extend(itertools.islice(block, missing))
+            _id_block["ids"] = block
+    return ids
+
+
+def _reserve_book_ids(size):
+    from .models import Book, IdSequence
+
+    # The UPDATE takes the write lock before the new value is read
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        sequences = IdSequence.objects.filter(name="book")
+        if not sequences.update(next_value=F("next_value") + size):
+            highest = Book.all_objects.order_by("-pk").values_list("pk", flat=True)
+            try:
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    IdSequence.objects.create(
+                        name="book", next_value=(highest.first() or 0) + 1 + size
+                    )
+            except IntegrityError:
+                sequences.update(next_value=F("next_value") + size)
+        return sequences.values_list("next_value", flat=True).get() - size
+
+
+# Make sure ids handed out later are higher than `book_id`
+def reserve_book_ids_after(book_id):
+    from .models import IdSequence
+
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        sequence, created = IdSequence.objects.get_or_create(
+            name="book", defaults={"next_value": book_id + 1}
+        )
+        if not created and sequence.next_value <= book_id:
+            IdSequence.objects.filter(pk=sequence.pk).update(next_value=book_id + 1)
+
+
+# Prepare a book for saving: record its author's placement, give new books an
+# id from the global sequence and move books whose author changed shard. Books
+# loaded from the shard their author is being moved away from replace their
+# copy on the new shard; the move clears the old one.
+def prepare_book_save(book, kwargs):
+    if book.author_id is None:
+        return kwargs
+    shard = shard_directory.assign(book.author_id)
+    if book.pk is None:
+        book.pk = allocate_book_ids(1)[0]
+        kwargs["force_insert"] = True
+    elif book._state.db in shard_databases() and book._state.db != shard:
+        stale = book._state.db
+        if stale == shard_directory.moving_from(book.author_id):
+            stale = shard
+        type(book).all_objects.using(stale).filter(pk=book.pk)._raw_delete(stale)
+        kwargs["force_insert"] = True
+        kwargs.pop("update_fields", None)
+    if kwargs.get("using") is None:
+        kwargs["using"] = shard
+    return kwargs
+
+
+# Routes books to the shard of their author and every other model to the
+# default database. Inactive while BOOK_SHARD_DATABASES is empty.
+class BookShardRouter:
+    def db_for_read(self, model, **hints):
+        return self._route(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model, hints)
+
+    def _route(self, model, hints):
+        shards = shard_databases()
+        if not shards:
+            return None
+        if not is_book_model(model):
+            return DEFAULT_DB_ALIAS
+
+        instance = hints.get("instance")
+        if isinstance(instance, model):
+            if instance._state.db in shards:
+                return instance._state.db
+            if instance.author_id is not None:
+                return shard_directory.shard_for(instance.author_id)
+        elif isinstance(instance, model._meta.get_field("author").related_model):
+            return shard_directory.shard_for(instance.pk)
+        # Spans every shard; ShardedQuerySet gathers the results
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if shard_databases() and (is_book_model(obj1) or is_book_model(obj2)):
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        shards = shard_databases()
+        if not shards:
+            return None
+        is_book = app_label == "bookstore_app" and model_name == "book"
+        if db in shards:
+            return is_book
+        return not is_book
+
+
+def _book_values(book):
+    return tuple(field.value_from_object(book) for field in book._meta.concrete_fields)
+
+
+# Copy books to `target` keeping their ids, replacing earlier copies, and
+# return the copied field values by id. Rows are copied without signals or
+# cascades as the books themselves do not change.
+def copy_books(queryset, target, batch_size):
+    from .models import Book
+
+    copied = {}
+    books = queryset.order_by("pk").iterator(chunk_size=batch_size)
+    while batch := list(itertools.islice(books, batch_size)):
+        ids = [book.pk for book in batch]
+        with transaction.atomic(using=target):
+            Book.all_objects.using(target).filter(pk__in=ids)._raw_delete(target)
+            Book.all_objects.using(target).bulk_create(batch)
+        copied.update((book.pk, _book_values(book)) for book in batch)
+    return copied
+
+
+# Move every book of an author to `target` while the site keeps running.
+# The author is first marked as moving and, once every process has reloaded
+# the directory (`grace` seconds), their books are copied and the directory is
+# switched. Until the move is finished each process reads the author's books
+# only from the shard it places them on, and writes them to the shard placed
+# in the database. After another `grace` seconds, changes written to the old
+# shard in the meantime are copied unless the book also changed on the new
+# one, and the old shard is cleared.
+def move_author(author_id, target, batch_size=1000, grace=None):
+    from .models import Book
+
+    shard_directory.reset()
+    source = shard_directory.shard_for(author_id)
+    if source == target:
+        return 0
+    if grace is None:
+        grace = settings.BOOK_SHARD_DIRECTORY_TTL + 1
+
+    shard_directory.start_move(author_id)
+    time.sleep(grace)
+    source_books = Book.all_objects.using(source).filter(author_id=author_id)
+    copied = copy_books(source_books, target, batch_size)
+    shard_directory.move(author_id, target)
+    time.sleep(grace)
+
+    def values_by_id(queryset):
+        return {
+            book.pk: _book_values(book)
+            for book in queryset.iterator(chunk_size=batch_size)
+        }
+
+    current = values_by_id(source_books)
+    moved = values_by_id(Book.all_objects.using(target).filter(author_id=author_id))
+    changed = []
+    removed = []
+    for pk in current.keys() | copied.keys():
+        old, new = copied.get(pk), current.get(pk)
+        if new == old or new == moved.get(pk):
+            continue
+        if moved.get(pk) != old:
+            logger.warning(
+                "Book %s changed on %s and %s while author %s was moved; "
+                "keeping the version on %s",
+                pk,
+                source,
+                target,
+                author_id,
+                target,
+            )
+        elif new is None:
+            removed.append(pk)
+        else:
+            changed.append(pk)
+    for start in range(0, len(changed), batch_size):
+        batch = changed[start : start + batch_size]
+        copy_books(source_books.filter(pk__in=batch), target, batch_size)
+    for start in range(0, len(removed), batch_size):
+        Book.all_objects.using(target).filter(
+            pk__in=removed[start : start + batch_size]
+        )._raw_delete(target)
+    source_books._raw_delete(source)
+    shard_directory.finish_move(author_id)
+    return len(current)
+
+
+# Book counts per author on every shard, as {shard: {author id: count}}
+def author_book_counts():
+    from .models import Book
+
+    def count(alias):
+        return dict(
+            Book.all_objects.using(alias)
+            .values("author_id")
+            .annotate(books=models.Count("pk"))
+            .values_list("author_id", "books")
+        )
+
+    return dict(zip(shard_databases(), scatter(count)))
+
+
+# Author moves, as (author id, source, target) tuples, that bring every shard
+# within `tolerance` of the mean book count. Each step moves the author from
+# the fullest to the emptiest shard whose book count best halves their gap.
+def plan_rebalance(tolerance):
+    counts = author_book_counts()
+    loads = {alias: sum(authors.values()) for alias, authors in counts.items()}
+    allowed_gap = tolerance * sum(loads.values()) / len(loads)
+    moves = []
+    while True:
+        fullest = max(loads, key=loads.get)
+        emptiest = min(loads, key=loads.get)
+        gap = loads[fullest] - loads[emptiest]
+        if gap <= allowed_gap:
+            break
+        candidates = [
+            (books, author_id)
+            for author_id, books in counts[fullest].items()
+            if books < gap
+        ]
+        if not candidates:
+            break
+        books, author_id = min(candidates, key=lambda item: abs(gap / 2 - item[0]))
+        del counts[fullest][author_id]
+        counts[emptiest][author_id] = books
+        loads[fullest] -= books
+        loads[emptiest] += books
+        moves.append((author_id, fullest, emptiest))
+    return moves
+
+
+# Move books stored in the default database before sharding was enabled to
+# the shards of their authors
+def import_unsharded_books(batch_size=1000):
+    from .models import Book
+
+    unsharded = models.QuerySet(Book, using=DEFAULT_DB_ALIAS)
+    highest = unsharded.order_by("-pk").values_list("pk", flat=True).first()
+    if highest is None:
+        return 0
+    reserve_book_ids_after(highest)
+
+    moved = 0
+    author_ids = unsharded.values_list("author_id", flat=True).distinct()
+    for author_id in list(author_ids):
+        target = shard_directory.assign(author_id)
+        author_books = unsharded.filter(author_id=author_id)
+        moved += len(copy_books(author_books, target, batch_size))
+        author_books._raw_delete(DEFAULT_DB_ALIAS)
+    return moved
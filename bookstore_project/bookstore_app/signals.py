@@ -0,0 +1,47 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .jobs import enqueue
+from .models import Book, PriceRule
+from .pricing import price_rules
+from .title_index import title_index
+
+
+# Keep this process's title index in step with committed book changes
+@receiver(post_save, sender=Book)
+def update_title_index(sender, instance, **kwargs):
+    if not title_index.tracks_changes:
+        return
+    if instance.is_published:
+        transaction.on_commit(lambda: title_index.add(instance.pk, instance.title))
+    else:
+        transaction.on_commit(lambda: title_index.remove(instance.pk))
+
+
+@receiver(post_delete, sender=Book)
+def remove_from_title_index(sender, instance, **kwargs):
+    if title_index.tracks_changes:
+        transaction.on_commit(lambda: title_index.remove(instance.pk))
+
+
+# Fields that affect the precomputed similar books
+SIMILARITY_FIELDS = {"title", "description", "is_published"}
+
+
+# Fold new, edited and unpublished books into the similar books in the background
+@receiver(post_save, sender=Book)
+def update_similar_books(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SIMILARITY_FIELDS & set(update_fields):
+        return
+    if instance.is_published:
+        enqueue("books.fold_in_similar", {"book_id": instance.pk})
+    else:
+        enqueue("books.drop_similar", {"book_id": instance.pk})
+
+
+# Rebuild this process's price rule index once rule changes have committed
+@receiver(post_save, sender=PriceRule)
+@receiver(post_delete, sender=PriceRule)
+def invalidate_price_rules(sender, **kwargs):
+    transaction.on_commit(price_rules.invalidate)
@@ -0,0 +1,329 @@
+import fcntl
+import json
+import logging
+import math
+import re
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from scipy import sparse
+
+from .models import Book, SimilarBook
+from .title_index import normalize_title
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+STOP_WORDS = frozenset(
+    "a an and are as at be but by for from has he her his in is it its of on or "
+    "she that the their they this to was were will with".split()
+)
+
+# Files of the model written by the last full build, and of the rows folded in
+# since then
+VOCABULARY_FILE = "vocabulary.json"
+BASE_MATRIX_FILE = "base_matrix.npz"
+BASE_IDS_FILE = "base_ids.npy"
+DELTA_MATRIX_FILE = "delta_matrix.npz"
+DELTA_IDS_FILE = "delta_ids.npy"
+LOCK_FILE = ".lock"
+
+
+# Terms of a book; title terms are counted twice to weigh them higher
+def tokenize(title, description):
+    text = normalize_title(f"{title} {title} {description}")
+    return [
+        token
+        for token in TOKEN_RE.findall(text)
+        if len(token) > 1 and token not in STOP_WORDS
+    ]
+
+
+# Scale every row of a sparse matrix to unit length
+def normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms) @ matrix
+
+
+# Sublinear term frequency, 1 + log(count)
+def term_weights(counts):
+    return [1 + math.log(count) for count in counts]
+
+
+# TF-IDF vectors of books, split into the matrix of the last full build and a
+# small matrix of books folded in since
+class SimilarityModel:
+    def __init__(self, terms, idf, base_ids, base_matrix, delta_ids, delta_matrix):
+        self.terms = terms
+        self.vocabulary = {term: column for column, term in enumerate(terms)}
+        self.idf = idf
+        self.base_ids = base_ids
+        self.base_matrix = base_matrix
+        self.delta_ids = delta_ids
+        self.delta_matrix = delta_matrix
+
+    def vectorize(self, title, description):
+        counts = Counter(
+            self.vocabulary[token]
+            for token in tokenize(title, description)
+            if token in self.vocabulary
+        )
+        columns = list(counts)
+        weights = np.array(term_weights(counts.values()), dtype=np.float32)
+        vector = sparse.csr_matrix(
+            (weights * self.idf[columns], (np.zeros(len(columns)), columns)),
+            shape=(1, len(self.terms)),
+            dtype=np.float32,
+        )
+        return normalize_rows(vector).tocsr()
+
+    # Store `vector` as the current vector of `book_id`
+    def set_delta_row(self, book_id, vector):
+        keep = self.delta_ids != book_id
+        self.delta_ids = np.append(self.delta_ids[keep], book_id)
+        self.delta_matrix = sparse.vstack([self.delta_matrix[keep], vector]).tocsr()
+
+    # Cosine similarity of `vector` to every book, as (ids, scores)
+    def scores(self, vector):
+        base_scores = (self.base_matrix @ vector.T).toarray().ravel()
+        # Base rows of books folded in later are stale
+        base_scores[np.isin(self.base_ids, self.delta_ids)] = 0
+        delta_scores = (self.delta_matrix @ vector.T).toarray().ravel()
+        return (
+            np.concatenate([self.base_ids, self.delta_ids]),
+            np.concatenate([base_scores, delta_scores]),
+        )
+
+
+# Indices of the `count` highest values, highest first
+def top_indices(values, count):
+    if len(values) > count:
+        candidates = np.argpartition(-values, count)[:count]
+    else:
+        candidates = np.arange(len(values))
+    return candidates[np.argsort(-values[candidates], kind="stable")]
+
+
+@contextmanager
+def model_lock():
+    model_dir = settings.SIMILAR_BOOKS_MODEL_DIR
+    model_dir.mkdir(parents=True, exist_ok=True)
+    with open(model_dir / LOCK_FILE, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# The base part of the model is large and only changes with a full build, so
+# it is cached per process and reloaded when its file changes
+_base_cache = {}
+
+
+def load_model():
+    model_dir = settings.SIMILAR_BOOKS_MODEL_DIR
+    base_path = model_dir / BASE_MATRIX_FILE
+    if not base_path.exists():
+        return None
+
+    modified = base_path.stat().st_mtime_ns
+    if _base_cache.get("modified") != modified:
+        with open(model_dir / VOCABULARY_FILE) as vocabulary_file:
+            vocabulary = json.load(vocabulary_file)
+        _base_cache.update(
+            modified=modified,
+            terms=vocabulary["terms"],
+            idf=np.array(vocabulary["idf"], dtype=np.float32),
+            ids=np.load(model_dir / BASE_IDS_FILE),
+            matrix=sparse.load_npz(base_path).tocsr(),
+        )
+
+    if (model_dir / DELTA_MATRIX_FILE).exists():
+        delta_ids = np.load(model_dir / DELTA_IDS_FILE)
+        delta_matrix = sparse.load_npz(model_dir / DELTA_MATRIX_FILE).tocsr()
+    else:
+        delta_ids = np.array([], dtype=np.int64)
+        delta_matrix = sparse.csr_matrix(
+            (0, len(_base_cache["terms"])), dtype=np.float32
+        )
+    return SimilarityModel(
+        _base_cache["terms"],
+        _base_cache["idf"],
+        _base_cache["ids"],
+        _base_cache["matrix"],
+        delta_ids,
+        delta_matrix,
+    )
+
+
+def save_delta(model):
+    model_dir = settings.SIMILAR_BOOKS_MODEL_DIR
+    np.save(model_dir / DELTA_IDS_FILE, model.delta_ids)
+    sparse.save_npz(model_dir / DELTA_MATRIX_FILE, model.delta_matrix)
+
+
+# Replace the neighbour rows of the given books; `neighbours` maps a book id to
+# a list of (similar id, similar title, score) in rank order
+def write_neighbours(neighbours):
+    with transaction.atomic():
+        SimilarBook.objects.filter(book_id__in=list(neighbours)).delete()
+        SimilarBook.objects.bulk_create(
+            SimilarBook(
+                book_id=book_id,
+                similar_id=similar_id,
+                similar_title=similar_title,
+                score=score,
+                rank=rank,
+            )
+            for book_id, rows in neighbours.items()
+            for rank, (similar_id, similar_title, score) in enumerate(rows, start=1)
+        )
+
+
+# Recompute the TF-IDF model and the top-k neighbours of every published book.
+# Vectors are assembled in one pass over the Book table, and similarities are
+# computed one batch of rows at a time so memory stays bounded.
+def build_similar_books(top_k, batch_size, progress=None):
+    ids = array("q")
+    titles = []
+    vocabulary = {}
+    columns = array("q")
+    weights = array("f")
+    indptr = array("q", [0])
+    rows = Book.objects.order_by("pk").values_list("pk", "title", "description")
+    for book_id, title, description in rows.iterator(chunk_size=batch_size):
+        counts = Counter(tokenize(title, description))
+        for term in counts:
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+        weights.extend(term_weights(counts.values()))
+        indptr.append(len(columns))
+        ids.append(book_id)
+        titles.append(title)
+
+    book_count = len(ids)
+    counts_matrix = sparse.csr_matrix(
+        (
+            np.frombuffer(weights, dtype=np.float32),
+            np.frombuffer(columns, dtype=np.int64),
+            np.frombuffer(indptr, dtype=np.int64),
+        ),
+        shape=(book_count, len(vocabulary)),
+    )
+    document_frequency = np.bincount(counts_matrix.indices, minlength=len(vocabulary))
+    idf = (np.log((1 + book_count) / (1 + document_frequency)) + 1).astype(np.float32)
+    matrix = (
+        normalize_rows(counts_matrix @ sparse.diags(idf)).tocsr().astype(np.float32)
+    )
+    ids = np.frombuffer(ids, dtype=np.int64)
+
+    transposed = matrix.T.tocsr()
+    for start in range(0, book_count, batch_size):
+        block = (matrix[start : start + batch_size] @ transposed).tocsr()
+        neighbours = {}
+        for offset in range(block.shape[0]):
+            row = start + offset
+            begin, end = block.indptr[offset], block.indptr[offset + 1]
+            columns_in_row = block.indices[begin:end]
+            scores = block.data[begin:end]
+            keep = (columns_in_row != row) & (scores > 0)
+            columns_in_row, scores = columns_in_row[keep], scores[keep]
+            neighbours[int(ids[row])] = [
+                (int(ids[column]), titles[column], float(scores[position]))
+                for position in top_indices(scores, top_k)
+                for column in [columns_in_row[position]]
+            ]
+        write_neighbours(neighbours)
+        if progress:
+            progress(min(start + batch_size, book_count), book_count)
+
+    # Neighbour lists of books that are no longer published. Books may be
+    # stored in other databases, so the ids are compared here instead of joined.
+    published = set(ids.tolist())
+    stale = [
+        book_id
+        for book_id in SimilarBook.objects.values_list("book_id", flat=True).distinct()
+        if book_id not in published
+    ]
+    for start in range(0, len(stale), batch_size):
+        SimilarBook.objects.filter(
+            book_id__in=stale[start : start + batch_size]
+        ).delete()
+
+    with model_lock():
+        model_dir = settings.SIMILAR_BOOKS_MODEL_DIR
+        terms = sorted(vocabulary, key=vocabulary.get)
+        with open(model_dir / VOCABULARY_FILE, "w") as vocabulary_file:
+            json.dump({"terms": terms, "idf": idf.tolist()}, vocabulary_file)
+        np.save(model_dir / BASE_IDS_FILE, ids)
+        sparse.save_npz(model_dir / BASE_MATRIX_FILE, matrix)
+        for name in (DELTA_IDS_FILE, DELTA_MATRIX_FILE):
+            (model_dir / name).unlink(missing_ok=True)
+    return book_count
+
+
+# Fold a new or edited book into the model without rebuilding it: compute its
+# own neighbours and update the lists of the books it is most similar to.
+# Terms unknown to the last full build are ignored until the next one.
+def fold_in_book(book_id):
+    book = Book.objects.filter(pk=book_id).values_list("title", "description").first()
+    if book is None:
+        drop_book(book_id)
+        return
+    title, description = book
+
+    with model_lock():
+        model = load_model()
+        if model is None:
+            logger.info("No similarity model built yet, skipping book %s", book_id)
+            return
+        vector = model.vectorize(title, description)
+        model.set_delta_row(book_id, vector)
+        save_delta(model)
+
+    top_k = settings.SIMILAR_BOOKS_TOP_K
+    ids, scores = model.scores(vector)
+    scores[ids == book_id] = 0
+    candidates = top_indices(scores, settings.SIMILAR_BOOKS_FOLD_IN_CANDIDATES)
+    candidates = [index for index in candidates if scores[index] > 0]
+    candidate_scores = {int(ids[index]): float(scores[index]) for index in candidates}
+    published = dict(
+        Book.objects.filter(pk__in=list(candidate_scores)).values_list("pk", "title")
+    )
+
+    neighbours = {
+        book_id: [
+            (similar_id, published[similar_id], score)
+            for similar_id, score in candidate_scores.items()
+            if similar_id in published
+        ][:top_k]
+    }
+
+    # Books that listed this one before, or should list it now
+    affected = set(published) | set(
+        SimilarBook.objects.filter(similar_id=book_id).values_list("book_id", flat=True)
+    )
+    existing = {}
+    for row in SimilarBook.objects.filter(book_id__in=affected).order_by("rank"):
+        existing.setdefault(row.book_id, []).append(
+            (row.similar_id, row.similar_title, row.score)
+        )
+    for other_id in affected:
+        rows = [row for row in existing.get(other_id, []) if row[0] != book_id]
+        score = candidate_scores.get(other_id, 0)
+        if score > 0:
+            rows.append((book_id, title, score))
+        neighbours[other_id] = sorted(rows, key=lambda row: -row[2])[:top_k]
+    write_neighbours(neighbours)
+
+
+# Remove an unpublished or deleted book from every neighbour list
+def drop_book(book_id):
+    SimilarBook.objects.filter(similar_id=book_id).delete()
+    SimilarBook.objects.filter(book_id=book_id).delete()
@@ -0,0 +1,98 @@
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .jobs import enqueue, job
+from .models import Book
+
+User = get_user_model()
+
+
+# Validate an uploaded cover and shrink it to the configured maximum size
+@job("books.process_cover")
+def process_cover(book_id, cover_name):
+    # Pillow is only imported by job workers, not at web worker boot
+    from PIL import Image
+
+    book = Book.all_objects.filter(pk=book_id).only("cover_image").first()
+    # Skip covers that were replaced or removed after the job was queued
+    if book is None or book.cover_image.name != cover_name:
+        return
+
+    with default_storage.open(cover_name, "rb") as cover_file:
+        image = Image.open(cover_file)
+        image.load()
+
+    max_size = settings.BOOK_COVER_MAX_SIZE
+    if image.width <= max_size[0] and image.height <= max_size[1]:
+        return
+
+    image_format = image.format
+    image.thumbnail(max_size)
+    with default_storage.open(cover_name, "wb") as cover_file:
+        image.save(cover_file, format=image_format)
+
+
+# Remove a cover file that no book references any more
+@job("books.delete_cover")
+def delete_cover(cover_name):
+    if Book.all_objects.filter(cover_image=cover_name).exists():
+        return
+    default_storage.delete(cover_name)
+
+
+# Delete a user and all of their books in small batches.
+# Each batch commits on its own so SQLite's write lock is never held for long.
+@job("users.purge")
+def purge_user(user_id):
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Book.all_objects.filter(author_id=user_id).values_list(
+                    "pk", "cover_image"
+                )[: settings.BOOK_PURGE_BATCH_SIZE]
+            )
+            if not rows:
+                break
+            Book.all_objects.filter(pk__in=[pk for pk, _ in rows]).delete()
+
+        for _, cover_name in rows:
+            if cover_name:
+                enqueue("books.delete_cover", {"cover_name": cover_name})
+        # Give other writers a chance to take the database lock
+        time.sleep(settings.BOOK_PURGE_PAUSE)
+
+    User.objects.filter(pk=user_id).delete()
+
+
+# Fold a new or edited book into the precomputed similar books
+@job("books.fold_in_similar")
+def fold_in_similar(book_id):
+    from .similarity import fold_in_book
+
+    fold_in_book(book_id)
+
+
+# Remove an unpublished book from the precomputed similar books
+@job("books.drop_similar")
+def drop_similar(book_id):
+    from .similarity import drop_book
+
+    drop_book(book_id)
+
+
+# Write book views buffered by a web worker
+@job("books.record_views")
+def record_views(counts, viewed_at):
+    from .popularity import write_views
+
+    # A retried job must not count the views of earlier chunks twice
+    with transaction.atomic():
+        write_views(
+            {int(pk): count for pk, count in counts.items()},
+            datetime.fromisoformat(viewed_at),
+        )
@@ -1,14 +1,86 @@
+import csv
+import http.client
+import io
+import json
+import math
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock
+
+import msgpack
 from bookstore_app.banned_users_cache import set_banned_users
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import override_settings
 from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.request import Request
+from rest_framework.test import (
+    APIClient,
+    APIRequestFactory,
+    APITestCase,
+    APITransactionTestCase,
+)
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from bookstore_project.handlers import PathRoutedWSGIHandler
+
+from .coalescing import SingleFlight, coalescing_stats
+from .jobs import (
+    claim_jobs,
+    enqueue,
+    job,
+    prune_finished_jobs,
+    requeue_stale_jobs,
+    run_job,
+)
+from .management.commands.profile_imports import parse_importtime
+from .management.commands.serve import Worker, memory_usage
+from .models import Book, Job, PriceRule, RevokedToken, SimilarBook
+from .paginators import EstimatedCountPaginator
+from .popularity import log_view_weight, view_counter, write_views
+from .pricing import apply_price_rule, price_rules
+from .profiling import REPORT_HEADER
+from .read_models import ReadModel
+from .serializers import BookSerializer
+from .sharding import merge_key, move_author, shard_directory
+from .similarity import build_similar_books, fold_in_book
+from .title_index import TitleIndex, title_index
+from .token_denylist import BloomFilter, TokenDenylist, denylist
+from .views import BookViewSet
+from .warmup import build_indexes, warm_up
 
-from .models import Book
+# Files written by tests go below this directory, removed when the run ends
+TEST_FILES = tempfile.TemporaryDirectory()
+TEST_FILES_DIR = Path(TEST_FILES.name)
+
+
+# Books may be stored on shard databases (BOOKSTORE_BOOK_SHARDS), so tests may
+# query every database
+class ShardAwareAPITestCase(APITestCase):
+    databases = "__all__"
 
 
 # Test class for general book API tests
-class BookAPITests(APITestCase):
+class BookAPITests(ShardAwareAPITestCase):
     # Set up a user and book for testing
     def setUp(self):
         self.user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
@@ -81,7 +153,7 @@ class BookAPITests(APITestCase):
 
 
 # Test class for book author and other user API tests
-class BookAuthorAPITests(APITestCase):
+class BookAuthorAPITests(ShardAwareAPITestCase):
     def setUp(self):
         # Author user to test authorized actions
         self.author_user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
@@ -160,6 +232,42 @@ class BookAuthorAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
         self.client.logout()
 
+    # Test case: Deleting a book unpublishes it instead of removing the row
+    def test_delete_unpublishes_book(self):
+        response = self.client.delete(
+            reverse("book-detail", kwargs={"pk": self.book.pk})
+        )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        unpublished_book = Book.all_objects.get(pk=self.book.pk)
+        self.assertFalse(unpublished_book.is_published)
+        self.assertIsNotNone(unpublished_book.unpublished_at)
+
+        # Unpublished books are hidden from the list and detail endpoints
+        response = self.client.get(reverse("book-list"))
+        self.assertNotIn(self.book.pk, [book["id"] for book in response.data])  # type: ignore for `response.data`
+        response = self.client.get(reverse("book-detail", kwargs={"pk": self.book.pk}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    # Test case: Deleting a user deactivates them and purges their books in batches
+    def test_delete_user_purges_books_in_background(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(
+                reverse("customuser-detail", kwargs={"pk": self.pseudonym_user.pk})
+            )
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.pseudonym_user.refresh_from_db()
+        self.assertFalse(self.pseudonym_user.is_active)
+
+        with self.settings(BOOK_PURGE_BATCH_SIZE=1, BOOK_PURGE_PAUSE=0):
+            self.assertTrue(run_job(claim_jobs(1)[0]))
+        self.assertFalse(
+            get_user_model().objects.filter(pk=self.pseudonym_user.pk).exists()
+        )
+        self.assertFalse(
+            Book.all_objects.filter(pk=self.book_by_pseudonym_author.pk).exists()
+        )
+
     # Test case: Retrieve a book detail includes correct author displayed name
     def test_retrieve_book_detail_includes_author_displayed_name(self):
         # Assuming author_user has both a real name and a pseudonym set up
@@ -202,7 +310,7 @@ class BookAuthorAPITests(APITestCase):
 
 
 # Test class for non-author API tests
-class BookNonAuthorAPITests(APITestCase):
+class BookNonAuthorAPITests(ShardAwareAPITestCase):
     def setUp(self):
         # Author user to test authorized actions
         self.author_user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
@@ -260,7 +368,7 @@ class BookNonAuthorAPITests(APITestCase):
 
 
 # Test class for admins
-class BookAdminTest(APITestCase):
+class BookAdminTest(ShardAwareAPITestCase):
     def setUp(self):
         # Admin user
         self.admin_user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
@@ -305,7 +413,7 @@ class BookAdminTest(APITestCase):
 
 
 # Class for testing banned user API access
-class BannedUserAPITests(APITestCase):
+class BannedUserAPITests(ShardAwareAPITestCase):
     # Setup for banned user tests
     def setUp(self):
         # Set up banned user
@@ -356,3 +464,1402 @@ class BannedUserAPITests(APITestCase):
         self.client.login(username="Darth Vader", password="testpassword23")
         response = self.client.get(reverse("book-detail", kwargs={"pk": self.book.pk}))  # type: ignore for `self.book`
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+# Job handler used by the job queue tests; fails while `fail` is set
+@job("tests.record")
+def record_job(fail=False):
+    if fail:
+        raise RuntimeError("Job failed on purpose")
+
+
+# Test class for the background job queue
+class JobQueueTests(ShardAwareAPITestCase):
+    # Test case: Jobs are only inserted once the surrounding transaction commits
+    def test_enqueue_waits_for_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue("tests.record")
+            self.assertFalse(Job.objects.exists())
+        self.assertEqual(Job.objects.filter(name="tests.record").count(), 1)
+
+    # Test case: Enqueueing with the same idempotency key creates a single job
+    def test_idempotency_key_deduplicates_jobs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue("tests.record", idempotency_key="same-key")
+            enqueue("tests.record", idempotency_key="same-key")
+        self.assertEqual(Job.objects.count(), 1)
+
+    # Test case: A claimed job runs to completion
+    def test_claimed_job_succeeds(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue("tests.record")
+        claimed = claim_jobs(10)
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(claim_jobs(10), [])
+        self.assertTrue(run_job(claimed[0]))
+        self.assertEqual(Job.objects.get().status, Job.SUCCEEDED)
+
+    # Test case: A failing job is rescheduled with backoff, then marked failed
+    def test_failing_job_is_retried_then_failed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue("tests.record", {"fail": True})
+        Job.objects.update(max_attempts=2)
+
+        self.assertFalse(run_job(claim_jobs(1)[0]))
+        failed_job = Job.objects.get()
+        self.assertEqual(failed_job.status, Job.PENDING)
+        self.assertIn("Job failed on purpose", failed_job.last_error)
+        # The retry is scheduled in the future and not claimable yet
+        self.assertEqual(claim_jobs(1), [])
+
+        Job.objects.update(run_after=failed_job.created_at)
+        self.assertFalse(run_job(claim_jobs(1)[0]))
+        self.assertEqual(Job.objects.get().status, Job.FAILED)
+
+    # Test case: An error raised around a job counts as a failed attempt and
+    # does not stop the worker
+    def test_run_jobs_survives_errors_outside_jobs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue("tests.record")
+        stdout, stderr = io.StringIO(), io.StringIO()
+        with mock.patch(
+            "bookstore_app.management.commands.run_jobs.run_job",
+            side_effect=DatabaseError("database is locked"),
+        ):
+            call_command("run_jobs", once=True, stdout=stdout, stderr=stderr)
+        self.assertIn("succeeded: 0, failed: 1", stdout.getvalue())
+        self.assertIn("database is locked", stderr.getvalue())
+        failed_job = Job.objects.get()
+        self.assertEqual(failed_job.status, Job.PENDING)
+        self.assertIn("database is locked", failed_job.last_error)
+
+    # Test case: Abandoned jobs are retried until they run out of attempts
+    def test_stale_jobs_are_requeued_then_failed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            enqueue("tests.record")
+            enqueue("tests.record")
+        first, second = claim_jobs(2)
+        Job.objects.filter(pk=second).update(max_attempts=1)
+        Job.objects.update(locked_at=timezone.now() - timedelta(seconds=2 * 300))
+        with self.settings(JOB_QUEUE_LOCK_TIMEOUT=300):
+            self.assertEqual(requeue_stale_jobs(), 1)
+        self.assertEqual(Job.objects.get(pk=first).status, Job.PENDING)
+        self.assertEqual(Job.objects.get(pk=second).status, Job.FAILED)
+
+    # Test case: Finished jobs are deleted once their retention has passed
+    def test_finished_jobs_are_pruned(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                enqueue("tests.record")
+        finished, recent, pending = Job.objects.order_by("pk")
+        for _ in range(2):
+            run_job(claim_jobs(1)[0])
+        Job.objects.filter(pk__in=[finished.pk, pending.pk]).update(
+            updated_at=timezone.now() - timedelta(days=2)
+        )
+        with self.settings(JOB_QUEUE_RETENTION=24 * 3600):
+            self.assertEqual(prune_finished_jobs(), 1)
+        self.assertEqual(
+            set(Job.objects.values_list("pk", flat=True)), {recent.pk, pending.pk}
+        )
+
+
+# Test class for JWT token issuance and refresh
+class TokenAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        denylist.reset()
+        self.user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="tokenuser", password="testpassword"
+        )
+        self.credentials = {"username": "tokenuser", "password": "testpassword"}
+
+    # Test case: Logging in with a legacy PBKDF2 hash upgrades it to scrypt
+    def test_login_rehashes_legacy_password(self):
+        self.user.password = make_password("testpassword", hasher="pbkdf2_sha256")
+        self.user.save(update_fields=["password"])
+
+        response = self.client.post(
+            reverse("token_obtain_pair"), self.credentials, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.password.startswith("scrypt$"))
+
+    # Test case: Refreshing rotates the refresh token and revokes the old one
+    def test_refresh_rotates_and_revokes_token(self):
+        response = self.client.post(
+            reverse("token_obtain_pair"), self.credentials, format="json"
+        )
+        refresh = response.data["refresh"]  # type: ignore for `response.data`
+
+        response = self.client.post(
+            reverse("token_refresh"), {"refresh": refresh}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn("access", response.data)  # type: ignore for `response.data`
+        self.assertNotEqual(response.data["refresh"], refresh)  # type: ignore for `response.data`
+
+        # The old refresh token cannot be used a second time
+        response = self.client.post(
+            reverse("token_refresh"), {"refresh": refresh}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    # Test case: A rotated refresh token cannot be replayed through another
+    # process whose denylist has not picked up the revocation yet
+    def test_refresh_token_replay_across_denylists(self):
+        response = self.client.post(
+            reverse("token_obtain_pair"), self.credentials, format="json"
+        )
+        refresh = response.data["refresh"]  # type: ignore for `response.data`
+        other = TokenDenylist()
+        self.assertFalse(other.is_revoked("unrelated"))
+
+        response = self.client.post(
+            reverse("token_refresh"), {"refresh": refresh}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # The other denylist synced before the revocation and still misses it
+        jti = RefreshToken(refresh)["jti"]
+        self.assertFalse(other.is_revoked(jti))
+        with mock.patch("bookstore_app.serializers.denylist", other):
+            response = self.client.post(
+                reverse("token_refresh"), {"refresh": refresh}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertNotIn("refresh", response.data)  # type: ignore for `response.data`
+
+    # Test case: Refreshing the token of a deactivated user is refused
+    def test_refresh_for_inactive_user_is_unauthorized(self):
+        response = self.client.post(
+            reverse("token_obtain_pair"), self.credentials, format="json"
+        )
+        self.user.is_active = False
+        self.user.save(update_fields=["is_active"])
+        response = self.client.post(
+            reverse("token_refresh"),
+            {"refresh": response.data["refresh"]},  # type: ignore for `response.data`
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response.data["detail"].code, "no_active_account")  # type: ignore for `response.data`
+
+    # Test case: Rotating refreshes consult the denylist and queue no jobs
+    def test_rotating_refresh_checks_denylist(self):
+        response = self.client.post(
+            reverse("token_obtain_pair"), self.credentials, format="json"
+        )
+        refresh = response.data["refresh"]  # type: ignore for `response.data`
+        with mock.patch.object(denylist, "is_revoked", return_value=True) as checked:
+            response = self.client.post(
+                reverse("token_refresh"), {"refresh": refresh}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        checked.assert_called_once_with(RefreshToken(refresh)["jti"])
+
+        response = self.client.post(
+            reverse("token_refresh"), {"refresh": refresh}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Job.objects.exists())
+
+    # Test case: run_jobs deletes revoked tokens once they have expired
+    def test_run_jobs_purges_expired_revoked_tokens(self):
+        denylist.revoke("expired", timezone.now() - timedelta(minutes=1))
+        denylist.revoke("current", timezone.now() + timedelta(days=1))
+        call_command("run_jobs", once=True, stdout=io.StringIO())
+        self.assertEqual(
+            list(RevokedToken.objects.values_list("jti", flat=True)), ["current"]
+        )
+
+    # Test case: The bloom filter never reports an added item as missing
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(capacity=1000, error_rate=0.01)
+        items = [f"jti-{i}" for i in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+        false_positives = sum(f"other-{i}" in bloom for i in range(1000))
+        self.assertLess(false_positives, 50)
+
+
+# Test class for the MessagePack renderer and parser
+class MessagePackAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="msgpackuser", password="testpassword"
+        )
+        self.client.force_authenticate(user=self.user)  # type: ignore for `self.client`
+        self.book = Book.objects.create(
+            title="Binary Book",
+            description="A book served as MessagePack",
+            author=self.user,
+            price=12.99,
+        )
+
+    # Test case: Content negotiation returns MessagePack with fixed-point prices
+    def test_list_renders_msgpack(self):
+        response = self.client.get(
+            reverse("book-list"), HTTP_ACCEPT="application/msgpack"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        books = msgpack.unpackb(response.content)
+        self.assertEqual(books[0]["title"], "Binary Book")
+        self.assertEqual(books[0]["price"], 1299)
+
+    # Test case: A MessagePack request body with a fixed-point price creates a book
+    def test_create_from_msgpack(self):
+        data = {
+            "title": "Packed Book",
+            "description": "Sent as MessagePack",
+            "price": 550,
+            "author": self.user.id,
+        }
+        response = self.client.post(
+            reverse("book-list"),
+            msgpack.packb(data),
+            content_type="application/msgpack",
+            HTTP_ACCEPT="application/json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["price"], "5.50")  # type: ignore for `response.data`
+
+    # Test case: Validation errors are rendered as MessagePack messages
+    def test_validation_error_renders_msgpack(self):
+        data = {
+            "title": "Packed Book",
+            "description": "Sent with an invalid price",
+            "price": "abc",
+            "author": self.user.id,
+        }
+        response = self.client.post(
+            reverse("book-list"), data, format="json", HTTP_ACCEPT="application/msgpack"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = msgpack.unpackb(response.content)
+        self.assertEqual(errors["price"], ["A valid number is required."])
+
+
+# Test class for worker start-up helpers
+class StartupTests(ShardAwareAPITestCase):
+    # Test case: Warm-up builds URL resolvers, serializers and renderers
+    # without querying the database; the indexes are built separately
+    def test_warm_up(self):
+        self.addCleanup(title_index.reset)
+        with self.assertNumQueries(0):
+            warm_up()
+        self.assertFalse(title_index.is_built)
+        build_indexes()
+        self.assertTrue(title_index.is_built)
+        response = self.client.get(reverse("book-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    # Test case: Development-only apps are installed in development mode only
+    def test_dev_apps_follow_dev_mode(self):
+        script = (
+            "from django.conf import settings; "
+            "print('django_extensions' in settings.INSTALLED_APPS, settings.DEV_MODE)"
+        )
+        for dev_mode, expected in [("1", "True True"), ("0", "False False")]:
+            result = subprocess.run(
+                [sys.executable, "-c", script],
+                cwd=settings.BASE_DIR,
+                env={
+                    **os.environ,
+                    "DJANGO_SETTINGS_MODULE": "bookstore_project.settings",
+                    "BOOKSTORE_DEV_MODE": dev_mode,
+                },
+                capture_output=True,
+                text=True,
+            )
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(result.stdout.strip(), expected)
+
+    # Test case: Import time output is parsed into self and cumulative times
+    def test_parse_importtime(self):
+        output = "\n".join(
+            [
+                "import time: self [us] | cumulative | imported package",
+                "import time:       120 |        120 |   _io",
+                "import time:      1503 |       2210 | json.decoder",
+                "import time:       707 |       2917 | json",
+                "Some unrelated warning",
+            ]
+        )
+        self.assertEqual(
+            parse_importtime(output),
+            {"_io": (120, 120), "json.decoder": (1503, 2210), "json": (707, 2917)},
+        )
+
+
+# Test class for the Django admin changelists
+class AdminChangelistTests(ShardAwareAPITestCase):
+    def setUp(self):
+        self.admin_user = get_user_model().objects.create_superuser(  # type: ignore for `get_user_model``
+            username="siteadmin", password="testpassword"
+        )
+        self.author_user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="Chewbacca",
+            password="testpassword",
+            first_name="Lowbacca",
+            author_pseudonym="Chewie",
+        )
+        for i in range(3):
+            Book.objects.create(
+                title=f"Wookiee Tales {i}",
+                description="Tales from Kashyyyk",
+                author=self.author_user,
+                price=9.99,
+            )
+        self.client.force_login(self.admin_user)
+
+    # Test case: Book search matches title and author username prefixes
+    def test_book_search_matches_prefixes(self):
+        url = reverse("admin:bookstore_app_book_changelist")
+        response = self.client.get(url, {"q": "wookiee"})
+        self.assertEqual(response.context["cl"].result_count, 3)
+        response = self.client.get(url, {"q": "chew"})
+        self.assertEqual(response.context["cl"].result_count, 3)
+        # Only prefixes match, not substrings
+        response = self.client.get(url, {"q": "tales"})
+        self.assertEqual(response.context["cl"].result_count, 0)
+
+    # Test case: User search matches pseudonym and first name prefixes
+    def test_user_search_matches_pseudonym(self):
+        url = reverse("admin:bookstore_app_customuser_changelist")
+        response = self.client.get(url, {"q": "CHEWIE"})
+        self.assertEqual(response.context["cl"].result_count, 1)
+        response = self.client.get(url, {"q": "lowb"})
+        self.assertEqual(response.context["cl"].result_count, 1)
+
+    # Test case: Counts above the threshold are estimated instead of counted
+    def test_paginator_estimates_large_counts(self):
+        with self.settings(ADMIN_EXACT_COUNT_THRESHOLD=5):
+            paginator = EstimatedCountPaginator(Book.all_objects.order_by("pk"), 2)
+            self.assertEqual(paginator.count, 3)
+        with self.settings(ADMIN_EXACT_COUNT_THRESHOLD=1):
+            paginator = EstimatedCountPaginator(Book.all_objects.order_by("pk"), 2)
+            self.assertGreaterEqual(paginator.count, 2)
+
+
+# Test class for the path routed request handler
+class PathRoutedHandlerTests(ShardAwareAPITestCase):
+    def get(self, handler, path):
+        headers = {}
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": path,
+            "SERVER_NAME": "testserver",
+            "SERVER_PORT": "80",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.url_scheme": "http",
+        }
+        response = handler(environ, lambda status, items: headers.update(items))
+        response.close()
+        return headers
+
+    # Test case: API requests skip the session, CSRF and clickjacking middleware
+    def test_api_requests_use_lean_middleware(self):
+        handler = PathRoutedWSGIHandler()
+        self.assertNotIn("X-Frame-Options", self.get(handler, "/api/"))
+        self.assertIn("X-Frame-Options", self.get(handler, "/admin/login/"))
+
+
+# Test class for the preforking server's workers
+class ServeWorkerTests(ShardAwareAPITestCase):
+    # Test case: A worker serves from the shared socket until its request limit
+    def test_worker_stops_after_max_requests(self):
+        sock = socket.create_server(("127.0.0.1", 0))
+        self.addCleanup(sock.close)
+        sock.setblocking(False)
+        worker = Worker(PathRoutedWSGIHandler(), sock, 2, request_timeout=5)
+        thread = threading.Thread(target=worker.serve)
+
+        with self.assertLogs("django.server"):
+            thread.start()
+            for _ in range(2):
+                connection = http.client.HTTPConnection(*sock.getsockname(), timeout=5)
+                connection.request(
+                    "GET",
+                    "/api/",
+                    headers={"Host": "testserver", "Accept": "application/json"},
+                )
+                response = connection.getresponse()
+                self.assertEqual(response.status, status.HTTP_200_OK)
+                self.assertIn(b"books", response.read())
+                connection.close()
+            thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(worker.served, 2)
+
+    # Test case: Worker memory is read from /proc where it exists
+    @unittest.skipUnless(os.path.exists("/proc/self/smaps_rollup"), "Needs /proc")
+    def test_memory_usage(self):
+        usage = memory_usage(os.getpid())
+        self.assertGreater(usage["rss"], 0)
+        self.assertLessEqual(usage["private"], usage["rss"])
+        self.assertIsNone(memory_usage(-1))
+
+
+# Test class for the author autocomplete endpoint
+class AuthorAutocompleteAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user(  # type: ignore for `get_user_model``
+            username="searcher", password="testpassword"
+        )
+        self.client.force_authenticate(user=self.user)  # type: ignore for `self.client`
+        self.by_username = User.objects.create_user(  # type: ignore for `get_user_model``
+            username="Lohgarra", password="testpassword"
+        )
+        self.by_pseudonym = User.objects.create_user(  # type: ignore for `get_user_model``
+            username="wookiee42",
+            password="testpassword",
+            author_pseudonym="Lohgarra of Kashyyyk",
+        )
+        self.by_full_name = User.objects.create_user(  # type: ignore for `get_user_model``
+            username="ewok_fan",
+            password="testpassword",
+            first_name="Wicket",
+            last_name="Warrick",
+        )
+
+    def autocomplete(self, **params):
+        response = self.client.get(reverse("customuser-autocomplete"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [user["username"] for user in response.data]  # type: ignore for `response.data`
+
+    # Test case: Username prefix matches rank ahead of pseudonym matches
+    def test_autocomplete_ranks_username_before_pseudonym(self):
+        self.assertEqual(self.autocomplete(q="LOHG"), ["Lohgarra", "wookiee42"])
+
+    # Test case: First name, last name and full name prefixes all match
+    def test_autocomplete_matches_names(self):
+        self.assertEqual(self.autocomplete(q="wick"), ["ewok_fan"])
+        self.assertEqual(self.autocomplete(q="warr"), ["ewok_fan"])
+        self.assertEqual(self.autocomplete(q="wicket  wa"), ["ewok_fan"])
+
+    # Test case: Results are capped by the limit parameter
+    def test_autocomplete_respects_limit(self):
+        self.assertEqual(self.autocomplete(q="lohgarra", limit=1), ["Lohgarra"])
+        self.assertEqual(self.autocomplete(q=""), [])
+
+
+# Test class for the title suggestion endpoint
+class TitleSuggestAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        self.author = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="suggestauthor", password="testpassword"
+        )
+        for title in ["Wookiee Wars", "Wookiee Ways", "Ewok Empire"]:
+            Book.objects.create(
+                title=title, description="Suggested", author=self.author, price=5.00
+            )
+        title_index.reset()
+
+    def suggest(self, **params):
+        response = self.client.get(reverse("book-suggest"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [book["title"] for book in response.data]  # type: ignore for `response.data`
+
+    # Test case: Suggestions match normalized title prefixes in order
+    def test_suggest_matches_prefix(self):
+        self.assertEqual(self.suggest(q="WOOKIEE  w"), ["Wookiee Wars", "Wookiee Ways"])
+        self.assertEqual(self.suggest(q="wookiee", limit=1), ["Wookiee Wars"])
+        self.assertEqual(self.suggest(q="ewók"), ["Ewok Empire"])
+
+    # Test case: Saved and unpublished books update a built index
+    def test_suggest_follows_book_changes(self):
+        self.suggest(q="w")
+        with self.captureOnCommitCallbacks(execute=True):
+            book = Book.objects.create(
+                title="Wookiee Wisdom", description="New", author=self.author, price=1
+            )
+        self.assertIn("Wookiee Wisdom", self.suggest(q="wookiee wi"))
+        with self.captureOnCommitCallbacks(execute=True):
+            book.unpublish()
+        self.assertEqual(self.suggest(q="wookiee wi"), [])
+
+    # Test case: Books added or removed while the index is rebuilt are kept in
+    # step with the rebuilt index
+    def test_rebuild_replays_concurrent_changes(self):
+        index = TitleIndex()
+        index.load([(1, "Alpha"), (2, "Beta")])
+
+        def rows():
+            yield 1, "Alpha"
+            # Committed by other threads while the rows are read
+            index.add(3, "Gamma")
+            index.remove(1)
+            yield 2, "Beta"
+
+        index.load(rows())
+        self.assertEqual(index.suggest("a", 10), [])
+        self.assertEqual(index.suggest("b", 10), [(2, "Beta")])
+        self.assertEqual(index.suggest("g", 10), [(3, "Gamma")])
+
+    # Test case: Removing a title with duplicates removes the right entry
+    def test_remove_duplicate_titles(self):
+        index = TitleIndex()
+        index.load([(1, "Same"), (2, "Same"), (3, "Same")])
+        index.remove(2)
+        self.assertEqual(index.suggest("same", 10), [(1, "Same"), (3, "Same")])
+
+
+# Test class for the similar books endpoint
+@override_settings(SIMILAR_BOOKS_MODEL_DIR=TEST_FILES_DIR / "similar_books")
+class SimilarBooksAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        settings.SIMILAR_BOOKS_MODEL_DIR.mkdir()
+        self.addCleanup(shutil.rmtree, settings.SIMILAR_BOOKS_MODEL_DIR)
+
+        self.author = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="similarauthor", password="testpassword"
+        )
+        self.forest = self.create_book("Forest Trees", "Wookiees climb forest trees")
+        self.trees = self.create_book("Tall Trees", "Giant trees of the forest moon")
+        self.space = self.create_book("Space Battles", "Starfighters battle in space")
+
+    def create_book(self, title, description):
+        return Book.objects.create(
+            title=title, description=description, author=self.author, price=3.00
+        )
+
+    def similar(self, book):
+        response = self.client.get(reverse("book-similar", kwargs={"pk": book.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [similar["id"] for similar in response.data]  # type: ignore for `response.data`
+
+    # Test case: The offline build stores ranked neighbours per book
+    def test_build_ranks_similar_books(self):
+        build_similar_books(top_k=2, batch_size=2)
+        self.assertEqual(self.similar(self.forest), [self.trees.pk])
+        self.assertEqual(self.similar(self.space), [])
+
+    # Test case: A new book is folded into its own and its neighbours' lists
+    def test_new_book_is_folded_in(self):
+        build_similar_books(top_k=2, batch_size=2)
+        starships = self.create_book("Space Starfighters", "Starfighters in space")
+        fold_in_book(starships.pk)
+        self.assertEqual(self.similar(starships), [self.space.pk])
+        self.assertEqual(self.similar(self.space), [starships.pk])
+
+        # Unpublished books drop out of every list
+        starships.unpublish()
+        fold_in_book(starships.pk)
+        self.assertEqual(self.similar(self.space), [])
+        self.assertFalse(SimilarBook.objects.filter(similar=starships).exists())
+
+    # Test case: Unknown books return 404
+    def test_similar_for_missing_book(self):
+        response = self.client.get(reverse("book-similar", kwargs={"pk": 999999}))
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+# Test class for view counting and trending ordering
+class TrendingAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        view_counter.flush()
+        self.author = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="trendingauthor", password="testpassword"
+        )
+        self.quiet = Book.objects.create(
+            title="Quiet Book", description="Rarely read", author=self.author, price=1
+        )
+        self.popular = Book.objects.create(
+            title="Popular Book", description="Often read", author=self.author, price=1
+        )
+
+    # Test case: Views are buffered and written in one batch
+    def test_views_are_buffered_until_flush(self):
+        with self.settings(BOOK_VIEW_FLUSH_INTERVAL=3600):
+            for _ in range(3):
+                self.client.get(reverse("book-detail", kwargs={"pk": self.popular.pk}))
+            self.client.get(reverse("book-detail", kwargs={"pk": self.quiet.pk}))
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.view_count, 0)
+
+        self.assertEqual(view_counter.flush(), 2)
+        self.popular.refresh_from_db()
+        self.quiet.refresh_from_db()
+        self.assertEqual(self.popular.view_count, 3)
+        self.assertEqual(self.quiet.view_count, 1)
+        self.assertGreater(self.popular.trending_score, self.quiet.trending_score)
+
+    # Test case: ?ordering=trending lists the most viewed books first
+    def test_ordering_by_trending(self):
+        for _ in range(2):
+            view_counter.record(self.popular.pk)
+        view_counter.flush()
+        response = self.client.get(reverse("book-list"), {"ordering": "trending"})
+        self.assertEqual(
+            [book["id"] for book in response.data],  # type: ignore for `response.data`
+            [self.popular.pk, self.quiet.pk],
+        )
+        response = self.client.get(reverse("book-list"), {"ordering": "-trending"})
+        self.assertEqual(response.data[0]["id"], self.quiet.pk)  # type: ignore for `response.data`
+
+    # Test case: Scores of views decades after the epoch stay finite and keep
+    # ranking by decayed popularity
+    def test_scores_stay_finite_long_after_epoch(self):
+        later = settings.TRENDING_EPOCH + timedelta(days=365 * 40)
+        write_views({self.popular.pk: 5, self.quiet.pk: 1}, later)
+        write_views({self.quiet.pk: 2}, later + settings.TRENDING_HALF_LIFE)
+        self.popular.refresh_from_db()
+        self.quiet.refresh_from_db()
+        self.assertTrue(math.isfinite(self.popular.trending_score))
+        # One view followed a half-life later by two more weighs 1 + 2 * 2
+        self.assertAlmostEqual(
+            self.quiet.trending_score,
+            log_view_weight(later, 5),
+            places=6,
+        )
+        self.assertAlmostEqual(
+            self.popular.trending_score, self.quiet.trending_score, places=6
+        )
+
+    # Test case: A full buffer is written by a queued job, not by the request
+    def test_due_views_are_written_by_a_job(self):
+        with self.settings(BOOK_VIEW_FLUSH_THRESHOLD=1):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.get(reverse("book-detail", kwargs={"pk": self.popular.pk}))
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.view_count, 0)
+
+        self.assertTrue(run_job(claim_jobs(1)[0]))
+        self.popular.refresh_from_db()
+        self.assertEqual(self.popular.view_count, 1)
+
+
+class CoalescingTests(ShardAwareAPITestCase):
+    # Test case: Concurrent calls with the same key run the computation once
+    def test_concurrent_calls_share_one_computation(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ["result"]
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(flight.do("k", compute))
+        )
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(flight.do("k", compute)))
+            for _ in range(4)
+        ]
+        for thread in followers:
+            thread.start()
+        while flight.stats["local_followers"] < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in [leader, *followers]:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["result"]] * 5)
+        self.assertEqual(flight.stats["leaders"], 1)
+
+    # Test case: Errors reach every waiting caller and are not cached
+    def test_errors_are_not_shared_afterwards(self):
+        flight = SingleFlight()
+
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            flight.do("k", fail)
+        self.assertEqual(flight.do("k", lambda: "ok"), "ok")
+
+    # Test case: Search terms differing only in case and spacing share a key
+    def test_list_key_normalizes_search(self):
+        author = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="coalesceauthor", password="testpassword"
+        )
+        Book.objects.create(
+            title="Shared Query", description="Test", author=author, price=1
+        )
+        response = self.client.get(reverse("book-list"), {"search": "  shared   QUERY"})
+        self.assertEqual(len(response.data), 1)  # type: ignore for `response.data`
+
+        factory = APIRequestFactory()
+        keys = {
+            BookViewSet().coalescing_key(Request(factory.get("/", params)))
+            for params in [{"search": "Shared Query"}, {"search": " shared  query "}]
+        }
+        self.assertEqual(len(keys), 1)
+
+    # Test case: Requests to another host or scheme do not share a result, as
+    # its cover image URLs are absolute
+    def test_list_key_includes_origin(self):
+        factory = APIRequestFactory()
+        requests = [
+            factory.get("/"),
+            factory.get("/", HTTP_HOST="books.example.com"),
+            factory.get("/", secure=True),
+        ]
+        with self.settings(ALLOWED_HOSTS=["testserver", "books.example.com"]):
+            keys = {
+                BookViewSet().coalescing_key(Request(request)) for request in requests
+            }
+        self.assertEqual(len(keys), 3)
+
+
+# Workers are stood in for by threads with their own SingleFlight, sharing
+# nothing but the coalescing cache. The threads use their own database
+# connections, so the cache table must not be locked by a test transaction.
+class SharedCoalescingTests(APITransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        caches[settings.COALESCE_CACHE_ALIAS].clear()
+
+    # Test case: The coalescing cache is not local to the process
+    def test_cache_backend_is_shared(self):
+        self.assertNotIsInstance(caches[settings.COALESCE_CACHE_ALIAS], LocMemCache)
+
+    # Test case: A worker waits for and reuses the result another worker
+    # computes, and the metrics of both are counted together
+    def test_workers_share_one_computation(self):
+        first_worker, second_worker = SingleFlight(), SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return ["result"]
+
+        results = []
+        leader = threading.Thread(
+            target=lambda: results.append(first_worker.do("k", compute))
+        )
+        leader.start()
+        started.wait(5)
+        # The leader finishes once the second worker is polling for its result
+        with mock.patch(
+            "bookstore_app.coalescing.time.sleep", side_effect=lambda _: release.set()
+        ):
+            follower = threading.Thread(
+                target=lambda: results.append(second_worker.do("k", compute))
+            )
+            follower.start()
+            for thread in (leader, follower):
+                thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["result"]] * 2)
+        self.assertEqual(second_worker.stats["remote_followers"], 1)
+        stats = coalescing_stats()
+        self.assertEqual(stats["leaders"], 1)
+        self.assertEqual(stats["remote_followers"], 1)
+        self.assertEqual(stats["collapsed"], 1)
+
+        out = io.StringIO()
+        call_command("coalescing_stats", stdout=out)
+        self.assertIn("remote_followers: 1", out.getvalue())
+
+
+@override_settings(PROFILE_REPORT_DIR=TEST_FILES_DIR / "profiles")
+class ProfilingTests(ShardAwareAPITestCase):
+    def setUp(self):
+        self.report_dir = settings.PROFILE_REPORT_DIR
+        self.report_dir.mkdir()
+        self.addCleanup(shutil.rmtree, self.report_dir)
+
+        self.staff = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="staffuser", password="testpassword", is_staff=True
+        )
+        self.user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="regularuser", password="testpassword"
+        )
+        Book.objects.create(
+            title="Profiled Book", description="Test", author=self.user, price=1
+        )
+
+    def get_books(self, user, profile="1"):
+        token = RefreshToken.for_user(user).access_token
+        return self.client.get(
+            reverse("book-list"),
+            {"search": "profiled"},
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+            HTTP_X_PROFILE=profile,
+        )
+
+    # Test case: Staff requests with the header get a stored report
+    def test_staff_request_is_profiled(self):
+        response = self.get_books(self.staff)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        report_id = response[REPORT_HEADER]
+
+        token = RefreshToken.for_user(self.staff).access_token
+        report = self.client.get(
+            reverse("profile-report", kwargs={"report_id": report_id}),
+            HTTP_AUTHORIZATION=f"Bearer {token}",
+        ).data
+        self.assertEqual(report["mode"], "sample")  # type: ignore for `report`
+        self.assertIn("serialize", report["phases_ms"])  # type: ignore for `report`
+        self.assertIn("render", report["phases_ms"])  # type: ignore for `report`
+        queries = report["sql"]["queries"]  # type: ignore for `report`
+        self.assertTrue(any("plan" in query for query in queries))
+
+    # Test case: The deterministic profiler also writes a .prof file
+    def test_cprofile_mode(self):
+        response = self.get_books(self.staff, profile="cprofile")
+        report_id = response[REPORT_HEADER]
+        self.assertTrue((self.report_dir / f"{report_id}.prof").exists())
+
+    # Test case: Non-staff users cannot profile requests or read reports
+    def test_non_staff_request_is_not_profiled(self):
+        response = self.get_books(self.user)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn(REPORT_HEADER, response)
+        self.assertEqual(list(self.report_dir.glob("*.json")), [])
+
+        self.client.force_authenticate(user=self.user)  # type: ignore for `self.client`
+        response = self.client.get(
+            reverse("profile-report", kwargs={"report_id": "missing"})
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    # Test case: Sampled traffic is stored without exposing the report
+    def test_sampled_requests_are_stored(self):
+        with self.settings(PROFILE_SAMPLE_RATE=1.0):
+            response = self.client.get(reverse("book-list"))
+        self.assertNotIn(REPORT_HEADER, response)
+        self.assertEqual(len(list(self.report_dir.glob("*.json"))), 1)
+
+
+# Test class for price rules and effective prices
+class PriceRuleAPITests(ShardAwareAPITestCase):
+    def setUp(self):
+        price_rules.reset()
+        self.addCleanup(price_rules.reset)
+        # Detail requests buffer book views
+        self.addCleanup(view_counter.flush)
+        self.admin_user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="priceadmin", password="testpassword", is_staff=True
+        )
+        self.author = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="priceauthor", password="testpassword"
+        )
+        self.other_author = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="otherpriceauthor", password="testpassword"
+        )
+        self.saga = Book.objects.create(
+            title="Space Saga", description="One", author=self.author, price="20.00"
+        )
+        self.guide = Book.objects.create(
+            title="Garden Guide", description="Two", author=self.author, price="10.00"
+        )
+        self.other = Book.objects.create(
+            title="Space Opera",
+            description="Three",
+            author=self.other_author,
+            price="9.99",
+        )
+        self.client.force_authenticate(user=self.admin_user)  # type: ignore for `self.client`
+
+    def create_rule(self, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("pricerule-list"),
+                {"name": "Sale", "kind": "percent", **fields},
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data["id"]  # type: ignore for `response.data`
+
+    def effective_price(self, book):
+        response = self.client.get(reverse("book-detail", kwargs={"pk": book.pk}))
+        return response.data["effective_price"]  # type: ignore for `response.data`
+
+    # Test case: Active rules lower the effective price, the lowest one wins
+    def test_effective_price_uses_best_active_rule(self):
+        self.create_rule(amount="10", author=self.author.pk)
+        self.create_rule(kind="fixed", amount="5", title_contains="space")
+        self.create_rule(
+            amount="50",
+            book_ids=[self.guide.pk],
+            starts_at=(timezone.now() + timedelta(days=1)).isoformat(),
+        )
+
+        self.assertEqual(self.effective_price(self.saga), "15.00")
+        self.assertEqual(self.effective_price(self.guide), "9.00")
+        self.assertEqual(self.effective_price(self.other), "4.99")
+        # The stored prices are unchanged
+        self.assertEqual(self.saga.price, "20.00")
+        self.saga.refresh_from_db()
+        self.assertEqual(self.saga.price, Decimal("20.00"))
+
+    # Test case: Effective prices are read from the index without queries
+    def test_effective_price_needs_no_queries(self):
+        self.create_rule(amount="25", title_contains="opera")
+        price_rules.ensure_current()
+        book = Book.objects.get(pk=self.other.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(price_rules.effective_price(book), Decimal("7.49"))
+
+    # Test case: Books created or renamed after the index was built match
+    # title rules at once, as when another process made the change
+    def test_title_rule_follows_new_and_renamed_books(self):
+        self.create_rule(amount="50", title_contains="space")
+        price_rules.ensure_current()
+        Book.objects.filter(pk=self.guide.pk).update(title="Space Garden")
+        Book.objects.filter(pk=self.saga.pk).update(title="Saga")
+        renamed = Book.objects.get(pk=self.guide.pk)
+        no_longer_matching = Book.objects.get(pk=self.saga.pk)
+        new_book = Book(title="Lost in Space", author=self.author, price="8.00")
+        with self.assertNumQueries(0):
+            self.assertEqual(price_rules.effective_price(renamed), Decimal("5.00"))
+            self.assertEqual(
+                price_rules.effective_price(no_longer_matching), Decimal("20.00")
+            )
+            self.assertEqual(price_rules.effective_price(new_book), Decimal("4.00"))
+
+    # Test case: Scheduled and expired rules cannot be applied
+    def test_inactive_rule_cannot_be_applied(self):
+        rule_id = self.create_rule(
+            amount="50", starts_at=(timezone.now() + timedelta(days=1)).isoformat()
+        )
+        response = self.client.post(reverse("pricerule-apply", kwargs={"pk": rule_id}))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.saga.refresh_from_db()
+        self.assertEqual(self.saga.price, Decimal("20.00"))
+        with self.assertRaises(ValueError):
+            apply_price_rule(PriceRule.objects.get(pk=rule_id))
+
+    # Test case: Applying a rule updates the stored prices once
+    def test_apply_rule_updates_stored_prices(self):
+        rule_id = self.create_rule(amount="10", author=self.author.pk)
+        url = reverse("pricerule-apply", kwargs={"pk": rule_id})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"updated": 2})  # type: ignore for `response.data`
+        self.assertEqual(
+            sorted(Book.objects.values_list("price", flat=True)),
+            [Decimal("9.00"), Decimal("9.99"), Decimal("18.00")],
+        )
+        # Applied rules no longer discount the new stored price
+        self.assertEqual(self.effective_price(self.saga), "18.00")
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    # Test case: Percentages of whole prices keep their cents
+    def test_apply_percent_rule_to_whole_prices(self):
+        Book.objects.filter(pk=self.guide.pk).update(price="9.00")
+        Book.objects.filter(pk=self.saga.pk).update(price="15.00")
+        rule_id = self.create_rule(amount="50", author=self.author.pk)
+        response = self.client.post(reverse("pricerule-apply", kwargs={"pk": rule_id}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.guide.refresh_from_db()
+        self.saga.refresh_from_db()
+        self.assertEqual(self.guide.price, Decimal("4.50"))
+        self.assertEqual(self.saga.price, Decimal("7.50"))
+
+    # Test case: A rule applied through a stale copy discounts the prices once
+    def test_stale_rule_is_applied_once(self):
+        rule_id = self.create_rule(amount="10", author=self.author.pk)
+        first = PriceRule.objects.get(pk=rule_id)
+        second = PriceRule.objects.get(pk=rule_id)
+        self.assertEqual(apply_price_rule(first), 2)
+        self.assertIsNone(apply_price_rule(second))
+        self.saga.refresh_from_db()
+        self.assertEqual(self.saga.price, Decimal("18.00"))
+        self.assertIsNotNone(PriceRule.objects.get(pk=rule_id).applied_at)
+
+    # Test case: Fixed discounts never take a price below zero
+    def test_apply_fixed_rule_stops_at_zero(self):
+        rule_id = self.create_rule(
+            kind="fixed", amount="15", book_ids=[self.guide.pk, self.other.pk]
+        )
+        self.client.post(reverse("pricerule-apply", kwargs={"pk": rule_id}))
+        self.guide.refresh_from_db()
+        self.assertEqual(self.guide.price, Decimal("0.00"))
+
+    # Test case: Invalid rules and non-admin users are rejected
+    def test_rule_validation_and_permissions(self):
+        response = self.client.post(
+            reverse("pricerule-list"),
+            {"name": "Too much", "kind": "percent", "amount": "150"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.client.force_authenticate(user=self.author)  # type: ignore for `self.client`
+        response = self.client.get(reverse("pricerule-list"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+# Test class for the read-model list and export path
+class ReadModelTests(ShardAwareAPITestCase):
+    def setUp(self):
+        price_rules.reset()
+        self.addCleanup(price_rules.reset)
+        self.admin_user = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="readmodeladmin", password="testpassword", is_staff=True
+        )
+        pen_name = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="penname", password="testpassword", author_pseudonym="Pen Name"
+        )
+        full_name = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="fullname",
+            password="testpassword",
+            first_name="Chris",
+            last_name="Paul",
+        )
+        Book.objects.create(
+            title="Covered",
+            description="One",
+            author=pen_name,
+            price="12.50",
+            cover_image="book_covers/covered.png",
+        )
+        Book.objects.create(
+            title="Plain", description="Two", author=full_name, price="3.00"
+        )
+        Book.objects.create(
+            title="Third", description="Three", author=self.admin_user, price="7.25"
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            PriceRule.objects.create(name="Sale", amount="10", author=full_name)
+
+    # Test case: Records serialize exactly like model instances
+    def test_records_match_serializer_output(self):
+        request = Request(APIRequestFactory().get("/api/books/"))
+        serializer = BookSerializer(context={"request": request})
+        read_model = ReadModel(serializer)
+        queryset = Book.objects.order_by("pk")
+        expected = BookSerializer(
+            queryset, many=True, context={"request": request}
+        ).data
+        with self.assertNumQueries(1):
+            data = read_model.to_representation(read_model.records(queryset))
+        self.assertEqual(data, [dict(book) for book in expected])
+        self.assertEqual(
+            data[0]["cover_image"], "http://testserver/media/book_covers/covered.png"
+        )
+        self.assertEqual(data[0]["author_displayed_name"], "Pen Name")
+        self.assertEqual(data[1]["effective_price"], "2.70")
+
+    # Test case: The list endpoint reads every book with one query. Coalescing
+    # goes through a local cache, as the shared one is a database table.
+    @override_settings(COALESCE_CACHE_ALIAS="default")
+    def test_list_uses_single_query(self):
+        price_rules.ensure_current()
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse("book-list"), {"ordering": "-price"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [book["title"] for book in response.data],  # type: ignore for `response.data`
+            ["Covered", "Third", "Plain"],
+        )
+
+    # Test case: Admins export the catalogue as newline-delimited JSON
+    def test_export_streams_ndjson(self):
+        self.client.force_authenticate(user=self.admin_user)  # type: ignore for `self.client`
+        with self.settings(BOOK_EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(reverse("book-export"))
+            lines = b"".join(response.streaming_content).decode().splitlines()  # type: ignore for `response.streaming_content`
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [json.loads(line)["title"] for line in lines], ["Covered", "Plain", "Third"]
+        )
+
+        self.client.force_authenticate(user=None)  # type: ignore for `self.client`
+        response = self.client.get(reverse("book-export"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+@override_settings(MEDIA_ROOT=str(TEST_FILES_DIR / "import" / "media"))
+class ImportBooksCommandTests(ShardAwareAPITestCase):
+    def setUp(self):
+        self.work_dir = TEST_FILES_DIR / "import"
+        self.work_dir.mkdir()
+        self.addCleanup(shutil.rmtree, self.work_dir)
+
+        self.existing = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="existingauthor", password="testpassword"
+        )
+        covers_dir = self.work_dir / "covers"
+        covers_dir.mkdir()
+        Image.new("RGB", (1200, 600)).save(covers_dir / "wide.png")
+        self.source = self.work_dir / "books.csv"
+        with open(self.source, "w", newline="") as source:
+            writer = csv.writer(source)
+            writer.writerow(
+                ["title", "description", "price", "author", "author_pseudonym", "cover"]
+            )
+            writer.writerow(["First", "One", "1.50", "existingauthor", "", "wide.png"])
+            writer.writerow(["Second", "Two", "2.50", "newauthor", "Pen Name", ""])
+            writer.writerow(["Broken", "No price", "", "newauthor", "", ""])
+            writer.writerow(["Third", "Three", "3.50", "newauthor", "", ""])
+
+    def run_import(self, *args):
+        call_command(
+            "import_books",
+            str(self.source),
+            "--covers-dir",
+            str(self.work_dir / "covers"),
+            "--batch-size",
+            "2",
+            "--workers",
+            "1",
+            *args,
+            stdout=io.StringIO(),
+            stderr=io.StringIO(),
+        )
+
+    # Test case: Rows are imported in batches with new authors and resized covers
+    def test_import_creates_books_authors_and_covers(self):
+        self.run_import()
+        self.assertEqual(
+            sorted(Book.objects.values_list("title", flat=True)),
+            ["First", "Second", "Third"],
+        )
+        new_author = get_user_model().objects.get(username="newauthor")
+        self.assertEqual(new_author.author_pseudonym, "Pen Name")
+        self.assertFalse(new_author.has_usable_password())
+        cover = Book.objects.get(title="First").cover_image
+        with Image.open(cover.path) as image:
+            self.assertLessEqual(image.width, settings.BOOK_COVER_MAX_SIZE[0])
+
+    # Test case: A second run resumes after the recorded rows
+    def test_import_resumes_after_recorded_rows(self):
+        self.run_import()
+        with open(f"{self.source}.import-state.json") as state_file:
+            state = json.load(state_file)
+        self.assertEqual(state["rows"], 4)
+
+        Book.all_objects.filter(title="Third").delete()
+        state["rows"] = 2
+        with open(f"{self.source}.import-state.json", "w") as state_file:
+            json.dump(state, state_file)
+        self.run_import()
+        self.assertEqual(Book.objects.count(), 3)
+
+    # Test case: Covers of a batch whose insert fails are deleted
+    def test_failed_batch_deletes_its_covers(self):
+        with mock.patch.object(
+            Book.all_objects, "bulk_create", side_effect=DatabaseError
+        ):
+            with self.assertRaises(DatabaseError):
+                self.run_import()
+        self.assertEqual(list((self.work_dir / "media" / "book_covers").iterdir()), [])
+
+    # Test case: Covers stored for a batch that was never inserted are deleted
+    # when the import resumes
+    def test_resume_deletes_orphan_covers(self):
+        orphan = default_storage.save("book_covers/orphan.png", ContentFile(b"cover"))
+        source_stat = self.source.stat()
+        with open(f"{self.source}.import-state.json", "w") as state_file:
+            json.dump(
+                {
+                    "size": source_stat.st_size,
+                    "mtime": int(source_stat.st_mtime),
+                    "rows": 0,
+                    "covers": [orphan],
+                },
+                state_file,
+            )
+        self.run_import()
+        self.assertFalse(default_storage.exists(orphan))
+        cover = Book.objects.get(title="First").cover_image
+        self.assertEqual(
+            list((self.work_dir / "media" / "book_covers").iterdir()),
+            [Path(cover.path)],
+        )
+
+
+class ShardMergeTests(unittest.TestCase):
+    # Test case: Rows from several shards merge in mixed-direction order
+    def test_merge_key_orders_by_several_fields(self):
+        rows = [(2, "b"), (1, "a"), (2, "a"), (None, "c")]
+        key = merge_key([(lambda row: row[0], True), (lambda row: row[1], False)])
+        self.assertEqual(
+            sorted(rows, key=key), [(2, "a"), (2, "b"), (1, "a"), (None, "c")]
+        )
+
+
+# The shard databases are configured at startup, so the sharding tests run in
+# a separate process with books on two SQLite shards
+@unittest.skipIf(settings.BOOK_SHARD_DATABASES, "Book sharding is enabled")
+class ShardedProcessTests(unittest.TestCase):
+    # Test case: The sharding tests pass with books on two shards
+    def test_sharding_tests_pass_on_two_shards(self):
+        result = subprocess.run(
+            [sys.executable, "manage.py", "test", f"{__name__}.BookShardingTests"],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, "BOOKSTORE_BOOK_SHARDS": "2"},
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertNotIn("skipped", result.stderr)
+
+
+# Also run on their own with BOOKSTORE_BOOK_SHARDS=2
+@unittest.skipUnless(
+    len(settings.BOOK_SHARD_DATABASES) >= 2, "Book sharding is not enabled"
+)
+class BookShardingTests(APITransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        shard_directory.reset()
+        self.first_shard, self.second_shard = settings.BOOK_SHARD_DATABASES[:2]
+        self.alice = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="alice", password="testpassword"
+        )
+        self.bob = get_user_model().objects.create_user(  # type: ignore for `get_user_model``
+            username="bob", password="testpassword"
+        )
+        shard_directory.move(self.alice.pk, self.first_shard)
+        shard_directory.move(self.bob.pk, self.second_shard)
+
+    def tearDown(self):
+        view_counter.flush()
+
+    def create_book(self, author, title, price):
+        self.client.force_authenticate(user=author)  # type: ignore for `self.client`
+        response = self.client.post(
+            reverse("book-list"),
+            {
+                "title": title,
+                "description": "Test",
+                "author": author.pk,
+                "price": price,
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data["id"]  # type: ignore for `response.data`
+
+    def stored_ids(self, alias):
+        return set(Book.all_objects.using(alias).values_list("pk", flat=True))
+
+    # Test case: Books are created on their author's shard with global ids
+    def test_books_are_stored_on_author_shard(self):
+        alice_book = self.create_book(self.alice, "Alice One", "5.00")
+        bob_book = self.create_book(self.bob, "Bob One", "7.00")
+        self.assertNotEqual(alice_book, bob_book)
+        self.assertEqual(self.stored_ids(self.first_shard), {alice_book})
+        self.assertEqual(self.stored_ids(self.second_shard), {bob_book})
+
+    # Test case: Listing and searching merge the ordered results of all shards
+    def test_list_merges_shards_in_order(self):
+        for author, title, price in [
+            (self.alice, "Alice Cheap", "1.00"),
+            (self.bob, "Bob Middle", "2.00"),
+            (self.alice, "Alice Dear", "3.00"),
+            (self.bob, "Bob Dearest", "4.00"),
+        ]:
+            self.create_book(author, title, price)
+        self.client.force_authenticate(user=None)  # type: ignore for `self.client`
+
+        response = self.client.get(reverse("book-list"), {"ordering": "-price"})
+        self.assertEqual(
+            [Decimal(book["price"]) for book in response.data],  # type: ignore for `response.data`
+            [Decimal("4.00"), Decimal("3.00"), Decimal("2.00"), Decimal("1.00")],
+        )
+        response = self.client.get(reverse("book-list"), {"search": "bob"})
+        self.assertEqual(
+            {book["title"] for book in response.data},  # type: ignore for `response.data`
+            {"Bob Middle", "Bob Dearest"},
+        )
+
+    # Test case: Books are found and deleted on their shard by id
+    def test_retrieve_and_delete_by_author(self):
+        bob_book = self.create_book(self.bob, "Bob One", "7.00")
+        response = self.client.get(reverse("book-detail", kwargs={"pk": bob_book}))
+        self.assertEqual(response.data["title"], "Bob One")  # type: ignore for `response.data`
+
+        self.client.force_authenticate(user=self.alice)  # type: ignore for `self.client`
+        response = self.client.delete(reverse("book-detail", kwargs={"pk": bob_book}))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_authenticate(user=self.bob)  # type: ignore for `self.client`
+        response = self.client.delete(reverse("book-detail", kwargs={"pk": bob_book}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Book.objects.filter(pk=bob_book).exists())
+
+    # Test case: Rebalancing moves an author's books to another shard
+    def test_rebalance_moves_author(self):
+        alice_books = {
+            self.create_book(self.alice, f"Alice {number}", "1.00")
+            for number in range(3)
+        }
+        call_command(
+            "rebalance_book_shards",
+            author=[self.alice.pk],
+            to=self.second_shard,
+            grace=0,
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(self.stored_ids(self.first_shard), set())
+        self.assertEqual(self.stored_ids(self.second_shard), alice_books)
+        self.assertEqual(shard_directory.shard_for(self.alice.pk), self.second_shard)
+        self.create_book(self.alice, "Alice Later", "1.00")
+        self.assertEqual(len(self.stored_ids(self.second_shard)), 4)
+
+    # Test case: Deleting a user deletes their books from their shard
+    def test_user_delete_removes_books_from_shard(self):
+        self.create_book(self.bob, "Bob One", "7.00")
+        self.bob.delete()
+        self.assertEqual(self.stored_ids(self.second_shard), set())
+
+    # Test case: Books of an author being moved are listed once, and writes
+    # made during the move are kept unless the book changed on both shards
+    def test_move_keeps_writes_made_during_move(self):
+        saved, stale, conflicting = [
+            self.create_book(self.alice, f"Alice {number}", "1.00")
+            for number in range(3)
+        ]
+        loaded = []
+
+        # Called once every process knows the author is moving, and again
+        # once the books are copied and the directory is switched
+        def wait(seconds):
+            if not loaded:
+                loaded.append(Book.objects.get(pk=saved))
+                return
+            response = self.client.get(reverse("book-list"))
+            self.assertCountEqual(
+                [book["id"] for book in response.data],  # type: ignore for `response.data`
+                [saved, stale, conflicting],
+            )
+            self.assertEqual(Book.objects.filter(author=self.alice).count(), 3)
+            loaded[0].title = "Saved during the move"
+            loaded[0].save()
+            Book.all_objects.using(self.first_shard).filter(
+                pk__in=[stale, conflicting]
+            ).update(title="Old shard")
+            Book.all_objects.using(self.second_shard).filter(pk=conflicting).update(
+                title="New shard"
+            )
+
+        with mock.patch("bookstore_app.sharding.time.sleep", side_effect=wait):
+            with self.assertLogs("bookstore_app.sharding", "WARNING"):
+                move_author(self.alice.pk, self.second_shard, grace=0)
+
+        self.assertEqual(self.stored_ids(self.first_shard), set())
+        self.assertEqual(
+            dict(Book.all_objects.using(self.second_shard).values_list("pk", "title")),
+            {
+                saved: "Saved during the move",
+                stale: "Old shard",
+                conflicting: "New shard",
+            },
+        )
+        self.assertIsNone(shard_directory.moving_from(self.alice.pk))
@@ -0,0 +1,177 @@
+import bisect
+import logging
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+# Case-fold, strip accents and collapse whitespace
+def normalize_title(title):
+    decomposed = unicodedata.normalize("NFKD", title)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(stripped.casefold().split())
+
+
+# Sort key for a title; titles that are already normalized share the key object
+def _entry(book_id, title):
+    key = normalize_title(title)
+    return key, book_id, key if key == title else title
+
+
+# Process-local index of published book titles for prefix suggestions.
+# Normalized titles are kept in a sorted list with parallel book ids and
+# display titles, so a lookup is one binary search plus a short scan.
+class TitleIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []
+        self._ids = array("q")
+        self._titles = []
+        self._key_by_id = {}
+        self._built_at = None
+        self._rebuilding = False
+        # Changes made while rows are loaded, as (book id, title or None)
+        self._pending = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    # Whether book changes must be passed to the index: once it is built, and
+    # while it is being loaded
+    @property
+    def tracks_changes(self):
+        return self._built_at is not None or self._pending is not None
+
+    # Replace the index with `rows`. Books added or removed while the rows are
+    # read, such as during a background rebuild, may be missing from them, so
+    # those changes are replayed onto the new index.
+    def load(self, rows):
+        with self._lock:
+            self._pending = []
+        try:
+            entries = sorted(_entry(book_id, title) for book_id, title in rows)
+            with self._lock:
+                self._keys = [key for key, _, _ in entries]
+                self._ids = array("q", (book_id for _, book_id, _ in entries))
+                self._titles = [title for _, _, title in entries]
+                self._key_by_id = {book_id: key for key, book_id, _ in entries}
+                for book_id, title in self._pending:
+                    if title is None:
+                        self._delete(book_id)
+                    else:
+                        self._insert(book_id, title)
+                self._built_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def reset(self):
+        with self._lock:
+            self.load([])
+            self._built_at = None
+
+    def build(self):
+        from .models import Book
+
+        rows = Book.objects.values_list("id", "title").iterator(chunk_size=10_000)
+        self.load(rows)
+        logger.info("Built title index with %d titles", len(self))
+
+    # Build on first use; afterwards rebuild in the background once the index is
+    # older than TITLE_SUGGEST_REBUILD_INTERVAL to pick up other processes' writes
+    def ensure_built(self):
+        if not self.is_built:
+            with self._lock:
+                if not self.is_built:
+                    self.build()
+            return
+        age = time.monotonic() - self._built_at
+        if age > settings.TITLE_SUGGEST_REBUILD_INTERVAL and not self._rebuilding:
+            self._rebuilding = True
+            threading.Thread(target=self._rebuild_in_background, daemon=True).start()
+
+    def _rebuild_in_background(self):
+        try:
+            self.build()
+        finally:
+            self._rebuilding = False
+            connection.close()
+
+    def add(self, book_id, title):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((book_id, title))
+            self._insert(book_id, title)
+
+    def remove(self, book_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((book_id, None))
+            self._delete(book_id)
+
+    def _insert(self, book_id, title):
+        self._delete(book_id)
+        key, _, title = _entry(book_id, title)
+        position = bisect.bisect_left(self._keys, key)
+        self._keys.insert(position, key)
+        self._ids.insert(position, book_id)
+        self._titles.insert(position, title)
+        self._key_by_id[book_id] = key
+
+    def _delete(self, book_id):
+        key = self._key_by_id.pop(book_id, None)
+        if key is None:
+            return
+        position = bisect.bisect_left(self._keys, key)
+        while self._ids[position] != book_id:
+            position += 1
+        del self._keys[position]
+        del self._ids[position]
+        del self._titles[position]
+
+    # Return up to `limit` (id, title) pairs whose normalized title starts with
+    # the normalized prefix, in alphabetical order
+    def suggest(self, prefix, limit):
+        prefix = normalize_title(prefix)
+        if not prefix:
+            return []
+        with self._lock:
+            position = bisect.bisect_left(self._keys, prefix)
+            end = min(position + limit, len(self._keys))
+            results = []
+            while position < end and self._keys[position].startswith(prefix):
+                results.append((self._ids[position], self._titles[position]))
+                position += 1
+            return results
+
+    # Approximate memory held by the index, in bytes
+    def memory_usage(self):
+        with self._lock:
+            return (
+                sys.getsizeof(self._keys)
+                + sum(sys.getsizeof(key) for key in self._keys)
+                + sys.getsizeof(self._ids)
+                + sys.getsizeof(self._titles)
+                # Titles equal to their normalized key are stored once
+                + sum(
+                    sys.getsizeof(title)
+                    for key, title in zip(self._keys, self._titles)
+                    if title is not key
+                )
+                + sys.getsizeof(self._key_by_id)
+                + sum(sys.getsizeof(book_id) for book_id in self._key_by_id)
+            )
+
+
+title_index = TitleIndex()
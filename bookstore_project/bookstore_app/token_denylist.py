@@ -0,0 +1,116 @@
+import hashlib
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import RevokedToken
+
+
+# Fixed-size bloom filter; membership tests may return false positives but
+# never false negatives
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        # Double hashing derives all positions from a single digest
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+
+# Store of revoked refresh tokens, fronted by a per-process bloom filter.
+# Most lookups are for tokens that were never revoked, and those are answered
+# from memory without a database query. Revocations made by other processes
+# are picked up every TOKEN_DENYLIST_SYNC_INTERVAL seconds, so `is_revoked`
+# may miss a token revoked elsewhere within that time. Checks that must not,
+# such as the single use of a rotated refresh token, go through `revoke`.
+class TokenDenylist:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bloom = None
+        self._last_pk = 0
+        self._synced_at = 0.0
+
+    def _new_bloom(self):
+        return BloomFilter(
+            settings.TOKEN_DENYLIST_BLOOM_CAPACITY,
+            settings.TOKEN_DENYLIST_BLOOM_ERROR_RATE,
+        )
+
+    def _sync(self):
+        now = time.monotonic()
+        if (
+            self._bloom is not None
+            and now - self._synced_at < settings.TOKEN_DENYLIST_SYNC_INTERVAL
+        ):
+            return
+        with self._lock:
+            # Rebuild once the filter is over capacity, dropping expired tokens
+            if self._bloom is None or self._bloom.count > self._bloom.capacity:
+                self._bloom = self._new_bloom()
+                self._last_pk = 0
+            revoked = RevokedToken.objects.filter(
+                pk__gt=self._last_pk, expires_at__gt=timezone.now()
+            ).values_list("pk", "jti")
+            for pk, jti in revoked.iterator():
+                self._bloom.add(jti)
+                self._last_pk = max(self._last_pk, pk)
+            self._synced_at = now
+
+    def is_revoked(self, jti):
+        self._sync()
+        if jti not in self._bloom:
+            return False
+        return RevokedToken.objects.filter(jti=jti).exists()
+
+    # Record the revocation of a token. Returns False when the token was
+    # already revoked, by this process or any other, as the unique `jti`
+    # column lets only one insert succeed.
+    def revoke(self, jti, expires_at):
+        try:
+            with transaction.atomic():
+                RevokedToken.objects.create(jti=jti, expires_at=expires_at)
+        except IntegrityError:
+            return False
+        self._sync()
+        self._bloom.add(jti)
+        return True
+
+    # Delete revoked tokens that have expired anyway. Their bits stay in the
+    # bloom filters until the next rebuild and only cost a query when checked.
+    def purge_expired(self):
+        deleted, _ = RevokedToken.objects.filter(
+            expires_at__lte=timezone.now()
+        ).delete()
+        return deleted
+
+    def reset(self):
+        with self._lock:
+            self._bloom = None
+            self._last_pk = 0
+            self._synced_at = 0.0
+
+
+denylist = TokenDenylist()
@@ -1,16 +1,30 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
-from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
+from rest_framework_simplejwt.views import TokenObtainPairView
 
-from .views import BookViewSet, UserViewSet
+from .views import (
+    BookViewSet,
+    DenylistTokenRefreshView,
+    PriceRuleViewSet,
+    ProfileReportView,
+    UserViewSet,
+)
 
 router = DefaultRouter()
 router.register(r"users", UserViewSet)
 router.register(r"books", BookViewSet)
+router.register(r"price-rules", PriceRuleViewSet)
 
 # Implementation of JWT token authentication
 urlpatterns = [
     path("", include(router.urls)),
     path("api/token/", TokenObtainPairView.as_view(), name="token_obtain_pair"),
-    path("api/token/refresh/", TokenRefreshView.as_view(), name="token_refresh"),
+    path(
+        "api/token/refresh/", DenylistTokenRefreshView.as_view(), name="token_refresh"
+    ),
+    path(
+        "profiles/<str:report_id>/",
+        ProfileReportView.as_view(),
+        name="profile-report",
+    ),
 ]
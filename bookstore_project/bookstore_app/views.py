@@ -1,43 +1,169 @@
+import hashlib
+import json
+import operator
+from functools import reduce
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from rest_framework import filters, permissions, viewsets
+from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import filters, permissions, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.serializer_helpers import ReturnList
+from rest_framework.views import APIView
+from rest_framework_simplejwt.views import TokenRefreshView
 
-from .models import Book
+from .coalescing import single_flight
+from .jobs import enqueue
+from .models import Book, PriceRule, SimilarBook
 from .permissions import IsAdmin, IsAuthor, IsNotBanned
-from .serializers import BookSerializer, UserSerializer
+from .popularity import view_counter
+from .pricing import apply_price_rule
+from .profiling import ProfiledViewMixin, load_report, phase
+from .read_models import ReadModel
+from .search import autocomplete_authors
+from .serializers import (
+    BookSerializer,
+    DenylistTokenRefreshSerializer,
+    PriceRuleSerializer,
+    UserSerializer,
+)
+from .sharding import stored_together
+from .title_index import title_index
 
 User = get_user_model()
 
 
+# Read the `limit` query parameter of typeahead endpoints
+def parse_limit(request):
+    try:
+        limit = int(
+            request.query_params.get("limit", settings.AUTOCOMPLETE_DEFAULT_LIMIT)
+        )
+    except ValueError:
+        limit = settings.AUTOCOMPLETE_DEFAULT_LIMIT
+    return max(1, min(limit, settings.AUTOCOMPLETE_MAX_LIMIT))
+
+
+# Ordering filter that also accepts aliases such as ?ordering=trending
+class BookOrderingFilter(filters.OrderingFilter):
+    ordering_aliases = {"trending": "-trending_score"}
+
+    def get_ordering(self, request, queryset, view):
+        params = request.query_params.get(self.ordering_param)
+        if params:
+            fields = [self.resolve_alias(param.strip()) for param in params.split(",")]
+            ordering = self.remove_invalid_fields(queryset, fields, view, request)
+            if ordering:
+                return ordering
+        return self.get_default_ordering(view)
+
+    def resolve_alias(self, field):
+        descending = field.startswith("-")
+        alias = self.ordering_aliases.get(field.lstrip("-"))
+        if alias is None:
+            return field
+        # "-trending" reverses the direction of the aliased ordering
+        if descending:
+            return alias[1:] if alias.startswith("-") else f"-{alias}"
+        return alias
+
+
+# Search filter that also works when the models behind a related search field,
+# such as the authors of sharded books, are stored in another database. Those
+# fields are searched on their own database and matched by primary key.
+class CrossDatabaseSearchFilter(filters.SearchFilter):
+    def filter_queryset(self, request, queryset, view):
+        search_fields = self.get_search_fields(view, request)
+        search_terms = self.get_search_terms(request)
+        if not search_fields or not search_terms:
+            return queryset
+
+        remote_fields = {}
+        for search_field in search_fields:
+            prefix = search_field[0] if search_field[0] in self.lookup_prefixes else ""
+            relation, _, remote_field = search_field[len(prefix) :].partition("__")
+            if not remote_field:
+                continue
+            related_model = queryset.model._meta.get_field(relation).related_model
+            if not stored_together(queryset.model, related_model):
+                remote_fields[search_field] = (
+                    relation,
+                    related_model,
+                    prefix + remote_field,
+                )
+        if not remote_fields:
+            return super().filter_queryset(request, queryset, view)
+
+        conditions = []
+        for term in search_terms:
+            condition = Q()
+            for search_field in search_fields:
+                if search_field not in remote_fields:
+                    lookup = self.construct_search(str(search_field), queryset)
+                    condition |= Q(**{lookup: term})
+                    continue
+                relation, related_model, remote_field = remote_fields[search_field]
+                related = related_model._base_manager.all()
+                lookup = self.construct_search(remote_field, related)
+                matches = related.filter(**{lookup: term}).values_list("pk", flat=True)
+                condition |= Q(**{f"{relation}__in": list(matches)})
+            conditions.append(condition)
+        return queryset.filter(reduce(operator.and_, conditions))
+
+
 # A viewset for viewing and editing user instances.
 # Restricted to authenticated users only.
-class UserViewSet(viewsets.ModelViewSet):
+class UserViewSet(ProfiledViewMixin, viewsets.ModelViewSet):
 
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    # Deactivate the user right away and purge their books in the background
+    def perform_destroy(self, instance):
+        instance.is_active = False
+        instance.save(update_fields=["is_active"])
+        enqueue(
+            "users.purge",
+            {"user_id": instance.pk},
+            idempotency_key=f"users.purge:{instance.pk}",
+        )
+
+    # Ranked prefix matches on username, pseudonym and full name for typeahead
+    @action(detail=False, methods=["get"])
+    def autocomplete(self, request):
+        limit = parse_limit(request)
+        users = autocomplete_authors(request.query_params.get("q", ""), limit)
+        serializer = self.get_serializer(users, many=True)
+        return Response(serializer.data)
+
 
 # A viewset for viewing books. Allows unrestricted GET operations.
 # Restricts POST, PUT, DELETE to authenticated users.
-class BookViewSet(viewsets.ModelViewSet):
+class BookViewSet(ProfiledViewMixin, viewsets.ModelViewSet):
 
     queryset = Book.objects.all()
     serializer_class = BookSerializer
 
-    # Allows dynamic filtering based on query parameters
-    filter_backends = [filters.SearchFilter]
+    # Allows dynamic filtering and ordering based on query parameters
+    filter_backends = [CrossDatabaseSearchFilter, BookOrderingFilter]
     search_fields = ["title", "description", "author__username", "price"]
+    ordering_fields = ["title", "price", "trending_score"]
 
     # Define custom permissions for the BookViewSet
     def get_permissions(self):
         # Allow unrestricted GET operations
-        if self.action in ["list", "retrieve"]:
+        if self.action in ["list", "retrieve", "suggest", "similar"]:
             permission_classes = [permissions.AllowAny]
         # Allow only authenticated users and authors to perform POST operations
         elif self.action == "create":
             permission_classes = [permissions.IsAuthenticated, IsNotBanned, IsAuthor]
-        # Allow only admins to perform PUT operations
-        elif self.action in ["update", "partial_update"]:
+        # Allow only admins to perform PUT operations and export the catalogue
+        elif self.action in ["update", "partial_update", "export"]:
             permission_classes = [IsNotBanned, IsAdmin]
         # Allow only admins and authors of own book to perform DELETE operations
         elif self.action == "destroy":
@@ -46,6 +172,176 @@ class BookViewSet(viewsets.ModelViewSet):
             permission_classes = [permissions.IsAuthenticated]
         return [permission() for permission in permission_classes]
 
+    # Concurrent identical list and search requests share one query and
+    # serialization. Rows are read as lightweight records rather than model
+    # instances.
+    def list(self, request, *args, **kwargs):
+        if self.paginator is not None:
+            return super().list(request, *args, **kwargs)
+
+        def serialize():
+            queryset = self.filter_queryset(self.get_queryset())
+            read_model = ReadModel(self.get_serializer())
+            with phase("serialize"):
+                return read_model.to_representation(read_model.records(queryset))
+
+        data = single_flight.do(self.coalescing_key(request), serialize)
+        # Results shared through the cache lose their serializer reference
+        if not isinstance(data, ReturnList):
+            data = ReturnList(data, serializer=self.get_serializer(many=True))
+        return Response(data)
+
+    # Key of the list result for the query parameters that affect it. The
+    # result is shared before rendering, so the renderer is not part of the key.
+    # File URLs in the result are absolute, built from the scheme and host of
+    # the request, so requests to another host get their own result.
+    def coalescing_key(self, request):
+        params = {
+            "origin": f"{request.scheme}://{request.get_host()}",
+            "search": " ".join(
+                request.query_params.get(api_settings.SEARCH_PARAM, "").split()
+            ).casefold(),
+            "ordering": request.query_params.get(
+                api_settings.ORDERING_PARAM, ""
+            ).replace(" ", ""),
+        }
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+        return f"books:list:{digest.hexdigest()}"
+
+    # The filtered catalogue as newline-delimited JSON, in the list
+    # representation, streamed in chunks of BOOK_EXPORT_CHUNK_SIZE rows
+    @action(detail=False, methods=["get"])
+    def export(self, request):
+        queryset = self.filter_queryset(self.get_queryset())
+        if not queryset.query.order_by:
+            queryset = queryset.order_by("pk")
+        read_model = ReadModel(self.get_serializer())
+
+        def lines():
+            chunks = read_model.iter_records(queryset, settings.BOOK_EXPORT_CHUNK_SIZE)
+            for records in chunks:
+                yield "".join(
+                    json.dumps(book, separators=(",", ":")) + "\n"
+                    for book in read_model.to_representation(records)
+                )
+
+        response = StreamingHttpResponse(lines(), content_type="application/x-ndjson")
+        response["Content-Disposition"] = 'attachment; filename="books.ndjson"'
+        return response
+
+    # Count the view in memory; counts reach the database in batches
+    def retrieve(self, request, *args, **kwargs):
+        response = super().retrieve(request, *args, **kwargs)
+        view_counter.record(response.data["id"])
+        return response
+
+    # Title typeahead served from the in-memory title index
+    @action(detail=False, methods=["get"])
+    def suggest(self, request):
+        limit = parse_limit(request)
+        title_index.ensure_built()
+        suggestions = title_index.suggest(request.query_params.get("q", ""), limit)
+        return Response(
+            [{"id": book_id, "title": title} for book_id, title in suggestions]
+        )
+
+    # Precomputed similar books, read with a single indexed lookup
+    @action(detail=True, methods=["get"])
+    def similar(self, request, pk=None):
+        try:
+            book_id = int(pk)
+        except (TypeError, ValueError):
+            raise Http404
+        similar_books = list(
+            SimilarBook.objects.filter(book_id=book_id)
+            .order_by("rank")
+            .values_list("similar_id", "similar_title", "score")
+        )
+        if not similar_books and not Book.objects.filter(pk=book_id).exists():
+            raise Http404
+        return Response(
+            [
+                {"id": similar_id, "title": title, "score": round(score, 4)}
+                for similar_id, title, score in similar_books
+            ]
+        )
+
     # Set the author to the current user during book creation
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        book = serializer.save(author=self.request.user)
+        self.enqueue_cover_processing(book)
+
+    def perform_update(self, serializer):
+        book = serializer.save()
+        self.enqueue_cover_processing(book)
+
+    # Authors deleting their own book are looked up on their own shard only;
+    # other books fall back to the lookup over every shard
+    def get_object(self):
+        if self.action == "destroy" and self.request.user.is_authenticated:
+            lookup = self.kwargs[self.lookup_url_kwarg or self.lookup_field]
+            try:
+                book = self.request.user.book_set.filter(pk=lookup).first()
+            except (TypeError, ValueError):
+                raise Http404
+            if book is not None:
+                self.check_object_permissions(self.request, book)
+                return book
+        return super().get_object()
+
+    # Unpublish the book instead of deleting it
+    def perform_destroy(self, instance):
+        instance.unpublish()
+
+    # Cover validation and resizing run after the request has committed
+    def enqueue_cover_processing(self, book):
+        if not book.cover_image:
+            return
+        cover_name = book.cover_image.name
+        enqueue(
+            "books.process_cover",
+            {"book_id": book.pk, "cover_name": cover_name},
+            idempotency_key=f"books.process_cover:{book.pk}:{cover_name}",
+        )
+
+
+# A viewset for managing price rules. Restricted to admins.
+class PriceRuleViewSet(viewsets.ModelViewSet):
+
+    queryset = PriceRule.objects.order_by("-pk")
+    serializer_class = PriceRuleSerializer
+    permission_classes = [IsNotBanned, IsAdmin]
+
+    # Write the rule's discount into the stored prices of every book it
+    # covers, as one set-based update instead of a PUT per book
+    @action(detail=True, methods=["post"])
+    def apply(self, request, pk=None):
+        rule = self.get_object()
+        if rule.applied_at is None and not rule.is_active(timezone.now()):
+            return Response(
+                {"detail": "The rule is not in effect."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        updated = None if rule.applied_at is not None else apply_price_rule(rule)
+        if updated is None:
+            return Response(
+                {"detail": "The rule has already been applied."},
+                status=status.HTTP_409_CONFLICT,
+            )
+        return Response({"updated": updated})
+
+
+# Token refresh endpoint backed by the refresh token denylist
+class DenylistTokenRefreshView(TokenRefreshView):
+    serializer_class = DenylistTokenRefreshSerializer  # type: ignore
+
+
+# Stored request profiles, readable by staff only
+class ProfileReportView(APIView):
+    permission_classes = [IsAdmin]
+
+    def get(self, request, report_id):
+        report = load_report(report_id)
+        if report is None:
+            raise Http404
+        return Response(report)
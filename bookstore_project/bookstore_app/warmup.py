@@ -0,0 +1,47 @@
+import logging
+import time
+
+from django.db import DatabaseError
+from django.urls import get_resolver
+from rest_framework.settings import api_settings
+
+from .title_index import title_index
+
+logger = logging.getLogger(__name__)
+
+
+# Build the state that Django and DRF otherwise create lazily on the first
+# request: URL resolvers, model metadata behind serializer fields, translation
+# catalogs for field labels and the configured renderers and parsers. Runs
+# from AppConfig.ready(), so it must not query the database.
+def warm_up():
+    start = time.perf_counter()
+
+    # Importing the URLconf also imports every view, serializer and router
+    get_resolver()._populate()
+
+    from .urls import router
+
+    for _, viewset, _ in router.registry:
+        serializer = viewset.serializer_class()
+        for field in serializer.fields.values():
+            str(field.label)
+
+    for renderer_class in api_settings.DEFAULT_RENDERER_CLASSES:
+        renderer_class().render({"warm_up": [1, "1.00", None]})
+    for parser_class in api_settings.DEFAULT_PARSER_CLASSES:
+        parser_class()
+    for authentication_class in api_settings.DEFAULT_AUTHENTICATION_CLASSES:
+        authentication_class()
+
+    logger.info("Warm-up finished in %.1f ms", (time.perf_counter() - start) * 1000)
+
+
+# Load the in-memory indexes built from the database, which are otherwise
+# built on first use
+def build_indexes():
+    try:
+        title_index.build()
+    except DatabaseError:
+        # Not migrated yet; the index is built on the first suggestion request
+        logger.warning("Could not build the title index")
@@ -0,0 +1,65 @@
+"""
+Request handlers that run a reduced middleware chain for the JWT-only API.
+
+Requests whose path starts with ``API_PATH_PREFIX`` go through a handler built
+from ``API_MIDDLEWARE``; everything else (the admin) keeps ``MIDDLEWARE``.
+"""
+
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+
+
+# Builds the handler's middleware chain from API_MIDDLEWARE instead of MIDDLEWARE
+class APIMiddlewareMixin:
+    def load_middleware(self, is_async=False):
+        full_middleware = settings.MIDDLEWARE
+        # Handlers are built once at startup, before any request is served
+        settings.MIDDLEWARE = settings.API_MIDDLEWARE
+        try:
+            super().load_middleware(is_async)
+        finally:
+            settings.MIDDLEWARE = full_middleware
+
+
+class APIWSGIHandler(APIMiddlewareMixin, WSGIHandler):
+    pass
+
+
+class APIASGIHandler(APIMiddlewareMixin, ASGIHandler):
+    pass
+
+
+class PathRoutedWSGIHandler:
+    def __init__(self):
+        self.default_handler = WSGIHandler()
+        self.api_handler = APIWSGIHandler()
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(settings.API_PATH_PREFIX):
+            return self.api_handler(environ, start_response)
+        return self.default_handler(environ, start_response)
+
+
+class PathRoutedASGIHandler:
+    def __init__(self):
+        self.default_handler = ASGIHandler()
+        self.api_handler = APIASGIHandler()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"].startswith(
+            settings.API_PATH_PREFIX
+        ):
+            return await self.api_handler(scope, receive, send)
+        return await self.default_handler(scope, receive, send)
+
+
+def get_wsgi_application():
+    django.setup(set_prefix=False)
+    return PathRoutedWSGIHandler()
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return PathRoutedASGIHandler()
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,9 +43,25 @@ INSTALLED_APPS = [
     "bookstore_app.apps.BookstoreAppConfig",
     "rest_framework",
     "rest_framework_simplejwt",
+]
+
+# Apps only needed for local development
+DEV_APPS = [
     "django_extensions",
 ]
 
+# Development mode follows DEBUG unless set through BOOKSTORE_DEV_MODE
+DEV_MODE = os.environ.get("BOOKSTORE_DEV_MODE", "1" if DEBUG else "0") == "1"
+
+if DEV_MODE:
+    INSTALLED_APPS += DEV_APPS
+
+# Pre-build URL resolvers, serializer fields and renderers at startup so the
+# first request of a fresh worker is not slow. Off by default in development
+# to keep management commands quick. In-memory indexes read from the database
+# are built by `serve` before forking, or on first use.
+WARM_UP_ON_READY = os.environ.get("BOOKSTORE_WARM_UP", "0" if DEV_MODE else "1") == "1"
+
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -53,6 +70,17 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "bookstore_app.profiling.ProfilingMiddleware",
+]
+
+# The API authenticates with JWTs only and never uses sessions, CSRF tokens or
+# messages, so requests under API_PATH_PREFIX skip those middleware
+API_PATH_PREFIX = "/api/"
+
+API_MIDDLEWARE = [
+    "django.middleware.security.SecurityMiddleware",
+    "django.middleware.common.CommonMiddleware",
+    "bookstore_app.profiling.ProfilingMiddleware",
 ]
 
 ROOT_URLCONF = "bookstore_project.urls"
@@ -86,6 +114,67 @@ DATABASES = {
     }
 }
 
+# Caches. "coalescing" is shared by every worker process: Redis when
+# BOOKSTORE_REDIS_URL is set (needs the redis package), otherwise a table in
+# the default database created with `manage.py createcachetable`.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "coalescing": (
+        {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["BOOKSTORE_REDIS_URL"],
+        }
+        if os.environ.get("BOOKSTORE_REDIS_URL")
+        else {
+            "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+            "LOCATION": "bookstore_shared_cache",
+            # Culling could drop the request counters kept without expiry
+            "OPTIONS": {"MAX_ENTRIES": 100_000},
+        }
+    ),
+}
+
+# Books can be sharded by author over several databases. Set
+# BOOKSTORE_BOOK_SHARDS to the number of SQLite shard files; 0 keeps every book
+# in the default database. Run `migrate --database <alias>` for every shard,
+# then `rebalance_book_shards --import-unsharded` to move existing books.
+BOOK_SHARD_DATABASES = [
+    f"book_shard_{number}"
+    for number in range(int(os.environ.get("BOOKSTORE_BOOK_SHARDS", "0")))
+]
+for alias in BOOK_SHARD_DATABASES:
+    DATABASES[alias] = {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / f"db_{alias}.sqlite3",
+    }
+DATABASE_ROUTERS = ["bookstore_app.sharding.BookShardRouter"]
+# Threads querying the shards of one request in parallel
+BOOK_SHARD_QUERY_WORKERS = max(len(BOOK_SHARD_DATABASES), 1)
+# Seconds the author to shard directory is cached per process
+BOOK_SHARD_DIRECTORY_TTL = 5
+# Book ids reserved at a time by each process from the global id sequence
+BOOK_ID_BLOCK_SIZE = 100
+
+
+# Password hashing
+# https://docs.djangoproject.com/en/5.0/topics/auth/passwords/
+
+# Passwords stored with any of the other hashers are upgraded on login
+PASSWORD_HASHERS = [
+    "bookstore_app.hashers.TunableScryptPasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+]
+
+# Scrypt cost parameters; memory use per hash is 128 * work factor * block size
+PASSWORD_SCRYPT_WORK_FACTOR = 2**14
+PASSWORD_SCRYPT_BLOCK_SIZE = 8
+PASSWORD_SCRYPT_PARALLELISM = 1
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -139,13 +228,130 @@ REST_FRAMEWORK = {
     "DEFAULT_RENDERER_CLASSES": (
         "rest_framework.renderers.JSONRenderer",
         "rest_framework_xml.renderers.XMLRenderer",
+        "bookstore_app.renderers.MessagePackRenderer",
     ),
     "DEFAULT_PARSER_CLASSES": (
         "rest_framework.parsers.JSONParser",
         "rest_framework_xml.parsers.XMLParser",
+        "bookstore_app.parsers.MessagePackParser",
     ),
 }
 
+# Simple JWT settings
+SIMPLE_JWT = {
+    # Every refresh returns a new refresh token and revokes the old one
+    "ROTATE_REFRESH_TOKENS": True,
+}
+
+# Refresh token denylist settings
+TOKEN_DENYLIST_BLOOM_CAPACITY = 100_000
+TOKEN_DENYLIST_BLOOM_ERROR_RATE = 0.01
+# Seconds between pulls of tokens revoked by other processes
+TOKEN_DENYLIST_SYNC_INTERVAL = 5
+
 # Media settings for file uploads
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 MEDIA_URL = "/media/"
+
+# Background job queue settings
+JOB_QUEUE_WORKERS = 4
+# Either "thread" or "process"
+JOB_QUEUE_POOL = "thread"
+# Seconds an idle worker waits before polling for new jobs
+JOB_QUEUE_POLL_INTERVAL = 1.0
+JOB_QUEUE_MAX_ATTEMPTS = 5
+# Base delay in seconds for retries, doubled after every failed attempt
+JOB_QUEUE_RETRY_BACKOFF = 2
+JOB_QUEUE_MAX_BACKOFF = 600
+# Seconds after which a running job is considered abandoned by its worker
+JOB_QUEUE_LOCK_TIMEOUT = 300
+# Seconds finished jobs are kept before run_jobs deletes them
+JOB_QUEUE_RETENTION = 7 * 24 * 3600
+# Seconds between run_jobs maintenance passes, such as pruning finished jobs
+JOB_QUEUE_MAINTENANCE_INTERVAL = 60
+
+# Largest (width, height) a book cover is stored at
+BOOK_COVER_MAX_SIZE = (1200, 1800)
+
+# Books deleted per transaction when purging a user, and the pause in seconds
+# between batches
+BOOK_PURGE_BATCH_SIZE = 500
+BOOK_PURGE_PAUSE = 0.05
+
+# Books read per query when exporting the catalogue
+BOOK_EXPORT_CHUNK_SIZE = 2000
+
+# Admin changelists count rows exactly up to this many results and show an
+# estimate above it
+ADMIN_EXACT_COUNT_THRESHOLD = 10_000
+
+# Number of results returned by typeahead endpoints, and the most a client
+# may ask for
+AUTOCOMPLETE_DEFAULT_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+# Seconds after which the in-memory title suggestion index is rebuilt in the
+# background to pick up books written by other processes
+TITLE_SUGGEST_REBUILD_INTERVAL = 300
+
+# Seconds between checks for price rules changed by other processes; rule
+# changes in the same process and rule start and end times apply immediately
+PRICE_RULE_SYNC_INTERVAL = 5
+
+# Similar books computed from title and description TF-IDF vectors
+SIMILAR_BOOKS_TOP_K = 10
+# Highest scoring books whose neighbour lists are updated when a book is
+# folded in without a full rebuild
+SIMILAR_BOOKS_FOLD_IN_CANDIDATES = 100
+SIMILAR_BOOKS_MODEL_DIR = BASE_DIR / "data" / "similar_books"
+
+# Buffered book view counts are written after this many seconds, or once this
+# many distinct books have pending views
+BOOK_VIEW_FLUSH_INTERVAL = 10
+BOOK_VIEW_FLUSH_THRESHOLD = 1000
+
+# Trending scores decay by half every TRENDING_HALF_LIFE; weights are relative
+# to TRENDING_EPOCH and stored as base 2 logarithms, so the epoch never needs
+# to move forward
+TRENDING_HALF_LIFE = timedelta(days=3)
+TRENDING_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# Concurrent identical book list requests are coalesced into one query. Across
+# workers this goes through the cache named here, which must be shared between
+# them (Redis, Memcached or the database cache) for cross-worker coalescing.
+COALESCE_CACHE_ALIAS = "coalescing"
+# Seconds a worker may hold the computation lock before others give up waiting
+COALESCE_LOCK_TIMEOUT = 10
+# Seconds a computed result stays available to workers that waited for it
+COALESCE_RESULT_TTL = 1
+COALESCE_POLL_INTERVAL = 0.02
+
+# Staff users profile a request by sending an X-Profile header: "cprofile"
+# runs the deterministic profiler, any other value the sampling profiler.
+# Reports, with flamegraph-ready .folded stacks, are written to
+# PROFILE_REPORT_DIR and served at /api/profiles/<report id>/.
+PROFILE_REPORT_DIR = BASE_DIR / "data" / "profiles"
+PROFILE_REPORT_KEEP = 200
+# Fraction of all other requests profiled with the sampling profiler, by at
+# most PROFILE_MAX_CONCURRENT requests per process at a time
+PROFILE_SAMPLE_RATE = float(os.environ.get("BOOKSTORE_PROFILE_SAMPLE_RATE", "0"))
+PROFILE_MAX_CONCURRENT = 1
+# Seconds between stack samples
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_QUERIES = 500
+# Slowest SELECT statements of a staff profile that get an EXPLAIN plan
+PROFILE_EXPLAIN_LIMIT = 10
+
+# Preforking server run by `manage.py serve`. Workers are replaced after
+# serving SERVE_MAX_REQUESTS requests, plus a random share of the jitter so
+# they do not all restart at once.
+SERVE_WORKERS = int(os.environ.get("BOOKSTORE_SERVE_WORKERS", os.cpu_count() or 1))
+SERVE_MAX_REQUESTS = 1000
+SERVE_MAX_REQUESTS_JITTER = 100
+# Seconds a stopping worker may take to finish its current request before it
+# is killed
+SERVE_GRACEFUL_TIMEOUT = 30
+# Seconds a worker waits on a client that is slow to send its request
+SERVE_REQUEST_TIMEOUT = 30
+# Seconds between reports of the worker count and per-worker memory
+SERVE_STATS_INTERVAL = 60